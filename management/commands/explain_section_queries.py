@@ -0,0 +1,48 @@
+"""
+Сравнение планов запросов выборки разделов сайта
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from main.models import Section, Site
+
+
+class Command(BaseCommand):
+    help = 'Выводит EXPLAIN и время выполнения выборки разделов сайта через подзапросы и через LEFT JOIN настроек'
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', type=int, help='Идентификатор сайта')
+        parser.add_argument('--repeat', type=int, default=10, help='Количество повторов для замера времени')
+        parser.add_argument('--analyze', action='store_true', help='Выполнить EXPLAIN ANALYZE')
+
+    def handle(self, *args, **options):
+        try:
+            site = Site.objects.get(id=options['site'])
+        except Site.DoesNotExist:
+            raise CommandError('Сайт не найден')
+
+        query = Q(is_deleted=False) & Section.get_filter_query_by_site(site)
+        base_queryset = Section.objects.filter(query).nocache()
+
+        subquery_queryset = base_queryset\
+            .extra(**Section.get_extrafilter_ordering_by_site(site))\
+            .extra(**Section.get_extrafilter_active_by_site(site))\
+            .order_by('ordering', 'order')\
+            .distinct()
+        join_queryset = Section.annotate_site_overlay(base_queryset, site)\
+            .filter(site_is_active=True)\
+            .order_by('ordering', 'order')\
+            .distinct()
+
+        for title, queryset in (('Коррелированные подзапросы', subquery_queryset), ('LEFT JOIN настроек', join_queryset)):
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            self.stdout.write(queryset.explain(analyze=options['analyze']))
+
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                # новый клон на каждой итерации: иначе повторы берут результат из кеша QuerySet
+                count = len(queryset.all())
+            duration = (time.perf_counter() - start) / options['repeat']
+            self.stdout.write(f'Разделов: {count}, среднее время: {duration * 1000:.2f} мс\n')
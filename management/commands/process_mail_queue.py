@@ -0,0 +1,41 @@
+"""
+Фоновый обработчик очереди писем
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.services.feedback import MAIL_BATCH_SIZE, MAIL_MAX_ATTEMPTS, get_mail_queue_stats, process_mail_queue
+
+
+class Command(BaseCommand):
+    help = 'Отправляет письма из очереди django_mail_admin пачками с повтором неудачных отправок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=getattr(settings, 'MAIL_QUEUE_BATCH_SIZE', MAIL_BATCH_SIZE),
+                            help='Количество писем в пачке')
+        parser.add_argument('--max-attempts', type=int,
+                            default=getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', MAIL_MAX_ATTEMPTS),
+                            help='Количество попыток отправки письма')
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Пауза при пустой очереди, секунд')
+        parser.add_argument('--stats', action='store_true', help='Вывести состояние очереди без отправки писем')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for key, value in get_mail_queue_stats().items():
+                self.stdout.write(f'{key}: {value}')
+            return
+        while True:
+            stats = process_mail_queue(batch_size=options['batch_size'], max_attempts=options['max_attempts'])
+            if stats['rows']:
+                self.stdout.write(
+                    f'Писем: {stats["rows"]}, отправлено: {stats["sent"]}, '
+                    f'повторов: {stats["retried"]}, ошибок: {stats["failed"]}'
+                )
+            if not options['loop']:
+                break
+            if stats['rows'] < options['batch_size']:
+                time.sleep(options['sleep'])
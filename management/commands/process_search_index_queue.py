@@ -0,0 +1,36 @@
+"""
+Фоновый обработчик очереди обновления поискового индекса
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.services.search_index import get_index_backend, process_search_index_queue
+
+
+class Command(BaseCommand):
+    help = 'Разбирает очередь обновления поискового индекса пачками через bulk API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Размер пачки записей очереди')
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Пауза при пустой очереди, секунд')
+
+    def handle(self, *args, **options):
+        # одно хранилище на весь разбор: локальный индекс сохраняется, когда очередь разобрана
+        backend = get_index_backend()
+        try:
+            while True:
+                stats = process_search_index_queue(batch_size=options['batch_size'], backend=backend)
+                if stats['rows']:
+                    self.stdout.write(
+                        f'Записей: {stats["rows"]}, объектов: {stats["objects"]}, ошибок: {stats["failed"]}'
+                    )
+                if stats['rows'] < options['batch_size']:
+                    backend.flush()
+                if not options['loop']:
+                    break
+                if stats['rows'] < options['batch_size']:
+                    time.sleep(options['sleep'])
+        finally:
+            backend.flush()
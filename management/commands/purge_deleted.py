@@ -0,0 +1,50 @@
+"""
+Окончательное удаление давно удаленных объектов
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.services.purge import DEFAULT_RETENTION_DAYS, get_status_delete_models, purge_deleted
+
+
+class Command(BaseCommand):
+    help = 'Окончательно удаляет объекты, помеченные удаленными раньше срока хранения, пачками по первичному ключу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='*', help='Имена моделей (по умолчанию все модели с пометкой удаления)')
+        parser.add_argument('--retention-days', type=int,
+                            default=getattr(settings, 'PURGE_DELETED_RETENTION_DAYS', DEFAULT_RETENTION_DAYS),
+                            help='Срок хранения удаленных объектов, дней')
+        parser.add_argument('--batch-size', type=int, default=500, help='Количество объектов в пачке')
+        parser.add_argument('--sleep', type=float, default=0.5, help='Пауза между пачками, секунд')
+        parser.add_argument('--dry-run', action='store_true', help='Только подсчитать объекты для удаления')
+
+    def handle(self, *args, **options):
+        purge_models = get_status_delete_models()
+        if options['models']:
+            names = set(name.lower() for name in options['models'])
+            purge_models = [model for model in purge_models if model._meta.model_name in names]
+            if not purge_models:
+                raise CommandError('Модели не найдены')
+
+        total_rows = 0
+        total_bytes = 0
+        for model in purge_models:
+            rows = 0
+            size = None
+            for stats in purge_deleted(model, retention_days=options['retention_days'],
+                                       batch_size=options['batch_size'], sleep=options['sleep'],
+                                       dry_run=options['dry_run']):
+                rows += stats['rows']
+                if stats['bytes'] is not None:
+                    size = (size or 0) + stats['bytes']
+                self.stdout.write(f'{model._meta.label}: {rows}, последний id {stats["last_pk"]}')
+            if rows:
+                self.stdout.write(self.style.SUCCESS(
+                    f'{model._meta.label}: удалено {rows}' + (f', данных строк {size} байт' if size is not None else '')
+                ))
+            total_rows += rows
+            total_bytes += size or 0
+
+        prefix = 'К удалению' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(f'{prefix} объектов: {total_rows}, данных строк: {total_bytes} байт'))
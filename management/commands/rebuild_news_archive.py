@@ -0,0 +1,14 @@
+"""
+Перестроение архива новостей по месяцам
+"""
+from django.core.management.base import BaseCommand
+
+from main.models.news_archive import NewsArchive
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает таблицу архива новостей (количество новостей сайта по месяцам)'
+
+    def handle(self, *args, **options):
+        count = NewsArchive.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Архив новостей перестроен, ячеек: {count}'))
@@ -0,0 +1,257 @@
+"""
+Параллельное перестроение поискового индекса
+"""
+import multiprocessing
+import time
+import typing
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, models
+
+from main.models.search_model import SearchMixin
+from main.services.search_index import LocalIndexBackend, get_documents, index_objects, \
+    pause_search_index_queue, resume_search_index_queue, uses_local_index
+from main.services.search_local import get_local_index
+
+
+def get_search_models() -> typing.List[typing.Type[models.Model]]:
+    """ Возвращает модели, участвующие в поиске """
+    return [model for model in apps.get_app_config('main').get_models() if issubclass(model, SearchMixin)]
+
+
+def get_site_filter(site_id: typing.Optional[int]) -> models.Q:
+    """ Возвращает фильтр объектов по сайту """
+    if site_id is None:
+        return models.Q()
+    return models.Q(site_id=site_id)
+
+
+def init_worker() -> None:
+    """ Инициализация процесса: соединения с БД и Elasticsearch не наследуются от родителя """
+    from elasticsearch_dsl.connections import connections as es_connections
+
+    connections.close_all()
+    es_connections.create_connection(alias='default', **settings.ELASTICSEARCH_DSL['default'])
+
+
+def index_chunk(task: tuple) -> typing.Tuple[str, int, int, typing.Optional[str]]:
+    """
+    Индексирует объекты модели в диапазоне первичных ключей
+    :param task: (метка модели, начальный pk, конечный pk, имя индекса, сайт)
+    :return: (метка модели, отправлено документов, проиндексировано документов, первая ошибка)
+    """
+    from elasticsearch.helpers import bulk
+    from elasticsearch_dsl.connections import connections as es_connections
+
+    model_label, pk_from, pk_to, index_name, site_id = task
+    model = apps.get_model(model_label)
+    queryset = model._default_manager\
+        .filter(get_site_filter(site_id) & models.Q(pk__gte=pk_from, pk__lte=pk_to))\
+        .order_by('pk')
+    if hasattr(model, 'is_deleted'):
+        queryset = queryset.filter(is_deleted=False)
+    if hasattr(model, 'placeholders'):
+        queryset = queryset.prefetch_related('placeholders')
+    objects = list(queryset)
+
+    sent = 0
+    count = 0
+    first_error = None
+    for document_class in get_documents(model):
+        document = document_class()
+        generate_id = getattr(document_class, 'generate_id', None)
+        actions = [
+            {
+                '_op_type': 'index',
+                '_index': index_name or document_class._index._name,
+                '_id': generate_id(obj) if generate_id else obj.pk,
+                '_source': document.prepare(obj),
+            }
+            for obj in objects
+        ]
+        success, errors = bulk(es_connections.get_connection(), actions, raise_on_error=False)
+        sent += len(actions)
+        count += success
+        if errors and first_error is None:
+            first_error = str(errors[0])
+    return model_label, sent, count, first_error
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс всех моделей поиска параллельно пачками через bulk API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='*', help='Имена моделей (по умолчанию все модели поиска)')
+        parser.add_argument('--site', type=int, default=None, help='Переиндексировать только объекты сайта')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Количество объектов в пачке')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Количество процессов')
+        parser.add_argument('--no-swap', action='store_true',
+                            help='Индексировать в рабочий индекс без создания нового индекса и переключения алиаса')
+        parser.add_argument('--keep-old', action='store_true', help='Не удалять старый индекс после переключения')
+        parser.add_argument('--local', action='store_true',
+                            help='Построить только локальный индекс поиска (SEARCH_LOCAL_INDEX_PATH)')
+
+    def get_models(self, options) -> typing.List[typing.Type[models.Model]]:
+        search_models = get_search_models()
+        if options['models']:
+            names = set(name.lower() for name in options['models'])
+            search_models = [model for model in search_models if model._meta.model_name in names]
+            if not search_models:
+                raise CommandError('Модели поиска не найдены')
+        if options['site'] is not None:
+            skipped = [model for model in search_models if not hasattr(model, 'site_id')]
+            for model in skipped:
+                self.stdout.write(self.style.WARNING(f'{model._meta.label}: нет привязки к сайту, пропускаю'))
+            search_models = [model for model in search_models if model not in skipped]
+        return search_models
+
+    def get_tasks(self, search_models, index_names: dict, options) -> typing.Tuple[list, dict]:
+        """ Разбивает объекты моделей на диапазоны первичных ключей """
+        tasks = []
+        totals = dict()
+        for model in search_models:
+            queryset = model._default_manager.filter(get_site_filter(options['site']))
+            if hasattr(model, 'is_deleted'):
+                queryset = queryset.filter(is_deleted=False)
+            totals[model._meta.label] = 0
+            chunk = []
+            for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator():
+                chunk.append(pk)
+                totals[model._meta.label] += 1
+                if len(chunk) >= options['chunk_size']:
+                    tasks.append((model._meta.label, chunk[0], chunk[-1], index_names.get(model), options['site']))
+                    chunk = []
+            if chunk:
+                tasks.append((model._meta.label, chunk[0], chunk[-1], index_names.get(model), options['site']))
+        return tasks, totals
+
+    def create_indexes(self, search_models) -> typing.Tuple[dict, dict]:
+        """ Создает новые индексы для последующего переключения алиасов """
+        timestamp = time.strftime('%Y%m%d%H%M%S')
+        new_indexes = dict()
+        index_names = dict()
+        for model in search_models:
+            for document_class in get_documents(model):
+                alias = document_class._index._name
+                if alias not in new_indexes:
+                    new_indexes[alias] = document_class._index.clone(f'{alias}-{timestamp}')
+                    new_indexes[alias].create()
+                    self.stdout.write(f'Создан индекс {new_indexes[alias]._name}')
+                index_names[model] = new_indexes[alias]._name
+        return new_indexes, index_names
+
+    def swap_aliases(self, new_indexes: dict, keep_old: bool) -> None:
+        """ Переключает алиасы на новые индексы """
+        from elasticsearch_dsl.connections import connections as es_connections
+
+        client = es_connections.get_connection()
+        for alias, index in new_indexes.items():
+            client.indices.refresh(index=index._name)
+            actions = [{'add': {'index': index._name, 'alias': alias}}]
+            old_indexes = []
+            if client.indices.exists_alias(name=alias):
+                old_indexes = list(client.indices.get_alias(name=alias).keys())
+                actions = [{'remove': {'index': name, 'alias': alias}} for name in old_indexes] + actions
+            elif client.indices.exists(index=alias):
+                # первый запуск: рабочий индекс был обычным индексом, а не алиасом
+                self.stdout.write(self.style.WARNING(f'Индекс {alias} будет заменен алиасом'))
+                client.indices.delete(index=alias)
+            client.indices.update_aliases(body={'actions': actions})
+            self.stdout.write(self.style.SUCCESS(f'Алиас {alias} переключен на {index._name}'))
+            if not keep_old:
+                for name in old_indexes:
+                    client.indices.delete(index=name)
+                    self.stdout.write(f'Удален индекс {name}')
+
+    def delete_indexes(self, new_indexes: dict) -> None:
+        """ Удаляет новые индексы неудачного перестроения, рабочие алиасы не меняются """
+        for index in new_indexes.values():
+            index.delete(ignore=404)
+            self.stdout.write(f'Удален индекс {index._name}')
+
+    def build_local(self, search_models, options) -> None:
+        """ Строит локальный индекс поиска из тех же документов, что отправляются в Elasticsearch """
+        if options['site'] is None:
+            for model in search_models:
+                for document_class in get_documents(model):
+                    get_local_index(document_class._index._name).clear()
+
+        backend = LocalIndexBackend()
+        tasks, totals = self.get_tasks(search_models, dict(), options)
+        done = {label: 0 for label in totals}
+        start = time.perf_counter()
+        for model_label, pk_from, pk_to, _, site_id in tasks:
+            model = apps.get_model(model_label)
+            ids = list(
+                model._default_manager
+                    .filter(get_site_filter(site_id) & models.Q(pk__gte=pk_from, pk__lte=pk_to))
+                    .values_list('pk', flat=True)
+            )
+            index_objects(model, ids, [], backend=backend)
+            done[model_label] += len(ids)
+            self.stdout.write(f'{model_label}: {done[model_label]}/{totals[model_label]}')
+        backend.flush()
+        self.stdout.write(self.style.SUCCESS(
+            f'Локальный индекс построен: {sum(done.values())} документов за {time.perf_counter() - start:.1f} с'
+        ))
+
+    def handle(self, *args, **options):
+        search_models = self.get_models(options)
+        if options['local']:
+            self.build_local(search_models, options)
+            return
+        use_swap = not options['no_swap'] and options['site'] is None
+
+        if use_swap:
+            # изменения объектов во время перестроения остаются в очереди
+            # и после переключения алиаса попадают в новый индекс
+            pause_search_index_queue()
+        try:
+            self.rebuild(search_models, use_swap, options)
+            if uses_local_index():
+                # запасной индекс строится из тех же объектов, иначе при отказе кластера поиск пуст
+                self.build_local(search_models, options)
+        finally:
+            if use_swap:
+                resume_search_index_queue()
+
+    def rebuild(self, search_models, use_swap: bool, options) -> None:
+        new_indexes, index_names = self.create_indexes(search_models) if use_swap else (dict(), dict())
+        tasks, totals = self.get_tasks(search_models, index_names, options)
+        self.stdout.write(f'Объектов: {sum(totals.values())}, пачек: {len(tasks)}, процессов: {options["workers"]}')
+
+        # дочерние процессы открывают свои соединения
+        connections.close_all()
+        done = {label: 0 for label in totals}
+        sent = 0
+        failed = 0
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes=options['workers'], initializer=init_worker) as pool:
+            for model_label, chunk_sent, count, error in pool.imap_unordered(index_chunk, tasks):
+                if use_swap:
+                    pause_search_index_queue()
+                done[model_label] += count
+                sent += chunk_sent
+                failed += chunk_sent - count
+                if error:
+                    self.stderr.write(f'{model_label}: не проиндексировано {chunk_sent - count} документов: {error}')
+                duration = time.perf_counter() - start
+                self.stdout.write(
+                    f'{model_label}: {done[model_label]}/{totals[model_label]}, '
+                    f'всего {sum(done.values())} документов, {sum(done.values()) / duration:.0f} док/с'
+                )
+
+        if failed:
+            if use_swap:
+                self.delete_indexes(new_indexes)
+            raise CommandError(
+                f'Проиндексировано {sum(done.values())} из {sent} документов, ошибок: {failed}'
+                + ('. Алиасы не переключены' if use_swap else '')
+            )
+        if use_swap:
+            self.swap_aliases(new_indexes, options['keep_old'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Проиндексировано {sum(done.values())} документов за {time.perf_counter() - start:.1f} с'
+        ))
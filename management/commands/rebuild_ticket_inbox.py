@@ -0,0 +1,14 @@
+"""
+Перестроение сводки обращений
+"""
+from django.core.management.base import BaseCommand
+
+from main.models.ticket_inbox import TicketInboxSummary
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает таблицу сводки обращений (количество тикетов по статусам и типам, новые сообщения)'
+
+    def handle(self, *args, **options):
+        count = TicketInboxSummary.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Сводка обращений перестроена, ячеек: {count}'))
@@ -0,0 +1,47 @@
+"""
+Индексы БД, которые нельзя описать в Meta моделей этого модуля
+"""
+import typing
+from django.db import migrations, models
+
+ALIVE_CONDITION = 'is_deleted = false'
+
+
+def create_index_operation(table: str, name: str, columns: typing.List[str], where: str = None,
+                           concurrently: bool = False) -> migrations.RunSQL:
+    """
+    Возвращает операцию миграции для создания индекса
+    :param table: имя таблицы
+    :param name: имя индекса
+    :param columns: список колонок индекса
+    :param where: условие частичного индекса
+    :param concurrently: создавать без блокировки записи в таблицу (миграция должна быть atomic = False)
+    :return: операция миграции
+    """
+    option = 'CONCURRENTLY ' if concurrently else ''
+    sql = f'CREATE INDEX {option}IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+    if where:
+        sql += f' WHERE {where}'
+    return migrations.RunSQL(sql, reverse_sql=f'DROP INDEX {option}IF EXISTS {name}')
+
+
+def add_alive_index_operation(model_name: str, table: str, index: models.Index,
+                              columns: typing.List[str]) -> migrations.SeparateDatabaseAndState:
+    """
+    Возвращает операцию миграции для частичного индекса по неудаленным объектам (alive_index в Meta модели).
+    Индекс создается CONCURRENTLY, состояние миграций совпадает с AddIndex
+    :param model_name: имя модели в миграциях
+    :param table: имя таблицы
+    :param index: индекс из Meta.indexes модели
+    :param columns: колонки индекса в БД
+    """
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[create_index_operation(table, index.name, columns, ALIVE_CONDITION, concurrently=True)],
+        state_operations=[migrations.AddIndex(model_name=model_name, index=index)],
+    )
+
+
+# индекс присоединения настроек раздела для сайта (Section.annotate_site_overlay)
+SECTION_SETTINGS_SITE_INDEX = create_index_operation(
+    'main_sectionsettings', 'main_sectionsettings_section_site_idx', ['section_id', 'site_id']
+)
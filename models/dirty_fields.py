@@ -0,0 +1,97 @@
+"""
+Отслеживание изменений полей моделей
+"""
+import typing
+from collections import Counter
+
+from django.db import models
+
+side_effect_counters = Counter()
+
+
+def count_side_effect(name: str, performed: bool) -> None:
+    """ Учитывает выполненное или пропущенное побочное действие сохранения объекта """
+    side_effect_counters[f'{name}.{"performed" if performed else "skipped"}'] += 1
+
+
+def get_side_effect_counters() -> typing.Dict[str, int]:
+    """ Возвращает счетчики выполненных и пропущенных побочных действий в текущем процессе """
+    return dict(side_effect_counters)
+
+
+class DirtyFieldsMixin(models.Model):
+    """
+    Абстрактная модель с отслеживанием измененных полей с момента загрузки из БД или последнего сохранения.
+    В обработчиках post_save измененные при сохранении поля проверяются через was_changed()
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DirtyFieldsMixin, cls).from_db(db, field_names, values)
+        instance._loaded_state = instance.get_field_state()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(DirtyFieldsMixin, self).refresh_from_db(using=using, fields=fields)
+        self._update_loaded_state(fields)
+
+    def get_field_state(self) -> dict:
+        """ Возвращает значения загруженных полей объекта """
+        deferred = self.get_deferred_fields()
+        return {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+        }
+
+    def _get_attnames(self, names: typing.Iterable[str]) -> typing.Set[str]:
+        return {self._meta.get_field(name).attname for name in names}
+
+    def _update_loaded_state(self, fields: typing.Iterable[str] = None) -> None:
+        state = self.get_field_state()
+        if fields is not None and hasattr(self, '_loaded_state'):
+            attnames = self._get_attnames(fields)
+            state = dict(self._loaded_state, **{name: value for name, value in state.items() if name in attnames})
+        self._loaded_state = state
+
+    def is_tracked(self, name: str) -> bool:
+        """ Проверяет, известно ли значение поля на момент загрузки """
+        return self._meta.get_field(name).attname in getattr(self, '_loaded_state', dict())
+
+    def get_loaded_value(self, name: str):
+        """ Возвращает значение поля на момент загрузки или последнего сохранения """
+        return self._loaded_state[self._meta.get_field(name).attname]
+
+    def get_dirty_fields(self) -> typing.Set[str]:
+        """ Возвращает имена атрибутов полей, измененных с момента загрузки (для нового объекта - все поля) """
+        state = self.get_field_state()
+        loaded_state = getattr(self, '_loaded_state', None)
+        if loaded_state is None:
+            return set(state.keys())
+        return {name for name, value in state.items() if name not in loaded_state or loaded_state[name] != value}
+
+    def has_changed(self, *names: str) -> bool:
+        """ Проверяет, изменилось ли хотя бы одно из полей с момента загрузки """
+        return bool(self._get_attnames(names) & self.get_dirty_fields())
+
+    def was_changed(self, *names: str) -> bool:
+        """ Проверяет в обработчиках сохранения, было ли при сохранении изменено хотя бы одно из полей """
+        saved_changes = getattr(self, '_saved_changes', None)
+        if saved_changes is None:
+            return True
+        return bool(self._get_attnames(names) & saved_changes)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        changes = self.get_dirty_fields()
+        if update_fields is not None:
+            changes &= self._get_attnames(update_fields)
+        self._saved_changes = changes
+        try:
+            result = super(DirtyFieldsMixin, self).save(*args, **kwargs)
+        finally:
+            self._saved_changes = None
+        self._update_loaded_state(update_fields)
+        return result
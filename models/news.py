@@ -2,7 +2,6 @@
 Модуль модели новости
 """
 import logging
-import traceback
 from django.db import models
 from django_extensions.db.fields import AutoSlugField
 from slugify import slugify
@@ -10,14 +9,19 @@ from django_extensions.db.fields import CreationDateTimeField, ModificationDateT
 from django.utils import timezone
 import reversion
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 
 from main.models import NewsSection, Site, Placeholder, Image
 from main.models.include.image_transform import ImageTransform
 from main.models.fields import SanitizedHTMLField
+from main.models.news_archive import NewsArchive
+from main.models.search_index_queue import SearchIndexQueue
 
-from .status_delete_model import StatusDeleteMixin
+from .dirty_fields import DirtyFieldsMixin, count_side_effect
+from .status_delete_model import AliveManager, StatusDeleteMixin, StatusDeleteQuerySet, alive_index, \
+    status_deleted_many
 from .accessory import AccessoryMixin
 from .search_model import SearchMixin
 
@@ -26,7 +30,7 @@ logger = logging.getLogger('debug')
 
 
 @reversion.register()
-class News(SearchMixin, AccessoryMixin, StatusDeleteMixin, models.Model):
+class News(DirtyFieldsMixin, SearchMixin, AccessoryMixin, StatusDeleteMixin, models.Model):
     """
     Модель новостей
     """
@@ -52,10 +56,26 @@ class News(SearchMixin, AccessoryMixin, StatusDeleteMixin, models.Model):
 
     placeholders = GenericRelation(Placeholder)
 
+    objects = StatusDeleteQuerySet.as_manager()
+    alive = AliveManager()
+
+    # связанные объекты для сериализатора результатов поиска
+    search_select_related = ('image', )
+    # текст результата поиска собирается из плейсхолдеров (search_text)
+    search_prefetch_related = ('placeholders', )
+    # поля, от которых зависят документ поискового индекса и рассылка
+    search_index_fields = ('title', 'preview', 'slug', 'site', 'date_publish', 'is_chronicles', 'is_deleted')
+    mailing_fields = ('is_mailing', 'is_deleted')
+
     class Meta:
         verbose_name = 'Новость'
         verbose_name_plural = 'Новости'
         ordering = ('title', )
+        indexes = [
+            # публичные ленты новостей сайта и навигация по курсору: ORDER BY date_publish DESC, id DESC
+            # без NULL-дат совпадает с обратным проходом индекса
+            alive_index(['site', 'date_publish', 'id'], 'main_news_alive_site_pub_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.title
@@ -103,13 +123,14 @@ class News(SearchMixin, AccessoryMixin, StatusDeleteMixin, models.Model):
     @staticmethod
     def has_perm(obj, perm, user, site) -> bool:
         from .site_right import SiteRight
-        
-        rights = user.get_rights_for_site(site)
-        if rights:
-            if rights.rights_type == SiteRight.RightType.FULL:
+        from main.services.permissions import get_permission_matrix
+
+        matrix = get_permission_matrix(user, site)
+        if matrix.has_rights:
+            if matrix.rights_type == SiteRight.RightType.FULL:
                 return True
             else:
-                return rights.sections.filter(code='news').count() > 0
+                return 'news' in matrix.section_codes
         return False
 
     def copy_chronicles(self):
@@ -142,7 +163,6 @@ class News(SearchMixin, AccessoryMixin, StatusDeleteMixin, models.Model):
 @receiver(post_save, sender=News, weak=False)
 def news_post_save(instance: News, created, **kwargs):
     from .mailing import Mailing
-    from main.documents.news import NewsDocument
 
     if created:
         # создаю прейсхолжер для содержимого новости
@@ -152,17 +172,23 @@ def news_post_save(instance: News, created, **kwargs):
             site=instance.site
         )
 
-    # обновление поискового индекса
-    try:
-        if instance.is_deleted:
-            NewsDocument().update(instance, action='delete')
-        else:
-            NewsDocument().update(instance)
-    except:
-        logger.error('Error update search index for news')
-        logger.error(traceback.format_exc())
+    # обновление поискового индекса через очередь, индекс обновляется фоновым обработчиком
+    reindex = created or instance.was_changed(*News.search_index_fields)
+    count_side_effect('news.search_index', reindex)
+    if reindex:
+        SearchIndexQueue.enqueue(
+            instance,
+            action=SearchIndexQueue.Action.DELETE if instance.is_deleted else SearchIndexQueue.Action.INDEX
+        )
+
+    # обновление архива новостей по месяцам
+    update_news_archive(instance, created)
 
     # обновление рассылки
+    sync_mailing = created or instance.was_changed(*News.mailing_fields)
+    count_side_effect('news.mailing', sync_mailing)
+    if not sync_mailing:
+        return
     if instance.is_mailing and not instance.is_deleted:
         if not instance.mailings.all().exists():
             Mailing.objects.create(
@@ -173,5 +199,78 @@ def news_post_save(instance: News, created, **kwargs):
                 category=Mailing.Category.NEWS,
                 news=instance
             )
+    elif not created:
+        instance.mailings.all().delete()
+
+
+def update_news_archive(instance: News, created: bool = False) -> None:
+    """ Пересчитывает ячейки архива, в которые новость входила до и после изменения """
+    new_bucket = NewsArchive.get_bucket(instance)
+    if created:
+        buckets = {new_bucket}
+    elif all(instance.is_tracked(name) for name in NewsArchive.BUCKET_FIELDS):
+        old_bucket = NewsArchive.get_bucket(instance, loaded=True)
+        buckets = {old_bucket, new_bucket} if old_bucket != new_bucket else set()
+    else:
+        # прежние значения неизвестны (объект не загружался из БД), пересчитывается текущая ячейка
+        buckets = {new_bucket}
+    for bucket in buckets - {None}:
+        NewsArchive.recount(*bucket)
+
+
+@receiver([post_save, post_delete], sender=Placeholder, weak=False)
+def news_placeholder_changed(instance: Placeholder, **kwargs):
+    """ Текст плейсхолдера входит в поисковый текст новости, новость переиндексируется """
+    if kwargs.get('created') and not instance.text:
+        # пустой плейсхолдер создается вместе с новостью, новость уже в очереди индексации
+        return
+    if instance.content_type_id != ContentType.objects.get_for_model(News).id:
+        return
+    reindex = News.objects.filter(pk=instance.object_id, is_deleted=False).exists()
+    count_side_effect('news.placeholder_search_index', reindex)
+    if reindex:
+        SearchIndexQueue.enqueue_many(News, [instance.object_id])
+
+
+@receiver(post_delete, sender=News, weak=False)
+def news_post_delete(instance: News, **kwargs):
+    bucket = NewsArchive.get_bucket(instance)
+    if bucket:
+        NewsArchive.recount(*bucket)
+
+
+@receiver(status_deleted_many, sender=News, weak=False)
+def news_status_deleted_many(ids: list, is_deleted: bool, **kwargs):
+    """ Побочные действия пакетного удаления или восстановления новостей """
+    from .mailing import Mailing
+
+    SearchIndexQueue.enqueue_many(
+        News, ids, SearchIndexQueue.Action.DELETE if is_deleted else SearchIndexQueue.Action.INDEX
+    )
+
+    news_list = list(
+        News.objects.filter(pk__in=ids).only('id', 'site', 'title', 'is_chronicles', 'is_mailing', 'date_publish')
+    )
+    # ячейки архива, в которые входят новости, пересчитываются один раз
+    buckets = {
+        (news.site_id, news.is_chronicles, news.date_publish.year, news.date_publish.month)
+        for news in news_list if news.date_publish
+    }
+    for bucket in buckets:
+        NewsArchive.recount(*bucket)
+
+    if is_deleted:
+        Mailing.objects.filter(news_id__in=ids).delete()
     else:
-        instance.mailings.all().delete()
\ No newline at end of file
+        with_mailing = set(Mailing.objects.filter(news_id__in=ids).values_list('news_id', flat=True))
+        Mailing.objects.bulk_create([
+            Mailing(
+                site_id=news.site_id,
+                title=news.title,
+                is_active=True,
+                method=Mailing.TimeMethod.AUTO,
+                category=Mailing.Category.NEWS,
+                news=news
+            )
+            for news in news_list if news.is_mailing and news.id not in with_mailing
+        ])
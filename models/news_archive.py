@@ -0,0 +1,103 @@
+"""
+Модуль модели архива новостей
+"""
+import typing
+from django.db import IntegrityError, models
+from django.db.models import Count
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.transaction import atomic
+
+from main.models import Site
+
+
+class NewsArchive(models.Model):
+    """
+    Количество опубликованных новостей сайта по месяцам.
+    Поддерживается при сохранении новостей, используется для статистики архива
+    """
+    site = models.ForeignKey(Site, verbose_name='Сайт', default=None, blank=True, null=True, on_delete=models.CASCADE)
+    is_chronicles = models.BooleanField('Летопись', default=False, blank=True)
+    year = models.PositiveSmallIntegerField('Год')
+    month = models.PositiveSmallIntegerField('Месяц')
+    count = models.PositiveIntegerField('Количество новостей', default=0, blank=True)
+
+    class Meta:
+        verbose_name = 'Архив новостей'
+        verbose_name_plural = 'Архив новостей'
+        ordering = ('year', 'month')
+        unique_together = (
+            ('site', 'is_chronicles', 'year', 'month'),
+        )
+
+    def __str__(self) -> str:
+        return f'{self.month}.{self.year}: {self.count}'
+
+    # поля новости, определяющие ячейку архива
+    BUCKET_FIELDS = ('site', 'is_chronicles', 'is_deleted', 'date_publish')
+
+    @staticmethod
+    def get_bucket(news, loaded: bool = False) -> typing.Optional[tuple]:
+        """
+        Возвращает ячейку архива для новости или None если новость не учитывается
+        :param news: новость
+        :param loaded: по значениям полей на момент загрузки новости из БД
+        """
+        if loaded:
+            site_id, is_chronicles, is_deleted, date_publish = [
+                news.get_loaded_value(name) for name in NewsArchive.BUCKET_FIELDS
+            ]
+        else:
+            site_id, is_chronicles, is_deleted, date_publish = \
+                news.site_id, news.is_chronicles, news.is_deleted, news.date_publish
+        if is_deleted or not date_publish:
+            return None
+        return site_id, is_chronicles, date_publish.year, date_publish.month
+
+    @classmethod
+    @atomic
+    def recount(cls, site_id: typing.Optional[int], is_chronicles: bool, year: int, month: int) -> None:
+        """ Пересчитывает количество новостей в ячейке архива """
+        from main.models.news import News
+
+        count = News.objects.filter(
+            site_id=site_id,
+            is_chronicles=is_chronicles,
+            date_publish__year=year,
+            date_publish__month=month,
+            is_deleted=False,
+        ).count()
+        items = cls.objects.select_for_update().filter(
+            site_id=site_id, is_chronicles=is_chronicles, year=year, month=month
+        )
+        if count:
+            if items.update(count=count):
+                return
+            try:
+                with atomic():
+                    cls.objects.create(
+                        site_id=site_id, is_chronicles=is_chronicles, year=year, month=month, count=count
+                    )
+            except IntegrityError:
+                # ячейку одновременно создала другая транзакция
+                items.update(count=count)
+        else:
+            items.delete()
+
+    @classmethod
+    @atomic
+    def rebuild(cls) -> int:
+        """
+        Полностью перестраивает архив по таблице новостей
+        :return: количество ячеек архива
+        """
+        from main.models.news import News
+
+        rows = News.objects.filter(is_deleted=False, date_publish__isnull=False)\
+            .annotate(year=ExtractYear('date_publish'), month=ExtractMonth('date_publish'))\
+            .order_by()\
+            .values('site_id', 'is_chronicles', 'year', 'month')\
+            .annotate(count=Count('id'))
+        items = [cls(**row) for row in rows]
+        cls.objects.all().delete()
+        cls.objects.bulk_create(items)
+        return len(items)
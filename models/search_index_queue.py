@@ -0,0 +1,60 @@
+"""
+Модуль модели очереди обновления поискового индекса
+"""
+import typing
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+from django_extensions.db.fields import CreationDateTimeField
+
+
+class SearchIndexQueue(models.Model):
+    """
+    Очередь обновления поискового индекса.
+    Записи создаются в транзакции сохранения объекта и разбираются фоновым обработчиком
+    """
+    class Action:
+        INDEX = 'index'
+        DELETE = 'delete'
+
+        @classmethod
+        def to_dict(cls):
+            return {
+                cls.INDEX: 'Индексирование',
+                cls.DELETE: 'Удаление из индекса',
+            }
+
+    content_type = models.ForeignKey(ContentType, verbose_name='Тип объекта', on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField('Идентификатор объекта')
+    action = models.CharField('Действие', max_length=10, choices=list(Action.to_dict().items()), default=Action.INDEX)
+    date_created = CreationDateTimeField('Дата создания')
+    date_next_attempt = models.DateTimeField('Дата следующей попытки', default=timezone.datetime.now, db_index=True)
+    attempts = models.PositiveSmallIntegerField('Количество неудачных попыток', default=0, blank=True)
+    last_error = models.TextField('Последняя ошибка', default='', blank=True)
+
+    class Meta:
+        verbose_name = 'Очередь поискового индекса'
+        verbose_name_plural = 'Очередь поискового индекса'
+        ordering = ('id', )
+
+    def __str__(self) -> str:
+        return f'{self.content_type_id}:{self.object_id} {self.action}'
+
+    @classmethod
+    def enqueue(cls, instance: models.Model, action: str = Action.INDEX) -> 'SearchIndexQueue':
+        """ Ставит объект в очередь обновления поискового индекса """
+        return cls.objects.create(
+            content_type=ContentType.objects.get_for_model(instance),
+            object_id=instance.pk,
+            action=action,
+        )
+
+    @classmethod
+    def enqueue_many(cls, model: typing.Type[models.Model], ids: typing.Iterable[int],
+                     action: str = Action.INDEX) -> None:
+        """ Ставит в очередь обновления поискового индекса список объектов одной модели """
+        content_type = ContentType.objects.get_for_model(model)
+        cls.objects.bulk_create([
+            cls(content_type=content_type, object_id=object_id, action=action)
+            for object_id in ids
+        ])
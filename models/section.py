@@ -1,25 +1,47 @@
 """
 Модуль модели регионов России
 """
+import typing
+
 import reversion
 from django.contrib.contenttypes.fields import GenericRelation
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, FilteredRelation, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django_extensions.db.fields import AutoSlugField
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
+from mptt.querysets import TreeQuerySet
 from slugify import slugify
 
 from .accessory import AccessoryMixin
+from .dirty_fields import DirtyFieldsMixin
 from .page_meta import PageMeta
 from .site import Site
 from .site_template import SiteTemplate
-from .status_delete_model import StatusDeleteMixin
+from .status_delete_model import AliveManagerMixin, StatusDeleteMixin, StatusDeleteQuerySet, alive_index, \
+    status_deleted_many
 from .user import User
 from .parents_mixin import ParentsMixin
+from main.services.permissions import get_permission_matrix
+from main.services.section import bump_section_tree_generation
+
+
+class SectionQuerySet(StatusDeleteQuerySet, TreeQuerySet):
+    pass
+
+
+SectionManager = TreeManager.from_queryset(SectionQuerySet)
+
+
+class SectionAliveManager(AliveManagerMixin, SectionManager):
+    pass
 
 
 @reversion.register()
-class Section(ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
+class Section(DirtyFieldsMixin, ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
     """
     Модель разделов сайта
     """
@@ -41,12 +63,18 @@ class Section(ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
     page_meta = GenericRelation(PageMeta, related_query_name='section')
     placeholders = GenericRelation('Placeholder')
 
+    objects = SectionManager()
+    alive = SectionAliveManager()
+
     class Meta:
         verbose_name = 'Раздел сайта'
         verbose_name_plural = 'Разделы сайтов'
         unique_together = (
             ('code', 'template'),
         )
+        indexes = [
+            alive_index(['tree_id', 'lft'], 'main_section_alive_tree_idx'),
+        ]
         permissions = [
             ('can_control_section', 'Управление содержимым раздела'),
         ]
@@ -82,6 +110,20 @@ class Section(ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
         return (Q(template=site.template) if site else Q() )\
              & (Q(is_global=True) | (Q(sites=site) if site else Q()))
 
+    @staticmethod
+    def annotate_site_overlay(queryset, site: Site):
+        """
+        Добавляет в queryset сортировку (ordering) и активность (site_is_active) раздела на сайте.
+        Настройки сайта присоединяются одним LEFT JOIN по индексу (section_id, site_id)
+        """
+        return queryset.annotate(
+            site_settings=FilteredRelation('settings', condition=Q(settings__site_id=site.id if site else 0)),
+        ).annotate(
+            ordering=Coalesce('site_settings__order', Value(100), output_field=models.IntegerField()),
+            site_is_active=Coalesce('site_settings__is_active', 'is_default_active',
+                                    output_field=models.BooleanField()),
+        )
+
     @staticmethod
     def get_extrafilter_ordering_by_site(site: Site):
         """ Возвращает queryset extra для выборки данных сортировки """
@@ -133,25 +175,33 @@ class Section(ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
             return False
         return self.id in user.get_sections_access_write_list(site)
 
-    def get_settings(self, site: Site, cache: bool = True):
+    def get_settings(self, site: Site, cache: bool = True, resolver=None):
         """ Возвращает объект настроек раздела для сайта """
         from main.models.section_settings import SectionSettings
+        if resolver is not None and cache:
+            return resolver.get(self)
         if not cache:
             return SectionSettings.objects.filter(section=self, site=site).nocache().first()
         else:
             return SectionSettings.objects.filter(section=self, site=site).first()
 
-    def is_active(self, site: Site) -> bool:
+    def is_active(self, site: Site, resolver=None) -> bool:
         """ Возвращает флаг доступности раздела для пользотвалей """
         if self.can_deactivate:
-            settings = self.get_settings(site)
+            settings = self.get_settings(site, resolver=resolver)
             # Если есть настройки то беру флаг оттуда, если нет то по умолчанию включено
             return settings.is_active if settings else self.is_default_active
         return True
 
+    def get_tree_site_ids(self) -> typing.Optional[typing.List[int]]:
+        """ Возвращает сайты, в деревья разделов которых входит раздел, None - все сайты """
+        if self.is_global or (self.is_tracked('is_global') and self.get_loaded_value('is_global')):
+            return None
+        return list(self.sites.values_list('id', flat=True))
+
     def clear_cache(self, site: Site = None):
-        """ Очистка кеша """
-        pass
+        """ Очистка кеша деревьев разделов сайта или всех сайтов, в которые входит раздел """
+        bump_section_tree_generation([site.id] if site else self.get_tree_site_ids())
 
     @staticmethod
     def has_perm(obj, perm, user, site) -> bool:
@@ -159,26 +209,61 @@ class Section(ParentsMixin, StatusDeleteMixin, AccessoryMixin, MPTTModel):
         if not obj:
             return False
 
+        matrix = get_permission_matrix(user, site)
         if perm == 'main.can_control_section':
-            if obj.is_global or obj.sites.filter(id=site.id).count() > 0:
-                rights = user.get_rights_for_site(site)
-                if rights:
-                    if rights.rights_type == SiteRight.RightType.FULL:
-                        return True
-                    else:
-                        if obj:
-                            return rights.sections.filter(id=obj.id).count() > 0
-                        else:
-                            return True
+            if matrix.is_site_section(obj) and matrix.has_rights:
+                if matrix.rights_type == SiteRight.RightType.FULL:
+                    return True
+                else:
+                    return obj.id in matrix.section_ids
         else:
-            if not obj.is_global:
-                if obj.sites.filter(id=site.id).count() > 0:
-                    rights = user.get_rights_for_site(site)
-                    if rights:
-                        if rights.rights_type == SiteRight.RightType.FULL:
-                            return True
+            if not obj.is_global and obj.id in matrix.site_section_ids:
+                if matrix.rights_type == SiteRight.RightType.FULL:
+                    return True
         return False
 
     def get_serialized_parents(self, include_self=True, site: Site = None):
         from main.serializers.section import SectionParentSerializer
-        return SectionParentSerializer(self.get_ancestors(include_self=include_self), many=True, context={'site': site}).data
+        from main.services.section import SectionAncestorsResolver
+        ancestors = SectionAncestorsResolver().get_ancestors(self, include_self=include_self)
+        return SectionParentSerializer(ancestors, many=True, context={'site': site}).data
+
+
+@receiver(post_save, sender=Section, weak=False)
+def section_post_save(instance: Section, **kwargs):
+    instance.clear_cache()
+
+
+@receiver(post_delete, sender=Section, weak=False)
+def section_post_delete(**kwargs):
+    # связи удаленного раздела с сайтами уже удалены, сбрасываются деревья всех сайтов
+    bump_section_tree_generation()
+
+
+@receiver(status_deleted_many, sender=Section, weak=False)
+def section_status_deleted_many(ids: list, **kwargs):
+    if Section.objects.filter(pk__in=ids, is_global=True).exists():
+        bump_section_tree_generation()
+        return
+    bump_section_tree_generation(
+        Section.sites.through.objects.filter(section_id__in=ids).values_list('site_id', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=Section.sites.through, weak=False)
+def section_sites_changed(instance, action: str, reverse: bool, pk_set, **kwargs):
+    # изменение принадлежности разделов к сайтам
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        bump_section_tree_generation([instance.pk])
+    elif pk_set is not None:
+        bump_section_tree_generation(pk_set)
+    else:
+        # при очистке связей прежние сайты неизвестны
+        bump_section_tree_generation()
+
+
+@receiver([post_save, post_delete], sender='main.SectionSettings', weak=False)
+def section_settings_post_change(instance, **kwargs):
+    bump_section_tree_generation([instance.site_id] if instance.site_id else None)
@@ -1,7 +1,87 @@
+import typing
+
+import reversion
 from django.db import models
+from django.db.transaction import atomic
+from django.dispatch import Signal, receiver
 from django.utils import timezone
 from constance import config
 
+# Пакетная пометка объектов удаленными или их восстановление.
+# sender - модель, ids - идентификаторы измененных объектов, is_deleted - новое состояние
+status_deleted_many = Signal()
+
+# поле даты изменения, которое обновляется при удалении и восстановлении объекта
+MODIFICATION_DATE_FIELD = 'date_modified'
+
+
+def has_modification_date(model: typing.Type[models.Model]) -> bool:
+    return any(field.name == MODIFICATION_DATE_FIELD for field in model._meta.concrete_fields)
+
+
+class StatusDeleteQuerySet(models.QuerySet):
+    """ Запросы моделей с пометкой удаления: удаление и восстановление набора объектов одним UPDATE """
+
+    def soft_delete(self) -> int:
+        """
+        Помечает объекты запроса удаленными
+        :return: количество удаленных объектов
+        """
+        return self._set_deleted(True, timezone.datetime.now())
+
+    def restore(self) -> int:
+        """
+        Восстанавливает удаленные объекты запроса
+        :return: количество восстановленных объектов
+        """
+        return self._set_deleted(False, None)
+
+    def _set_deleted(self, is_deleted: bool, date_deleted) -> int:
+        from cacheops import invalidate_model
+
+        with atomic():
+            # обрабатываются только объекты, состояние которых меняется
+            ids = list(
+                self.model._default_manager
+                    .filter(pk__in=self.filter(is_deleted=not is_deleted).values('pk'))
+                    .select_for_update()
+                    .values_list('pk', flat=True)
+            )
+            if not ids:
+                return 0
+            values = {'is_deleted': is_deleted, 'date_deleted': date_deleted}
+            if has_modification_date(self.model):
+                values[MODIFICATION_DATE_FIELD] = timezone.datetime.now()
+            self.model._default_manager.filter(pk__in=ids).update(**values)
+            # побочные действия выполняются пачкой для всех объектов вместо post_save каждого объекта
+            status_deleted_many.send(sender=self.model, ids=ids, is_deleted=is_deleted)
+        invalidate_model(self.model)
+        return len(ids)
+
+
+class AliveManagerMixin:
+    """
+    Менеджер только неудаленных объектов.
+    Условие совпадает с условием частичных индексов alive_index(), поэтому запросы используют эти индексы
+    """
+
+    def get_queryset(self):
+        return super(AliveManagerMixin, self).get_queryset().filter(is_deleted=False)
+
+
+class AliveManager(AliveManagerMixin, models.Manager.from_queryset(StatusDeleteQuerySet)):
+    pass
+
+
+def alive_index(fields: typing.List[str], name: str) -> models.Index:
+    """
+    Возвращает частичный индекс по неудаленным объектам (WHERE is_deleted = false).
+    Менеджер alive должен объявляться в модели после objects, чтобы objects оставался менеджером по умолчанию
+    :param fields: поля индекса
+    :param name: имя индекса (не длиннее 30 символов)
+    """
+    return models.Index(fields=fields, name=name, condition=models.Q(is_deleted=False))
+
 
 class StatusDeleteMixin(models.Model):
     """ Абстрактная модель для пометки объекта как удаленного """
@@ -18,14 +98,21 @@ class StatusDeleteMixin(models.Model):
             return super(StatusDeleteMixin, self).delete(*args, **kwargs)
         self.is_deleted = True
         self.date_deleted = timezone.datetime.now()
-        self.save()
+        self.save(update_fields=self.get_status_update_fields())
         return None
 
     def restore(self):
         """ Восстановление объекта """
         self.is_deleted = False
         self.date_deleted = None
-        self.save()
+        self.save(update_fields=self.get_status_update_fields())
+
+    def get_status_update_fields(self) -> typing.List[str]:
+        """ Поля, сохраняемые при удалении и восстановлении: дата изменения обновляется вместе с пометкой """
+        fields = ['is_deleted', 'date_deleted']
+        if has_modification_date(type(self)):
+            fields.append(MODIFICATION_DATE_FIELD)
+        return fields
 
     @staticmethod
     def get_deleted_query(user=None):
@@ -36,4 +123,15 @@ class StatusDeleteMixin(models.Model):
             date_deadline = date_deadline.replace(minute=date_deadline.minute // 10 * 10, second=0, microsecond=0)
             return models.Q(is_deleted=False) | models.Q(is_deleted=True, date_deleted__gte=date_deadline)
         else:
-            return models.Q(is_deleted=False)
\ No newline at end of file
+            return models.Q(is_deleted=False)
+
+
+@receiver(status_deleted_many, weak=False)
+def status_deleted_many_revision(sender, ids: typing.List[int], is_deleted: bool, **kwargs):
+    """ Одна ревизия на пакетное удаление или восстановление объектов """
+    if not reversion.is_registered(sender):
+        return
+    with reversion.create_revision():
+        reversion.set_comment(f'{"Удаление" if is_deleted else "Восстановление"} объектов: {len(ids)}')
+        for obj in sender._default_manager.filter(pk__in=ids).iterator():
+            reversion.add_to_revision(obj)
@@ -2,15 +2,21 @@
 Модуль модели обращений
 """
 from django.db import models
+from django.db.models import F
+from django.db.transaction import atomic
 from django.utils import timezone
 from django_extensions.db.fields import CreationDateTimeField
 import reversion
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.contrib.contenttypes.fields import GenericRelation
 
 from main.models import User, Site
-from main.models.status_delete_model import StatusDeleteMixin
+from main.models.dirty_fields import DirtyFieldsMixin
+from main.models.status_delete_model import AliveManager, StatusDeleteMixin, StatusDeleteQuerySet, alive_index, \
+    status_deleted_many
+from main.models.ticket_inbox import TicketInboxSummary
+from main.services.event_bus import publish_on_commit
 from main.models.accessory import AccessoryMixin
 from main.models.user_include import UserInclude
 from main.models.chat_thread import ChatThread
@@ -18,7 +24,7 @@ from main.models.chat_message import ChatMessage
 
 
 @reversion.register()
-class Ticket(StatusDeleteMixin, AccessoryMixin, models.Model):
+class Ticket(DirtyFieldsMixin, StatusDeleteMixin, AccessoryMixin, models.Model):
     """
     Модель тикета для пользователя
     """
@@ -73,10 +79,16 @@ class Ticket(StatusDeleteMixin, AccessoryMixin, models.Model):
 
     threads = GenericRelation(ChatThread)
 
+    objects = StatusDeleteQuerySet.as_manager()
+    alive = AliveManager()
+
     class Meta:
         verbose_name = 'Тикет'
         verbose_name_plural = 'Тикеты'
         ordering = ('date_created',)
+        indexes = [
+            alive_index(['date_created'], 'main_ticket_alive_created_idx'),
+        ]
         permissions = [
             ('comment_ticket', 'Возможность комментирования'),
         ]
@@ -106,18 +118,103 @@ class Ticket(StatusDeleteMixin, AccessoryMixin, models.Model):
                     return True
         return False
 
+    # счетчики новых сообщений изменяются атомарными update() в onChatMessageAdd и mark_read
+    COUNTER_FIELDS = ('count_new_user', 'count_new_staff')
+
+    @atomic
+    def save(self, *args, **kwargs):
+        # сводка обращений обновляется в одной транзакции с тикетом
+        if self.pk and not self._state.adding:
+            if kwargs.get('update_fields') is None:
+                # полное сохранение не перезаписывает счетчики значениями, устаревшими с момента загрузки
+                skipped = {name for name in self.COUNTER_FIELDS if not self.has_changed(name)}
+                if skipped:
+                    kwargs['update_fields'] = [
+                        field.name for field in self._meta.concrete_fields
+                        if not field.primary_key and field.name not in skipped
+                    ]
+            # вклад тикета в сводке берется из строки, заблокированной до конца транзакции
+            self._stored_count_new_staff = Ticket.objects.select_for_update()\
+                .filter(pk=self.pk)\
+                .values_list('count_new_staff', flat=True)\
+                .first()
+        try:
+            return super(Ticket, self).save(*args, **kwargs)
+        finally:
+            self._stored_count_new_staff = None
+
+    # канал событий изменения счетчиков новых сообщений для модераторов
+    STAFF_CHANNEL = 'tickets:staff'
+
+    @staticmethod
+    def get_user_channel(user_id: int) -> str:
+        """ Возвращает канал событий изменения счетчиков новых сообщений в тикетах пользователя """
+        return f'tickets:user:{user_id}'
+
+    def publish_counter(self, field: str) -> None:
+        """ Отправляет подписчикам новое значение счетчика после фиксации транзакции """
+        event = {'ticket': self.pk, 'site': self.site_id, field: getattr(self, field)}
+        if field == 'count_new_staff':
+            publish_on_commit(Ticket.STAFF_CHANNEL, event)
+        elif self.sender_id:
+            publish_on_commit(Ticket.get_user_channel(self.sender_id), event)
+
+    @staticmethod
+    def get_counter_field(for_staff: bool) -> str:
+        """ Возвращает поле счетчика новых сообщений для модераторов или пользователей """
+        return 'count_new_staff' if for_staff else 'count_new_user'
+
     def onChatMessageAdd(self, message: ChatMessage):
         """ Обработчик сигнала добавления сообщения в чате """
         if message.user_id:
-            if message.user.is_staff:
-                self.count_new_user += 1
-            else:
-                self.count_new_staff += 1
-            self.save()
+            # сообщение модератора новое для пользователя и наоборот
+            field = self.get_counter_field(not message.user.is_staff)
+            with atomic():
+                # атомарное увеличение одной колонки без сохранения всего объекта и сигналов сохранения
+                Ticket.objects.filter(pk=self.pk).update(**{field: F(field) + 1})
+                self.invalidate_cache()
+                # строка тикета заблокирована до конца транзакции, значения полей сводки актуальны
+                self.refresh_from_db(fields=[field, 'site', 'status', 'ticket_type', 'is_deleted'])
+                self.invalidate_cache()
+                if field == 'count_new_staff' and not self.is_deleted:
+                    TicketInboxSummary.add(self.site_id, self.status, self.ticket_type, count_new_staff=1)
+                self.publish_counter(field)
+
+    @atomic
+    def mark_read(self, for_staff: bool) -> None:
+        """
+        Сбрасывает счетчик новых сообщений
+        :param for_staff: для модераторов или для пользователя
+        """
+        field = self.get_counter_field(for_staff)
+        values = Ticket.objects.select_for_update()\
+            .filter(pk=self.pk)\
+            .values(field, 'site_id', 'status', 'ticket_type', 'is_deleted')\
+            .first()
+        if values is None:
+            return
+        Ticket.objects.filter(pk=self.pk).update(**{field: 0})
+        self.invalidate_cache()
+        if for_staff and values[field] and not values['is_deleted']:
+            TicketInboxSummary.add(
+                values['site_id'], values['status'], values['ticket_type'], count_new_staff=-values[field]
+            )
+        self.refresh_from_db(fields=[field])
+        self.invalidate_cache()
+        if values[field]:
+            self.publish_counter(field)
+
+    def invalidate_cache(self) -> None:
+        """ Сбрасывает кеш запросов по текущему состоянию тикета: update() счетчиков не вызывает инвалидацию cacheops """
+        from cacheops import invalidate_obj
+        invalidate_obj(self)
 
 
 @receiver(post_save, sender=Ticket, weak=False)
 def ticket_post_save(instance: Ticket, created: bool = False, **kwargs):
+    # обновление сводки обращений в транзакции сохранения
+    update_ticket_inbox(instance, created)
+
     # создаю нить чата для нового тикета
     if created:
         if not instance.threads.all().exists():
@@ -126,3 +223,36 @@ def ticket_post_save(instance: Ticket, created: bool = False, **kwargs):
             )
             thread.users.add(instance.sender)
 
+
+def update_ticket_inbox(instance: Ticket, created: bool = False) -> None:
+    """ Переносит вклад тикета в сводке обращений из прежней ячейки в новую """
+    new_bucket = TicketInboxSummary.get_bucket(instance)
+    if created:
+        TicketInboxSummary.move(None, new_bucket)
+    elif all(instance.is_tracked(name) for name in ('site', 'status', 'ticket_type', 'count_new_staff', 'is_deleted')):
+        old_bucket = TicketInboxSummary.get_bucket(instance, loaded=True)
+        stored = getattr(instance, '_stored_count_new_staff', None)
+        if stored is not None:
+            # счетчик в памяти мог устареть: прежний вклад - значение из БД до сохранения
+            if not instance.was_changed('count_new_staff'):
+                instance.count_new_staff = stored
+                instance._update_loaded_state(['count_new_staff'])
+                new_bucket = TicketInboxSummary.get_bucket(instance)
+            if old_bucket:
+                old_bucket = old_bucket[:3] + (stored, )
+        TicketInboxSummary.move(old_bucket, new_bucket)
+    else:
+        # прежние значения неизвестны (объект не загружался из БД), пересчитывается текущая ячейка
+        TicketInboxSummary.recount(instance.site_id, instance.status, instance.ticket_type)
+
+
+@receiver(post_delete, sender=Ticket, weak=False)
+def ticket_post_delete(instance: Ticket, **kwargs):
+    TicketInboxSummary.move(TicketInboxSummary.get_bucket(instance), None)
+
+
+@receiver(status_deleted_many, sender=Ticket, weak=False)
+def ticket_status_deleted_many(ids: list, **kwargs):
+    buckets = set(Ticket.objects.filter(pk__in=ids).values_list('site_id', 'status', 'ticket_type').distinct())
+    for bucket in buckets:
+        TicketInboxSummary.recount(*bucket)
@@ -0,0 +1,143 @@
+"""
+Модуль модели сводки входящих обращений
+"""
+import typing
+from django.db import IntegrityError, models
+from django.db.models import Count, F, Sum
+from django.db.transaction import atomic
+
+from main.models import Site
+
+
+class TicketInboxSummary(models.Model):
+    """
+    Количество неудаленных тикетов сайта по статусам и типам и количество новых сообщений для модераторов.
+    Поддерживается в транзакциях изменения тикетов, используется для сводки панели модераторов
+    """
+    site = models.ForeignKey(Site, verbose_name='Сайт', default=None, blank=True, null=True, on_delete=models.CASCADE)
+    status = models.CharField('Статус', max_length=1)
+    ticket_type = models.CharField('Тип заявки', max_length=1)
+    count = models.IntegerField('Количество тикетов', default=0, blank=True)
+    count_new_staff = models.IntegerField('Количество новых сообщений для модераторов', default=0, blank=True)
+
+    class Meta:
+        verbose_name = 'Сводка обращений'
+        verbose_name_plural = 'Сводка обращений'
+        unique_together = (
+            ('site', 'status', 'ticket_type'),
+        )
+
+    def __str__(self) -> str:
+        return f'{self.site_id} {self.status} {self.ticket_type}: {self.count}'
+
+    @staticmethod
+    def get_bucket(ticket, loaded: bool = False) -> typing.Optional[tuple]:
+        """
+        Возвращает вклад тикета в сводку: (сайт, статус, тип, новых сообщений) или None для удаленного тикета
+        :param ticket: тикет
+        :param loaded: по значениям полей на момент загрузки тикета из БД
+        """
+        fields = ('site', 'status', 'ticket_type', 'count_new_staff', 'is_deleted')
+        if loaded:
+            site_id, status, ticket_type, count_new_staff, is_deleted = [
+                ticket.get_loaded_value(name) for name in fields
+            ]
+        else:
+            site_id, status, ticket_type, count_new_staff, is_deleted = \
+                ticket.site_id, ticket.status, ticket.ticket_type, ticket.count_new_staff, ticket.is_deleted
+        if is_deleted:
+            return None
+        return site_id, status, ticket_type, count_new_staff
+
+    @classmethod
+    @atomic
+    def add(cls, site_id: typing.Optional[int], status: str, ticket_type: str,
+            count: int = 0, count_new_staff: int = 0) -> None:
+        """ Атомарно изменяет счетчики ячейки сводки """
+        if not count and not count_new_staff:
+            return
+        items = cls.objects.filter(site_id=site_id, status=status, ticket_type=ticket_type)
+        if items.update(count=F('count') + count, count_new_staff=F('count_new_staff') + count_new_staff):
+            return
+        try:
+            with atomic():
+                cls.objects.create(
+                    site_id=site_id, status=status, ticket_type=ticket_type,
+                    count=count, count_new_staff=count_new_staff
+                )
+        except IntegrityError:
+            # ячейку одновременно создала другая транзакция
+            items.update(count=F('count') + count, count_new_staff=F('count_new_staff') + count_new_staff)
+
+    @classmethod
+    def move(cls, old_bucket: typing.Optional[tuple], new_bucket: typing.Optional[tuple]) -> None:
+        """ Переносит вклад тикета из прежней ячейки сводки в новую """
+        if old_bucket == new_bucket:
+            return
+        if old_bucket:
+            cls.add(*old_bucket[:3], count=-1, count_new_staff=-old_bucket[3])
+        if new_bucket:
+            cls.add(*new_bucket[:3], count=1, count_new_staff=new_bucket[3])
+
+    @classmethod
+    @atomic
+    def recount(cls, site_id: typing.Optional[int], status: str, ticket_type: str) -> None:
+        """ Пересчитывает ячейку сводки по таблице тикетов """
+        from main.models.ticket import Ticket
+
+        values = Ticket.objects\
+            .filter(site_id=site_id, status=status, ticket_type=ticket_type, is_deleted=False)\
+            .aggregate(count=Count('id'), count_new_staff=Sum('count_new_staff'))
+        items = cls.objects.select_for_update().filter(site_id=site_id, status=status, ticket_type=ticket_type)
+        if values['count']:
+            values['count_new_staff'] = values['count_new_staff'] or 0
+            if items.update(**values):
+                return
+            try:
+                with atomic():
+                    cls.objects.create(site_id=site_id, status=status, ticket_type=ticket_type, **values)
+            except IntegrityError:
+                # ячейку одновременно создала другая транзакция
+                items.update(**values)
+        else:
+            items.delete()
+
+    @classmethod
+    @atomic
+    def rebuild(cls) -> int:
+        """
+        Полностью перестраивает сводку по таблице тикетов
+        :return: количество ячеек сводки
+        """
+        from main.models.ticket import Ticket
+
+        rows = Ticket.objects.filter(is_deleted=False)\
+            .order_by()\
+            .values('site_id', 'status', 'ticket_type')\
+            .annotate(count=Count('id'), count_new_staff=Sum('count_new_staff'))
+        items = [cls(**row) for row in rows]
+        cls.objects.all().delete()
+        cls.objects.bulk_create(items)
+        return len(items)
+
+    @classmethod
+    def get_summary(cls, site_id: int = None) -> dict:
+        """
+        Возвращает сводку обращений
+        :param site_id: сайт, None - по всем сайтам
+        :return: количество тикетов по статусам и типам, новых сообщений по сайтам
+        """
+        items = cls.objects.all()
+        if site_id is not None:
+            items = items.filter(site_id=site_id)
+        result = {'count': 0, 'count_new_staff': 0, 'statuses': dict(), 'types': dict(), 'sites': dict()}
+        for item in items:
+            result['count'] += item.count
+            result['count_new_staff'] += item.count_new_staff
+            result['statuses'][item.status] = result['statuses'].get(item.status, 0) + item.count
+            result['types'][item.ticket_type] = result['types'].get(item.ticket_type, 0) + item.count
+            site = result['sites'].setdefault(item.site_id, {'count': 0, 'count_new_staff': 0})
+            site['count'] += item.count
+            site['count_new_staff'] += item.count_new_staff
+        result['sites'] = [{'site': key, **value} for key, value in result['sites'].items()]
+        return result
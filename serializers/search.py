@@ -1,11 +1,12 @@
 from rest_framework import serializers
-from django.contrib.contenttypes.models import ContentType
+
+from main.services.search import hydrate_search_hits
 
 
 class SearchSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     title = serializers.CharField()
-    text = serializers.CharField()
+    text = serializers.SerializerMethodField()
     url = serializers.CharField()
     score = serializers.SerializerMethodField()
     highlight = serializers.SerializerMethodField()
@@ -38,14 +39,29 @@ class SearchSerializer(serializers.Serializer):
             pass
         return result
 
+    def get_search_node(self, obj):
+        key = (obj.model_class, int(obj.id))
+        nodes = self.context.get('search_nodes')
+        if nodes is None:
+            # без предзагрузки объект загружается один раз для текста и данных объекта
+            nodes = self.context.setdefault('hydrated_nodes', dict())
+            if key not in nodes:
+                nodes[key] = hydrate_search_hits([obj]).get(key)
+        return nodes.get(key)
+
+    def get_text(self, obj):
+        # текст не хранится в результатах поиска, берется из объекта
+        node = self.get_search_node(obj)
+        if node is None:
+            return None
+        return getattr(node, 'search_text', None)
+
     def get_node(self, obj):
-        try:
-            node_type = ContentType.objects.get(app_label='main', model=obj.model_class)
-            node = node_type.get_object_for_this_type(id=obj.id)
-            serializer = node.get_search_serializer()
-            if serializer:
-                return serializer(node).data
-            else:
-                return None
-        except:
-            return None
\ No newline at end of file
+        node = self.get_search_node(obj)
+        if node is None:
+            return None
+        serializer = node.get_search_serializer()
+        if serializer:
+            return serializer(node).data
+        else:
+            return None
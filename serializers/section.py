@@ -3,15 +3,28 @@
 """
 import typing
 from rest_framework import serializers
+from django.db import models
 from django.db.models import Q
 from django.core.exceptions import ObjectDoesNotExist
 
 from main.models import Section
+from main.services.section import (build_children_index, get_section_ancestors_resolver,
+                                   get_section_settings_resolver)
 from .section_settings import SectionSettingsSerializer
 from .site_template import BaseSiteTemplateSerializer
 from .site import Site
 
 
+class SectionListSerializer(serializers.ListSerializer):
+    """ Сериализатор списка разделов с пакетной загрузкой связанных данных """
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.Manager) else data)
+        if hasattr(self.child, 'prefetch_sections'):
+            self.child.prefetch_sections(items)
+        return super(SectionListSerializer, self).to_representation(items)
+
+
 class BaseSectionSerializer(serializers.ModelSerializer):
     """ Базовый сериализатор разделов сайта """
     class Meta:
@@ -43,13 +56,25 @@ class SectionParentSerializer(serializers.ModelSerializer):
             'settings',
             'is_deleted',
         )
+        list_serializer_class = SectionListSerializer
 
-    def get_settings(self, obj: Section):
+    def _get_site(self):
         if self.context.get('site'):
-            settings = obj.get_settings(self.context.get('site'))
-            return SectionSettingsSerializer(settings).data if settings else None
+            return self.context.get('site')
         elif self.context.get('request') and self.context.get('request').site:
-            settings = obj.get_settings(self.context.get('request').site)
+            return self.context.get('request').site
+        return None
+
+    def prefetch_sections(self, items: typing.List[Section]) -> None:
+        """ Загружает настройки разделов списка одним запросом """
+        site = self._get_site()
+        if site:
+            get_section_settings_resolver(self.context, site).prefetch(items)
+
+    def get_settings(self, obj: Section):
+        site = self._get_site()
+        if site:
+            settings = obj.get_settings(site, resolver=get_section_settings_resolver(self.context, site))
             return SectionSettingsSerializer(settings).data if settings else None
         return None
 
@@ -88,18 +113,33 @@ class SectionSerializer(BaseSectionSerializer):
             'can_deactivate',
             'is_deleted',
         )
+        list_serializer_class = SectionListSerializer
+
+    def _get_settings_resolver(self):
+        return get_section_settings_resolver(self.context, self.context['request'].site)
+
+    def prefetch_sections(self, items: typing.List[Section]) -> None:
+        """ Загружает предков и настройки разделов списка (и дерева из контекста) пачкой """
+        if 'parents' in self.fields:
+            get_section_ancestors_resolver(self.context).prefetch(items)
+        if self.context.get('request'):
+            if 'sections' in self.context and not self.context.get('sections_prefetched'):
+                items = items + list(self.context['sections'])
+                self.context['sections_prefetched'] = True
+            self._get_settings_resolver().prefetch(items)
 
     def get_is_active(self, obj):
         if self.context.get('request'):
-            return obj.is_active(self.context.get('request').site)
+            return obj.is_active(self.context.get('request').site, resolver=self._get_settings_resolver())
         return False
 
     def get_parents(self, obj: Section) -> typing.List[dict]:
-        return SectionParentSerializer(obj.get_ancestors(ascending=False), many=True, context=self.context).data
+        ancestors = get_section_ancestors_resolver(self.context).get_ancestors(obj)
+        return SectionParentSerializer(ancestors, many=True, context=self.context).data
 
     def get_settings(self, obj: Section):
         if self.context.get('request'):
-            settings = obj.get_settings(self.context.get('request').site)
+            settings = obj.get_settings(self.context.get('request').site, resolver=self._get_settings_resolver())
             return SectionSettingsSerializer(settings).data if settings else None
         return None
 
@@ -115,7 +155,7 @@ class SectionSerializer(BaseSectionSerializer):
         """ Сериализует флаг возможности просмотра """
         if self.context.get('request'):
             site = self.context['request'].site
-            return obj.is_active(site) if site else False
+            return obj.is_active(site, resolver=self._get_settings_resolver()) if site else False
         else:
             return False
 
@@ -162,34 +202,46 @@ class SectionHierarchySerializer(SectionSerializer):
                     pass
         return site
 
-    def get_children(self, obj: Section) -> typing.List[dict]:
-        """ Возвращает потомков сериализованных потомком пункта меню """
-        result = []
-        if 'sections' in self.context:
-            # получение дочерних разделов из контекста сверху
-            children_items = list(filter(lambda i: i.parent_id == obj.id, self.context['sections']))
-            if len(children_items) > 0:
-                result = SectionHierarchySerializer(children_items, many=True, context=self.context).data
-        else:
-            # получение дочерних разделов запросом в БД
+    def _get_subtree_index(self, obj: Section) -> dict:
+        """ Возвращает индекс потомков раздела по родителю, поддерево загружается одним запросом """
+        subtrees = self.context.setdefault('subtree_index', dict())
+        if obj.id not in subtrees:
             request = self.context.get('request')
             site = self._get_current_site(request) if request else None
             query = Q(is_deleted=False) & Section.get_filter_query_by_site(site if site else None)
-            queryset = obj.get_children()\
-                .extra(
-                    **Section.get_extrafilter_ordering_by_site(site)
-                )\
+            queryset = Section.annotate_site_overlay(obj.get_descendants(), site)\
                 .filter(query)\
-                .prefetch_related('settings')\
                 .order_by('ordering', 'order')\
                 .distinct()
 
             # фильтрация отключенных разделов в адмикнке сайта
             if request and site and request.GET.get('is_active') == 'true':
-                queryset = queryset.extra(
-                    **Section.get_extrafilter_active_by_site(site)
-                )
-            result = SectionHierarchySerializer(queryset, many=True, context=self.context).data
+                queryset = queryset.filter(site_is_active=True)
+
+            descendants = list(queryset)
+            self.prefetch_sections(descendants)
+            index = build_children_index(descendants)
+            subtrees[obj.id] = index
+            for item in descendants:
+                subtrees[item.id] = index
+        return subtrees[obj.id]
+
+    def get_children(self, obj: Section) -> typing.List[dict]:
+        """ Возвращает потомков сериализованных потомком пункта меню """
+        result = []
+        if 'sections' in self.context:
+            # получение дочерних разделов из контекста сверху,
+            # индекс по родителю строится один раз на весь запрос
+            if 'sections_index' not in self.context:
+                self.context['sections_index'] = build_children_index(self.context['sections'])
+            children_items = self.context['sections_index'].get(obj.id, [])
+            if len(children_items) > 0:
+                result = SectionHierarchySerializer(children_items, many=True, context=self.context).data
+        else:
+            # получение дочерних разделов из поддерева, загруженного одним запросом в БД
+            children_items = self._get_subtree_index(obj).get(obj.id, [])
+            if len(children_items) > 0:
+                result = SectionHierarchySerializer(children_items, many=True, context=self.context).data
         return result
 
 
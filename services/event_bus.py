@@ -0,0 +1,227 @@
+"""
+Шина событий для отправки изменений клиентам (server-sent events)
+"""
+import json
+import logging
+import queue
+import threading
+import time
+import typing
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('debug')
+
+DEFAULT_EVENT_BUS_BACKEND = 'main.services.event_bus.InProcessEventBackend'
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+
+class BaseSubscription:
+    """ Подписка на каналы шины событий """
+
+    def get(self, timeout: float = None) -> typing.Optional[dict]:
+        """
+        Ожидает следующее событие
+        :param timeout: время ожидания, секунд
+        :return: событие или None, если событий не было
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BaseEventBackend:
+    """ Базовый класс шины событий """
+
+    def publish(self, channel: str, event: dict) -> None:
+        raise NotImplementedError()
+
+    def subscribe(self, channels: typing.List[str]) -> BaseSubscription:
+        raise NotImplementedError()
+
+
+class InProcessSubscription(BaseSubscription):
+    def __init__(self, backend: 'InProcessEventBackend', channels: typing.List[str]):
+        self.backend = backend
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    def put(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # медленный клиент теряет самые старые события, счетчики в следующих событиях актуальны
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(event)
+
+    def get(self, timeout: float = None) -> typing.Optional[dict]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.backend.unsubscribe(self)
+
+
+class InProcessEventBackend(BaseEventBackend):
+    """ Шина событий в памяти процесса, события получают только подписчики этого же процесса """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel: str, event: dict) -> None:
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, channels: typing.List[str]) -> InProcessSubscription:
+        subscription = InProcessSubscription(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: InProcessSubscription) -> None:
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscriptions[channel].discard(subscription)
+                if not self.subscriptions[channel]:
+                    del self.subscriptions[channel]
+
+
+class LocalPubSub:
+    """ Подписка LocalBroker с интерфейсом redis.client.PubSub """
+
+    def __init__(self, broker: 'LocalBroker', ignore_subscribe_messages: bool = False):
+        self.broker = broker
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels: str) -> None:
+        with self.broker.lock:
+            for channel in channels:
+                self.channels.add(channel)
+                self.broker.subscribers[channel].add(self)
+        if not self.ignore_subscribe_messages:
+            for channel in channels:
+                self.messages.put({'type': 'subscribe', 'channel': channel, 'data': 1})
+
+    def get_message(self, timeout: float = 0) -> typing.Optional[dict]:
+        try:
+            return self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        with self.broker.lock:
+            for channel in self.channels:
+                self.broker.subscribers[channel].discard(self)
+        self.channels = set()
+
+
+class LocalBroker:
+    """
+    Локальная замена брокера сообщений с интерфейсом публикации и подписки Redis.
+    Используется в тестах и окружениях без Redis
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel: str, data: str) -> int:
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub.messages.put({'type': 'message', 'channel': channel, 'data': data})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> LocalPubSub:
+        return LocalPubSub(self, ignore_subscribe_messages=ignore_subscribe_messages)
+
+
+_local_broker = LocalBroker()
+
+
+def get_broker_client():
+    """ Возвращает клиент брокера по EVENT_BUS_BROKER_URL: redis://... или local:// """
+    url = getattr(settings, 'EVENT_BUS_BROKER_URL', 'local://')
+    if url.startswith('local://'):
+        return _local_broker
+    import redis
+    return redis.Redis.from_url(url)
+
+
+class BrokerSubscription(BaseSubscription):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout: float = None) -> typing.Optional[dict]:
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            message = self.pubsub.get_message(timeout=max(deadline - time.monotonic(), 0))
+            if message and message.get('type') == 'message':
+                data = message['data']
+                return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+            if time.monotonic() >= deadline:
+                return None
+
+    def close(self) -> None:
+        self.pubsub.close()
+
+
+class BrokerEventBackend(BaseEventBackend):
+    """ Шина событий между процессами через брокер (Redis pub/sub или LocalBroker) """
+
+    def __init__(self, client=None):
+        self.client = client or get_broker_client()
+
+    def publish(self, channel: str, event: dict) -> None:
+        self.client.publish(channel, json.dumps(event))
+
+    def subscribe(self, channels: typing.List[str]) -> BrokerSubscription:
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        return BrokerSubscription(pubsub)
+
+
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+
+def get_event_bus() -> BaseEventBackend:
+    """ Возвращает шину событий из настройки EVENT_BUS_BACKEND """
+    global _event_bus
+    with _event_bus_lock:
+        if _event_bus is None:
+            _event_bus = import_string(getattr(settings, 'EVENT_BUS_BACKEND', DEFAULT_EVENT_BUS_BACKEND))()
+        return _event_bus
+
+
+def publish_on_commit(channel: str, event: dict) -> None:
+    """ Публикует событие после фиксации текущей транзакции, ошибки шины не влияют на запрос """
+    from django.db import transaction
+
+    def publish():
+        try:
+            get_event_bus().publish(channel, event)
+        except Exception:
+            logger.exception(f'Error publish event to {channel}')
+
+    transaction.on_commit(publish)
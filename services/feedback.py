@@ -1,5 +1,187 @@
+import logging
+import threading
+import time
+import traceback
+import typing
+from collections import Counter
+
 from django_mail_admin import mail, models
 from django.conf import settings
+from django.core.mail import get_connection
+from django.db.models import Count, Q
+from django.db.transaction import atomic
+from django.utils import timezone
+
+logger = logging.getLogger('debug')
+
+TEMPLATE_CACHE_TIMEOUT = 5 * 60
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_BASE_DELAY = 60
+# время, на которое письмо закрепляется за обработчиком; письма упавшего обработчика отправятся повторно
+MAIL_CLAIM_TIMEOUT = 10 * 60
+
+
+class TemplateCache:
+    """ Кеш шаблонов писем в памяти процесса: шаблоны не читаются из БД при каждом письме """
+
+    def __init__(self, timeout: int = TEMPLATE_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self.templates = dict()
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> models.EmailTemplate:
+        """ Возвращает шаблон письма по имени """
+        with self.lock:
+            item = self.templates.get(name)
+        if item is None or item[0] < time.monotonic():
+            item = (time.monotonic() + self.timeout, models.EmailTemplate.objects.get(name=name))
+            with self.lock:
+                self.templates[name] = item
+        return item[1]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.templates.clear()
+
+
+template_cache = TemplateCache(timeout=getattr(settings, 'MAIL_TEMPLATE_CACHE_TIMEOUT', TEMPLATE_CACHE_TIMEOUT))
+
+
+def get_retry_delay(attempts: int, retry_delay: float = MAIL_RETRY_BASE_DELAY) -> timezone.timedelta:
+    """ Задержка повторной отправки растет экспоненциально с количеством неудачных попыток """
+    return timezone.timedelta(seconds=retry_delay * 2 ** (attempts - 1))
+
+
+def claim_queued_emails(batch_size: int) -> typing.List[int]:
+    """
+    Закрепляет за обработчиком пачку писем из очереди: дата отправки писем сдвигается на MAIL_CLAIM_TIMEOUT,
+    другие обработчики эти письма не получат. Транзакция короткая, письма отправляются после ее фиксации
+    :return: идентификаторы писем
+    """
+    now = timezone.now()
+    with atomic():
+        ids = list(
+            models.OutgoingEmail.objects
+                .select_for_update(skip_locked=True)
+                .filter(status=models.STATUS.queued)
+                .filter(Q(scheduled_time__lte=now) | Q(scheduled_time=None))
+                .order_by('-priority', 'id')
+                .values_list('id', flat=True)[:batch_size]
+        )
+        models.OutgoingEmail.objects.filter(id__in=ids)\
+            .update(scheduled_time=now + timezone.timedelta(seconds=MAIL_CLAIM_TIMEOUT))
+    return ids
+
+
+def process_mail_queue(batch_size: int = MAIL_BATCH_SIZE, max_attempts: int = MAIL_MAX_ATTEMPTS,
+                       retry_delay: float = MAIL_RETRY_BASE_DELAY) -> dict:
+    """
+    Отправляет пачку писем из очереди django_mail_admin через одно соединение на почтовый бэкенд.
+    Неудачные письма остаются в очереди и повторяются с увеличивающейся задержкой,
+    после max_attempts попыток письмо помечается неотправленным. Попытки записываются в журнал письма
+    :param batch_size: максимальное количество писем
+    :param max_attempts: максимальное количество попыток отправки письма
+    :param retry_delay: задержка первого повтора, секунд
+    :return: статистика обработки
+    """
+    from django_mail_admin.connections import connections
+    from django_mail_admin.settings import get_backend
+
+    ids = claim_queued_emails(batch_size)
+    stats = {'rows': len(ids), 'sent': 0, 'retried': 0, 'failed': 0}
+    if not ids:
+        return stats
+
+    emails = list(
+        models.OutgoingEmail.objects
+            .filter(id__in=ids)
+            .select_related('template')
+            .prefetch_related('attachments')
+    )
+    sent = []
+    failed = []
+    # соединение каждого почтового бэкенда открывается один раз на пачку:
+    # send_messages() неоткрытого соединения открывает и закрывает его на каждое письмо
+    batch_connections = dict()
+    try:
+        for email in emails:
+            try:
+                alias = email.backend_alias or 'default'
+                if alias not in batch_connections:
+                    batch_connections[alias] = get_connection(get_backend(alias))
+                    batch_connections[alias].open()
+                message = email.prepare_email_message()
+                message.connection = batch_connections[alias]
+                message.send()
+                sent.append(email)
+            except Exception as e:
+                logger.error(f'Error send email {email.id}: {e!r}')
+                failed.append((email, e, traceback.format_exc()))
+    finally:
+        for connection in batch_connections.values():
+            connection.close()
+        # соединения, открытые django_mail_admin при подготовке писем
+        connections.close()
+
+    now = timezone.now()
+    with atomic():
+        models.OutgoingEmail.objects.filter(id__in=[email.id for email in sent]).update(status=models.STATUS.sent)
+        attempts = Counter(
+            models.Log.objects
+                .filter(email_id__in=[email.id for email, _, _ in failed], status=models.STATUS.failed)
+                .values_list('email_id', flat=True)
+        )
+        for email, error, _ in failed:
+            email_attempts = attempts[email.id] + 1
+            if email_attempts >= max_attempts:
+                logger.error(f'Email {email.id} to {email.to} dropped after {email_attempts} attempts: {error!r}')
+                models.OutgoingEmail.objects.filter(id=email.id).update(status=models.STATUS.failed)
+                stats['failed'] += 1
+            else:
+                models.OutgoingEmail.objects.filter(id=email.id)\
+                    .update(scheduled_time=now + get_retry_delay(email_attempts, retry_delay))
+                stats['retried'] += 1
+        models.Log.objects.bulk_create([
+            models.Log(email=email, status=models.STATUS.failed, message=message,
+                       exception_type=type(error).__name__)
+            for email, error, message in failed
+        ] + [
+            models.Log(email=email, status=models.STATUS.sent, message='')
+            for email in sent
+        ])
+    stats['sent'] = len(sent)
+    return stats
+
+
+def get_mail_queue_stats(hours: int = 24) -> dict:
+    """
+    Возвращает состояние очереди писем по таблицам django_mail_admin, общее для всех обработчиков
+    :param hours: период для количества отправленных и неудачных попыток, часов
+    :return: queued - ожидают отправки, delayed - ожидают повтора или закреплены за обработчиком,
+             sent и failed - отправлено и отброшено писем за период, failed_attempts - неудачных попыток за период,
+             last_error - последняя ошибка отправки
+    """
+    now = timezone.now()
+    date_from = now - timezone.timedelta(hours=hours)
+    queued = models.OutgoingEmail.objects.filter(status=models.STATUS.queued)
+    statuses = dict(
+        models.OutgoingEmail.objects
+            .filter(last_updated__gte=date_from, status__in=[models.STATUS.sent, models.STATUS.failed])
+            .order_by()
+            .values_list('status')
+            .annotate(count=Count('id'))
+    )
+    failed_logs = models.Log.objects.filter(status=models.STATUS.failed)
+    last_error = failed_logs.order_by('-id').values('date', 'exception_type', 'message').first()
+    return {
+        'queued': queued.count(),
+        'delayed': queued.filter(scheduled_time__gt=now).count(),
+        'sent': statuses.get(models.STATUS.sent, 0),
+        'failed': statuses.get(models.STATUS.failed, 0),
+        'failed_attempts': failed_logs.filter(date__gte=date_from).count(),
+        'last_error': last_error,
+    }
 
 
 def send_form_data_on_email(template_name: str, form_data: dict) -> None:
@@ -9,13 +191,15 @@ def send_form_data_on_email(template_name: str, form_data: dict) -> None:
     :param form_data: Данные формы
     :return:
     """
-    mail_template = models.EmailTemplate.objects.get(name=template_name)
+    # по умолчанию письмо сохраняется в очередь и отправляется командой process_mail_queue,
+    # отправка не задерживает запрос и не теряется при перезапуске процесса
+    queued = getattr(settings, 'FEEDBACK_MAIL_QUEUE', True)
     mail.send(
         sender=settings.DEFAULT_FROM_EMAIL,
         recipients=settings.NOTICE_FEEDBACK_EMAIL,
-        template=mail_template,
+        template=template_cache.get(template_name),
         variable_dict=form_data,
-        priority=models.PRIORITY.now,
+        priority=models.PRIORITY.medium if queued else models.PRIORITY.now,
     )
 
 
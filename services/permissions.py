@@ -0,0 +1,113 @@
+"""
+Матрица прав пользователя на сайте
+"""
+import time
+import typing
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+PERMISSION_MATRIX_CACHE_TIMEOUT = 60
+PERMISSION_MATRIX_GENERATION_KEY = 'permission_matrix_generation'
+
+
+class SitePermissionMatrix:
+    """
+    Права пользователя на сайте, загруженные один раз.
+    Проверки прав на объекты сводятся к поиску в множествах
+    """
+
+    def __init__(self, rights_type: str = None, section_ids: typing.Iterable[int] = (),
+                 section_codes: typing.Iterable[str] = (), site_section_ids: typing.Iterable[int] = ()):
+        self.rights_type = rights_type
+        self.section_ids = frozenset(section_ids)
+        self.section_codes = frozenset(section_codes)
+        self.site_section_ids = frozenset(site_section_ids)
+
+    @classmethod
+    def load(cls, user, site) -> 'SitePermissionMatrix':
+        """ Загружает права пользователя, разрешенные разделы и разделы сайта """
+        from main.models import Section
+
+        if not site or not user or not user.is_authenticated:
+            return cls()
+
+        site_section_ids = Section.sites.through.objects.filter(site_id=site.id)\
+            .values_list('section_id', flat=True)
+        rights = user.get_rights_for_site(site)
+        if not rights:
+            return cls(site_section_ids=site_section_ids)
+
+        sections = list(rights.sections.values_list('id', 'code'))
+        return cls(
+            rights_type=rights.rights_type,
+            section_ids=[item[0] for item in sections],
+            section_codes=[item[1] for item in sections],
+            site_section_ids=site_section_ids,
+        )
+
+    @property
+    def has_rights(self) -> bool:
+        """ Возвращает флаг наличия прав пользователя на сайте """
+        return self.rights_type is not None
+
+    def is_site_section(self, section) -> bool:
+        """ Возвращает флаг принадлежности раздела к сайту """
+        return section.is_global or section.id in self.site_section_ids
+
+
+def get_permission_matrix_generation(site_id: int) -> str:
+    """ Возвращает поколение закешированных матриц прав сайта """
+    from main.services.section import get_section_tree_generation
+
+    generation = cache.get(PERMISSION_MATRIX_GENERATION_KEY)
+    if generation is None:
+        cache.add(PERMISSION_MATRIX_GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(PERMISSION_MATRIX_GENERATION_KEY)
+    # принадлежность разделов к сайту меняет поколение дерева разделов сайта
+    return '.'.join(str(value) for value in (generation, ) + get_section_tree_generation(site_id))
+
+
+def bump_permission_matrix_generation() -> None:
+    """ Делает недействительными все закешированные матрицы прав """
+    try:
+        cache.incr(PERMISSION_MATRIX_GENERATION_KEY)
+    except ValueError:
+        cache.add(PERMISSION_MATRIX_GENERATION_KEY, int(time.time() * 1000), None)
+
+
+def get_permission_matrix(user, site) -> SitePermissionMatrix:
+    """
+    Возвращает матрицу прав пользователя на сайте.
+    Матрица хранится в объекте пользователя на время запроса и в кеше на короткое время
+    """
+    if not site or not user or not user.is_authenticated:
+        return SitePermissionMatrix()
+
+    matrices = getattr(user, '_permission_matrices', None)
+    if matrices is None:
+        matrices = dict()
+        user._permission_matrices = matrices
+
+    if site.id not in matrices:
+        cache_key = f'permission_matrix:{get_permission_matrix_generation(site.id)}:{user.id}:{site.id}'
+        matrix = cache.get(cache_key)
+        if matrix is None:
+            matrix = SitePermissionMatrix.load(user, site)
+            cache.set(cache_key, matrix, PERMISSION_MATRIX_CACHE_TIMEOUT)
+        matrices[site.id] = matrix
+    return matrices[site.id]
+
+
+@receiver([post_save, post_delete], sender='main.SiteRight', weak=False)
+def site_right_post_change(**kwargs):
+    bump_permission_matrix_generation()
+
+
+# автоматически созданная модель связи прав с разделами
+@receiver(m2m_changed, sender='main.SiteRight_sections', weak=False)
+def site_right_sections_changed(action: str, **kwargs):
+    # выдача и отзыв прав на разделы
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_permission_matrix_generation()
@@ -0,0 +1,143 @@
+"""
+Окончательное удаление давно удаленных объектов
+"""
+import logging
+import time
+import typing
+
+from django.apps import apps
+from django.db import connection, models
+from django.db.transaction import atomic
+from django.utils import timezone
+
+logger = logging.getLogger('debug')
+
+DEFAULT_RETENTION_DAYS = 90
+
+
+def get_status_delete_models() -> typing.List[typing.Type[models.Model]]:
+    """ Возвращает модели с пометкой удаления """
+    from main.models.status_delete_model import StatusDeleteMixin
+    return [model for model in apps.get_app_config('main').get_models() if issubclass(model, StatusDeleteMixin)]
+
+
+def get_rows_size(model: typing.Type[models.Model], ids: typing.List[int]) -> typing.Optional[int]:
+    """ Возвращает размер данных строк в байтах (только PostgreSQL) """
+    if connection.vendor != 'postgresql' or not ids:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT COALESCE(SUM(pg_column_size(t.*)), 0) FROM {connection.ops.quote_name(model._meta.db_table)} t '
+            f'WHERE t.{connection.ops.quote_name(model._meta.pk.column)} = ANY(%s)',
+            [list(ids)]
+        )
+        return cursor.fetchone()[0]
+
+
+def get_live_dependent_ids(model: typing.Type[models.Model], ids: typing.List[int]) -> typing.Set[int]:
+    """
+    Возвращает объекты, у которых есть неудаленные зависимые объекты с пометкой удаления.
+    Каскадное удаление таких объектов удалило бы действующие данные
+    """
+    from main.models.status_delete_model import StatusDeleteMixin
+
+    result = set()
+    for relation in model._meta.related_objects:
+        if not relation.one_to_many and not relation.one_to_one:
+            continue
+        if relation.on_delete is not models.CASCADE or not issubclass(relation.related_model, StatusDeleteMixin):
+            continue
+        result.update(
+            relation.related_model._default_manager
+                .filter(**{f'{relation.field.name}__in': ids, 'is_deleted': False})
+                .values_list(relation.field.attname, flat=True)
+        )
+    return result
+
+
+def get_purge_ids(model: typing.Type[models.Model], ids: typing.List[int]) -> typing.List[int]:
+    """
+    Возвращает объекты пачки, которые можно окончательно удалить:
+    пропускаются объекты с неудаленными зависимыми объектами и узлы дерева с неудаленными потомками
+    """
+    from mptt.models import MPTTModel
+
+    live_ids = get_live_dependent_ids(model, ids)
+    if live_ids:
+        logger.info(f'{model._meta.label}: skip purge of {len(live_ids)} objects with live dependents')
+    queryset = model._default_manager.filter(pk__in=[pk for pk in ids if pk not in live_ids], is_deleted=True)
+    if not issubclass(model, MPTTModel):
+        return list(queryset.order_by('pk').values_list('pk', flat=True))
+    result = []
+    # узлы удаляются от нижних уровней к верхним
+    for obj in queryset.order_by('-level'):
+        if obj.get_descendants().filter(is_deleted=False).exists():
+            # неудаленные потомки удаленного узла не удаляются вместе с ним
+            logger.info(f'{model._meta.label}: skip purge of {obj.pk} with live descendants')
+            continue
+        result.append(obj.pk)
+    return result
+
+
+def purge_batch(model: typing.Type[models.Model], ids: typing.List[int]) -> typing.Tuple[int, typing.Optional[int]]:
+    """
+    Окончательно удаляет пачку объектов с учетом каскадного удаления связанных объектов.
+    Объекты с неудаленными зависимыми объектами и потомками пропускаются
+    :return: количество удаленных объектов модели и размер данных их строк в байтах
+    """
+    from mptt.models import MPTTModel
+    from main.models.search_index_queue import SearchIndexQueue
+    from main.models.search_model import SearchMixin
+
+    with atomic():
+        ids = get_purge_ids(model, ids)
+        size = get_rows_size(model, ids)
+        if issubclass(model, SearchMixin):
+            # документы удаленных объектов обычно уже убраны из индекса, удаление из индекса идемпотентно
+            SearchIndexQueue.enqueue_many(model, ids, SearchIndexQueue.Action.DELETE)
+        if issubclass(model, MPTTModel):
+            # узлы удаляются по одному с перечитыванием, чтобы нумерация дерева оставалась корректной
+            count = 0
+            for pk in ids:
+                obj = model._default_manager.filter(pk=pk).first()
+                if obj is None:
+                    continue
+                obj.delete(force_delete=True)
+                count += 1
+            return count, size
+        _, counts = model._default_manager.filter(pk__in=ids).delete()
+        return counts.get(model._meta.label, 0), size
+
+
+def purge_deleted(model: typing.Type[models.Model], retention_days: int = DEFAULT_RETENTION_DAYS,
+                  batch_size: int = 500, sleep: float = 0, dry_run: bool = False) -> typing.Iterator[dict]:
+    """
+    Окончательно удаляет объекты, помеченные удаленными раньше срока хранения.
+    Объекты обрабатываются пачками по возрастанию первичного ключа с паузой между пачками
+    :param model: модель с пометкой удаления
+    :param retention_days: срок хранения удаленных объектов, дней
+    :param batch_size: размер пачки
+    :param sleep: пауза между пачками, секунд
+    :param dry_run: только подсчитать объекты
+    :return: статистика по каждой пачке: rows - удалено объектов, bytes - размер данных строк
+    """
+    date_deadline = timezone.datetime.now() - timezone.timedelta(days=retention_days)
+    queryset = model._default_manager.filter(is_deleted=True, date_deleted__lt=date_deadline).order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        last_pk = ids[-1]
+        if dry_run:
+            # подсчитываются только объекты, которые действительно были бы удалены
+            purge_ids = get_purge_ids(model, ids)
+            rows, size = len(purge_ids), get_rows_size(model, purge_ids)
+        else:
+            rows, size = purge_batch(model, ids)
+        yield {'rows': rows, 'bytes': size, 'last_pk': last_pk}
+        if len(ids) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
@@ -0,0 +1,481 @@
+"""
+Сервисные функции поиска по сайту
+"""
+import logging
+import re
+import threading
+import time
+import typing
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from main.services.search_local import SUGGEST_FIELDS, LocalSearchIndex, get_local_index
+
+logger = logging.getLogger('debug')
+
+DEFAULT_SEARCH_BACKEND = 'main.services.search.ElasticsearchSearchBackend'
+SEARCH_INDEX_NAME = 'search'
+SEARCH_GENERATION_KEY = 'search_generation'
+SEARCH_RESULT_CACHE_TIMEOUT = 5 * 60
+SEARCH_RESULT_CACHE_MAX_ENTRIES = 1000
+SUGGEST_SIZE = 10
+FACETS_SIZE = 50
+SUGGEST_MAX_SIZE = 20
+# текст документа не запрашивается и не кешируется, он берется из загруженного объекта
+HIT_FIELDS = ('id', 'title', 'url', 'model_class')
+
+
+class LocalHit:
+    """ Результат поиска в локальном индексе с интерфейсом результата Elasticsearch """
+
+    def __init__(self, source: dict, score: float, highlight: dict):
+        self._source = source
+        self.meta = {'score': score, 'highlight': highlight}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._source[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class LocalSearchQuery:
+    """ Ленивый запрос к локальному индексу, поддерживает срезы и count() для пагинатора """
+
+    def __init__(self, index: LocalSearchIndex, text: str, site_id: int = None, model_class: str = None,
+                 facets: bool = False):
+        self.index = index
+        self.text = text
+        self.site_id = site_id
+        self.model_class = model_class
+        self.facets_enabled = facets
+        self._results = None
+        self._facets = None
+
+    def get_results(self) -> typing.List[typing.Tuple[str, float]]:
+        if self._results is None:
+            if self.facets_enabled:
+                # количество по типам считается по всем результатам, фильтр по типу применяется после
+                results = self.index.search(self.text, site_id=self.site_id)
+                model_classes = [self.index.get_document(key).get('model_class') for key, _ in results]
+                self._facets = dict(Counter(model_classes))
+                self._results = [
+                    item for item, model_class in zip(results, model_classes)
+                    if not self.model_class or model_class == self.model_class
+                ]
+            else:
+                self._results = self.index.search(self.text, site_id=self.site_id, model_class=self.model_class)
+        return self._results
+
+    def count(self) -> int:
+        return len(self.get_results())
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def facets(self) -> typing.Dict[str, int]:
+        """ Количество результатов по типам объектов без учета фильтра по типу """
+        self.get_results()
+        return self._facets or dict()
+
+    def get_hit(self, key: str, score: float) -> LocalHit:
+        return LocalHit(self.index.get_document(key), score, self.index.get_highlight(key, self.text))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.get_hit(key, score) for key, score in self.get_results()[item]]
+        key, score = self.get_results()[item]
+        return self.get_hit(key, score)
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class ElasticsearchSearchQuery:
+    """
+    Ленивый запрос к Elasticsearch для пагинатора.
+    Количество результатов берется из ответа на запрос страницы, поэтому количество, страница
+    и агрегации по типам объектов запрашиваются одним запросом
+    """
+
+    def __init__(self, search, facets: bool = False, window: typing.Tuple[int, int] = None):
+        self.search = search
+        self.facets_enabled = facets
+        self.window = window
+        self.responses = dict()
+        self.total = None
+
+    def execute(self, start: int, stop: int):
+        if (start, stop) not in self.responses:
+            self.responses[(start, stop)] = self.search[start:stop].execute()
+        return self.responses[(start, stop)]
+
+    def count(self) -> int:
+        if self.total is None:
+            start, stop = self.window or (0, 0)
+            total = self.execute(start, stop).hits.total
+            if getattr(total, 'relation', 'eq') == 'gte':
+                # Elasticsearch 7 считает попадания только до 10000: страница запрашивается с точным подсчетом.
+                # _count не подходит: он не учитывает post_filter фильтра по типу объектов
+                response = self.search.extra(track_total_hits=True)[start:stop].execute()
+                self.responses[(start, stop)] = response
+                total = response.hits.total
+            # в Elasticsearch 7 количество возвращается объектом с полем value
+            self.total = getattr(total, 'value', total)
+        return self.total
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def facets(self) -> typing.Dict[str, int]:
+        """ Количество результатов по типам объектов без учета фильтра по типу """
+        if not self.facets_enabled:
+            return dict()
+        response = next(iter(self.responses.values()), None) or self.execute(0, 0)
+        return {bucket.key: bucket.doc_count for bucket in response.aggregations.model_class.buckets}
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        if item.stop is not None:
+            # последняя страница пагинатора короче окна: срез берется из уже полученного ответа
+            for (window_start, window_stop), response in self.responses.items():
+                if window_stop is not None and window_start <= start and item.stop <= window_stop:
+                    return list(response)[start - window_start:item.stop - window_start]
+        return list(self.execute(start, item.stop))
+
+    def __iter__(self):
+        return iter(self[0:self.count()])
+
+
+class BaseSearchBackend:
+    """ Базовый класс поискового движка """
+
+    def is_available(self) -> bool:
+        return True
+
+    def supports_suggest(self) -> bool:
+        """ Проверяет, поддерживает ли индекс движка подсказки """
+        return True
+
+    def search(self, text: str, site_id: int, model_class: str = None, facets: bool = False,
+               window: typing.Tuple[int, int] = None):
+        """
+        Возвращает ленивый запрос поиска, поддерживающий срезы, count() и facets()
+        :param text: поисковая фраза
+        :param site_id: текущий сайт (глобальные документы находятся на всех сайтах)
+        :param model_class: фильтр по типу объекта
+        :param facets: считать количество результатов по типам объектов
+        :param window: срез запрашиваемой страницы, по которому сразу получается количество результатов
+        """
+        raise NotImplementedError()
+
+    def suggest(self, prefix: str, site_id: int, size: int = SUGGEST_SIZE) -> typing.List[dict]:
+        """
+        Возвращает подсказки по началу поисковой фразы
+        :param prefix: начало поисковой фразы
+        :param site_id: текущий сайт (глобальные документы подсказываются на всех сайтах)
+        :param size: количество подсказок
+        :return: список словарей с полями SUGGEST_FIELDS
+        """
+        raise NotImplementedError()
+
+
+class ElasticsearchSearchBackend(BaseSearchBackend):
+    """ Поиск в Elasticsearch """
+    health_check_interval = 30
+    suggest_check_interval = 5 * 60
+    _health = (None, True)
+    _suggest_support = (None, False)
+
+    def is_available(self) -> bool:
+        """ Проверяет доступность кластера, результат проверки кешируется на несколько секунд """
+        from elasticsearch_dsl.connections import connections
+
+        checked_at, available = ElasticsearchSearchBackend._health
+        if checked_at is None or time.monotonic() - checked_at > self.health_check_interval:
+            try:
+                available = bool(connections.get_connection().ping())
+            except Exception:
+                available = False
+            ElasticsearchSearchBackend._health = (time.monotonic(), available)
+        return available
+
+    def search(self, text: str, site_id: int, model_class: str = None, facets: bool = False,
+               window: typing.Tuple[int, int] = None):
+        from elasticsearch_dsl import Search
+        from elasticsearch_dsl.query import MultiMatch, Q
+
+        query = (Q('term', site=site_id) | Q('term', is_global=True))\
+            & MultiMatch(query=text, fields=['title', 'text'])
+        if model_class and not facets:
+            query &= Q('term', model_class=model_class)
+        search = Search(index=SEARCH_INDEX_NAME).query(query).source(list(HIT_FIELDS)).highlight('title', 'text')
+        if facets:
+            # фильтр по типу после агрегации, чтобы количество считалось по всем типам
+            search.aggs.bucket('model_class', 'terms', field='model_class', size=FACETS_SIZE)
+            if model_class:
+                search = search.post_filter('term', model_class=model_class)
+        return ElasticsearchSearchQuery(search, facets=facets, window=window)
+
+    def supports_suggest(self) -> bool:
+        """
+        Проверяет наличие поля автодополнения в маппинге индекса (документ с SuggestDocumentMixin).
+        Результат проверки запоминается на несколько минут, чтобы не отправлять заведомо неудачные запросы
+        """
+        from elasticsearch_dsl.connections import connections
+        from main.services.search_suggest import SUGGEST_FIELD
+
+        checked_at, supported = ElasticsearchSearchBackend._suggest_support
+        if checked_at is None or time.monotonic() - checked_at > self.suggest_check_interval:
+            try:
+                mappings = connections.get_connection().indices.get_mapping(index=SEARCH_INDEX_NAME)
+                supported = any(
+                    SUGGEST_FIELD in item.get('mappings', {}).get('properties', {}) for item in mappings.values()
+                )
+            except Exception as e:
+                logger.warning(f'Error check suggest mapping of {SEARCH_INDEX_NAME}: {e!r}')
+                supported = False
+            ElasticsearchSearchBackend._suggest_support = (time.monotonic(), supported)
+        return supported
+
+    def suggest(self, prefix: str, site_id: int, size: int = SUGGEST_SIZE) -> typing.List[dict]:
+        from elasticsearch_dsl import Search
+        from main.services.search_suggest import SUGGEST_FIELD, SUGGEST_GLOBAL_CONTEXT, SUGGEST_SITE_CONTEXT
+
+        search = Search(index=SEARCH_INDEX_NAME)\
+            .source(list(SUGGEST_FIELDS))\
+            .extra(size=0)\
+            .suggest('titles', prefix, completion={
+                'field': SUGGEST_FIELD,
+                'size': size,
+                'skip_duplicates': True,
+                'contexts': {SUGGEST_SITE_CONTEXT: [str(site_id), SUGGEST_GLOBAL_CONTEXT]},
+            })
+        response = search.execute()
+        return [
+            {field: getattr(option._source, field, None) for field in SUGGEST_FIELDS}
+            for option in response.suggest.titles[0].options
+        ]
+
+
+class LocalSearchBackend(BaseSearchBackend):
+    """ Поиск в локальном индексе процесса (BM25, русская морфология) """
+
+    def search(self, text: str, site_id: int, model_class: str = None, facets: bool = False,
+               window: typing.Tuple[int, int] = None):
+        return LocalSearchQuery(
+            get_local_index(SEARCH_INDEX_NAME), text, site_id=site_id, model_class=model_class, facets=facets
+        )
+
+    def suggest(self, prefix: str, site_id: int, size: int = SUGGEST_SIZE) -> typing.List[dict]:
+        return get_local_index(SEARCH_INDEX_NAME).suggest(prefix, site_id=site_id, size=size)
+
+
+def get_search_backend() -> BaseSearchBackend:
+    """ Возвращает поисковый движок из настроек, при недоступности - локальный индекс """
+    backend = import_string(getattr(settings, 'SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND))()
+    if not backend.is_available():
+        logger.error('Search backend is unavailable, local search index is used')
+        return LocalSearchBackend()
+    return backend
+
+
+def get_search_model(model_class: str):
+    """ Возвращает модель по имени из поискового индекса (типы объектов кешируются в процессе) """
+    try:
+        return ContentType.objects.get_by_natural_key('main', model_class).model_class()
+    except ContentType.DoesNotExist:
+        logger.error(f'Unknown search model class {model_class}')
+        return None
+
+
+def hydrate_search_hits(hits: typing.Iterable) -> dict:
+    """
+    Загружает объекты для результатов поиска, по одному запросу на модель
+    :param hits: результаты поиска
+    :return: словарь (model_class, id) -> объект
+    """
+    ids = defaultdict(set)
+    for hit in hits:
+        ids[hit.model_class].add(int(hit.id))
+
+    nodes = dict()
+    for model_class, model_ids in ids.items():
+        model = get_search_model(model_class)
+        if model is None:
+            continue
+        queryset = model._default_manager.all()
+        select_related = getattr(model, 'search_select_related', None)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        prefetch_related = getattr(model, 'search_prefetch_related', None)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        for pk, node in queryset.in_bulk(model_ids).items():
+            nodes[(model_class, pk)] = node
+    return nodes
+
+
+def get_search_generation(site_id: typing.Optional[int]) -> tuple:
+    """ Возвращает поколение поискового индекса: общее и для сайта """
+    keys = [f'{SEARCH_GENERATION_KEY}:global', f'{SEARCH_GENERATION_KEY}:{site_id}']
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            # после вытеснения ключа начинаю с метки времени, чтобы не вернуться к старым поколениям
+            cache.add(key, int(time.time() * 1000), None)
+            values[key] = cache.get(key)
+    return tuple(values[key] for key in keys)
+
+
+def bump_search_generation(site_ids: typing.Iterable[typing.Optional[int]] = None) -> None:
+    """
+    Увеличивает поколение поискового индекса сайтов, что сбрасывает кеш результатов поиска
+    :param site_ids: сайты, None - общее поколение для всех сайтов
+    """
+    keys = [f'{SEARCH_GENERATION_KEY}:{site_id}' for site_id in site_ids] if site_ids is not None \
+        else [f'{SEARCH_GENERATION_KEY}:global']
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), None)
+
+
+def get_hit_data(hit) -> tuple:
+    """ Возвращает компактное представление результата поиска для кеша """
+    source = {field: getattr(hit, field, None) for field in HIT_FIELDS}
+    try:
+        highlight = hit.meta['highlight']
+        highlight = highlight.to_dict() if hasattr(highlight, 'to_dict') else dict(highlight)
+    except (KeyError, AttributeError):
+        highlight = dict()
+    return source, hit.meta['score'], {field: list(value) for field, value in highlight.items()}
+
+
+class SearchResultCache:
+    """ Кеш результатов поиска в памяти процесса с ограничением по времени жизни и количеству записей (LRU) """
+
+    def __init__(self, timeout: int = SEARCH_RESULT_CACHE_TIMEOUT, max_entries: int = SEARCH_RESULT_CACHE_MAX_ENTRIES):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: tuple, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+search_result_cache = SearchResultCache(
+    timeout=getattr(settings, 'SEARCH_RESULT_CACHE_TIMEOUT', SEARCH_RESULT_CACHE_TIMEOUT),
+    max_entries=getattr(settings, 'SEARCH_RESULT_CACHE_MAX_ENTRIES', SEARCH_RESULT_CACHE_MAX_ENTRIES),
+)
+
+
+def normalize_search_text(text: str) -> str:
+    """ Нормализует поисковую фразу для ключа кеша """
+    return re.sub(r'\s+', ' ', (text or '').lower()).strip()
+
+
+class CachedSearchQuery:
+    """
+    Запрос поиска с кешем результатов по (движок, сайт, фраза, раздел, страница).
+    В кеше хранятся поля результатов, оценки и выделения, объекты загружаются при каждом запросе.
+    Движок входит в ключ, чтобы результаты локального индекса при недоступности Elasticsearch
+    не отдавались из кеша после восстановления кластера
+    """
+
+    def __init__(self, query, site_id: typing.Optional[int], text: str, model_class: str = None,
+                 result_cache: SearchResultCache = None):
+        self.query = query
+        self.result_cache = result_cache or search_result_cache
+        self.key = (
+            type(query).__name__, site_id, normalize_search_text(text), model_class or '',
+            get_search_generation(site_id),
+        )
+
+    def count(self) -> int:
+        key = self.key + ('count', )
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self.query.count()
+            self.result_cache.set(key, result)
+        return result
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def facets(self) -> typing.Dict[str, int]:
+        key = self.key + ('facets', )
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self.query.facets()
+            self.result_cache.set(key, result)
+        return result
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        key = self.key + ('page', item.start, item.stop)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = [get_hit_data(hit) for hit in self.query[item]]
+            self.result_cache.set(key, result)
+        return [LocalHit(dict(source), score, highlight) for source, score, highlight in result]
+
+    def __iter__(self):
+        return iter(self[0:self.count()])
+
+
+def get_suggestions(prefix: str, site_id: int, size: int = SUGGEST_SIZE,
+                    result_cache: SearchResultCache = None) -> typing.List[dict]:
+    """
+    Возвращает подсказки поиска, повторные префиксы отдаются из кеша результатов поиска.
+    Если индекс движка не поддерживает подсказки, используется локальный индекс
+    """
+    result_cache = result_cache or search_result_cache
+    backend = get_search_backend()
+    if not backend.supports_suggest():
+        backend = LocalSearchBackend()
+    key = (
+        type(backend).__name__, site_id, normalize_search_text(prefix), 'suggest', size,
+        get_search_generation(site_id),
+    )
+    result = result_cache.get(key)
+    if result is None:
+        try:
+            result = backend.suggest(prefix, site_id, size=size)
+        except Exception as e:
+            # пустые и запасные подсказки тоже кешируются, чтобы ошибка не повторялась на каждое нажатие клавиши
+            logger.warning(f'Error get suggestions from {type(backend).__name__}, local search index is used: {e!r}')
+            result = LocalSearchBackend().suggest(prefix, site_id, size=size)
+        result_cache.set(key, result)
+    return result
@@ -0,0 +1,302 @@
+"""
+Обновление поискового индекса через очередь
+"""
+import logging
+import traceback
+import typing
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.transaction import atomic
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from main.services.search import bump_search_generation
+from main.services.search_local import get_local_index
+
+logger = logging.getLogger('debug')
+
+# локальный запасной индекс обновляется вместе с Elasticsearch, иначе поиску при отказе кластера нечего отдать;
+# он обновляется первым, чтобы недоступность кластера не останавливала и его
+DEFAULT_INDEX_BACKEND = (
+    'main.services.search_index.LocalIndexBackend',
+    'main.services.search_index.ElasticsearchIndexBackend',
+)
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 60 * 60
+MAX_ATTEMPTS = 20
+# пока перестраивается индекс с переключением алиаса, очередь не разбирается:
+# иначе изменения попадут в старый индекс и пропадут после переключения
+QUEUE_PAUSE_KEY = 'search_index_queue_paused'
+QUEUE_PAUSE_TIMEOUT = 10 * 60
+# время, на которое записи очереди закрепляются за обработчиком; записи упавшего обработчика обработаются повторно
+QUEUE_CLAIM_TIMEOUT = 5 * 60
+
+
+class BaseIndexBackend:
+    """ Базовый класс хранилища поискового индекса """
+
+    def bulk(self, document, objects: typing.List[models.Model], action: str) -> None:
+        """
+        Выполняет пакетное обновление индекса
+        :param document: класс документа индекса
+        :param objects: список объектов
+        :param action: действие index или delete
+        """
+        raise NotImplementedError()
+
+    def flush(self) -> None:
+        """ Сохраняет накопленные изменения: вызывается после перестроения индекса или разбора очереди """
+        pass
+
+
+class ElasticsearchIndexBackend(BaseIndexBackend):
+    """ Пакетное обновление индекса Elasticsearch через bulk API """
+
+    def bulk(self, document, objects: typing.List[models.Model], action: str) -> None:
+        from elasticsearch.helpers import BulkIndexError
+
+        try:
+            document().update(objects, action=action)
+        except BulkIndexError as e:
+            # удаление отсутствующих в индексе документов ошибкой не считаю
+            errors = [item for item in e.errors if item.get('delete', {}).get('status') != 404]
+            if errors:
+                raise
+
+
+class LocalIndexBackend(BaseIndexBackend):
+    """
+    Локальная замена Elasticsearch: документы попадают в локальный инвертированный индекс.
+    Используется в тестах, окружениях без кластера и как запасной индекс для поиска.
+    Индекс записывается на диск целиком, поэтому сохраняется один раз в flush(), а не после каждой пачки
+    """
+
+    def __init__(self):
+        self.changed = set()
+
+    @staticmethod
+    def get_index_name(document) -> str:
+        return document._index._name
+
+    @staticmethod
+    def get_key(obj: models.Model) -> str:
+        return f'{obj._meta.model_name}:{obj.pk}'
+
+    def bulk(self, document, objects: typing.List[models.Model], action: str) -> None:
+        index = get_local_index(self.get_index_name(document))
+        for obj in objects:
+            if action == 'delete':
+                index.remove(self.get_key(obj))
+            else:
+                index.add(self.get_key(obj), document().prepare(obj))
+        self.changed.add(self.get_index_name(document))
+
+    def flush(self) -> None:
+        for name in sorted(self.changed):
+            get_local_index(name).save()
+        self.changed = set()
+
+
+class CompositeIndexBackend(BaseIndexBackend):
+    """ Обновляет несколько хранилищ индекса, например Elasticsearch и локальный запасной индекс """
+
+    def __init__(self, backends: typing.List[BaseIndexBackend]):
+        self.backends = backends
+
+    def bulk(self, document, objects: typing.List[models.Model], action: str) -> None:
+        for backend in self.backends:
+            backend.bulk(document, objects, action)
+
+    def flush(self) -> None:
+        for backend in self.backends:
+            backend.flush()
+
+
+def get_index_backend() -> BaseIndexBackend:
+    """ Возвращает хранилище поискового индекса из настроек проекта (путь к классу или список путей) """
+    value = getattr(settings, 'SEARCH_INDEX_BACKEND', DEFAULT_INDEX_BACKEND)
+    if isinstance(value, (list, tuple)):
+        return CompositeIndexBackend([import_string(path)() for path in value])
+    return import_string(value)()
+
+
+def uses_local_index(backend: BaseIndexBackend = None) -> bool:
+    """ Проверяет, обновляет ли хранилище индекса локальный запасной индекс """
+    backend = backend or get_index_backend()
+    if isinstance(backend, CompositeIndexBackend):
+        return any(uses_local_index(item) for item in backend.backends)
+    return isinstance(backend, LocalIndexBackend)
+
+
+def get_documents(model: typing.Type[models.Model]) -> list:
+    """ Возвращает документы поискового индекса, зарегистрированные для модели """
+    from django_elasticsearch_dsl.registries import registry
+    return list(registry.get_documents(models=[model]))
+
+
+def get_retry_delay(attempts: int) -> timezone.timedelta:
+    """ Возвращает задержку перед следующей попыткой (экспоненциально с ограничением) """
+    return timezone.timedelta(seconds=min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY))
+
+
+def index_objects(model: typing.Type[models.Model], index_ids: typing.Iterable[int],
+                  delete_ids: typing.Iterable[int], backend: BaseIndexBackend = None) -> None:
+    """
+    Обновляет поисковый индекс для объектов одной модели
+    :param model: модель объектов
+    :param index_ids: идентификаторы объектов для индексирования
+    :param delete_ids: идентификаторы объектов для удаления из индекса
+    :param backend: хранилище индекса; изменения переданного хранилища сохраняет вызывающий код через flush()
+    """
+    own_backend = backend is None
+    backend = backend or get_index_backend()
+    index_ids = set(index_ids)
+    delete_ids = set(delete_ids)
+
+    objects = []
+    if index_ids:
+        queryset = model._default_manager.filter(pk__in=index_ids)
+        if hasattr(model, 'placeholders'):
+            queryset = queryset.prefetch_related('placeholders')
+        for obj in queryset:
+            # удаленные объекты убираются из индекса
+            if getattr(obj, 'is_deleted', False):
+                delete_ids.add(obj.pk)
+            else:
+                objects.append(obj)
+        # объекты, которых уже нет в БД
+        delete_ids |= index_ids - {obj.pk for obj in objects} - delete_ids
+
+    for document in get_documents(model):
+        if objects:
+            backend.bulk(document, objects, 'index')
+        if delete_ids:
+            backend.bulk(document, [model(pk=pk) for pk in sorted(delete_ids)], 'delete')
+    if own_backend:
+        backend.flush()
+    bump_search_generation_for(objects, delete_ids)
+
+
+def bump_search_generation_for(objects: typing.List[models.Model], delete_ids: typing.Set[int]) -> None:
+    """
+    Сбрасывает кеш результатов поиска сайтов, объекты которых изменились в индексе.
+    Сайт удаленных объектов неизвестен, как и для общих объектов сбрасывается общее поколение
+    """
+    site_ids = set()
+    is_global = bool(delete_ids)
+    for obj in objects:
+        if getattr(obj, 'is_global', False) or getattr(obj, 'site_id', None) is None:
+            is_global = True
+        else:
+            site_ids.add(obj.site_id)
+    if is_global:
+        bump_search_generation()
+    elif site_ids:
+        bump_search_generation(site_ids)
+
+
+def pause_search_index_queue(timeout: int = QUEUE_PAUSE_TIMEOUT) -> None:
+    """
+    Приостанавливает разбор очереди обновления индекса.
+    Пауза ограничена временем, чтобы очередь не осталась остановленной после сбоя
+    """
+    cache.set(QUEUE_PAUSE_KEY, True, timeout)
+
+
+def resume_search_index_queue() -> None:
+    cache.delete(QUEUE_PAUSE_KEY)
+
+
+def is_search_index_queue_paused() -> bool:
+    return bool(cache.get(QUEUE_PAUSE_KEY))
+
+
+def claim_search_index_queue(batch_size: int) -> typing.List[models.Model]:
+    """
+    Закрепляет за обработчиком пачку записей очереди: дата следующей попытки сдвигается на QUEUE_CLAIM_TIMEOUT,
+    другие обработчики эти записи не получат. Блокировки строк держатся только в этой короткой транзакции
+    :return: записи очереди
+    """
+    from main.models.search_index_queue import SearchIndexQueue
+
+    now = timezone.datetime.now()
+    with atomic():
+        rows = list(
+            SearchIndexQueue.objects
+                .select_for_update(skip_locked=True)
+                .select_related('content_type')
+                .filter(date_next_attempt__lte=now)
+                .order_by('id')[:batch_size]
+        )
+        SearchIndexQueue.objects.filter(id__in=[row.id for row in rows])\
+            .update(date_next_attempt=now + timezone.timedelta(seconds=QUEUE_CLAIM_TIMEOUT))
+    return rows
+
+
+def process_search_index_queue(batch_size: int = 500, backend: BaseIndexBackend = None) -> dict:
+    """
+    Разбирает пачку очереди обновления поискового индекса.
+    Повторные изменения одного объекта схлопываются в одно действие.
+    Записи закрепляются короткой транзакцией, индекс обновляется вне транзакции,
+    результат записывается второй короткой транзакцией
+    :param batch_size: максимальное количество записей очереди
+    :param backend: хранилище индекса; изменения переданного хранилища сохраняет вызывающий код через flush()
+    :return: статистика обработки
+    """
+    from main.models.search_index_queue import SearchIndexQueue
+
+    own_backend = backend is None
+    backend = backend or get_index_backend()
+    stats = {'rows': 0, 'objects': 0, 'failed': 0}
+    if is_search_index_queue_paused():
+        return stats
+
+    rows = claim_search_index_queue(batch_size)
+    stats['rows'] = len(rows)
+    if not rows:
+        return stats
+
+    # последнее действие по объекту определяет итоговое состояние индекса
+    groups = defaultdict(OrderedDict)
+    for row in rows:
+        groups[row.content_type][row.object_id] = row.action
+
+    failed_content_types = dict()
+    for content_type, actions in groups.items():
+        model = content_type.model_class()
+        stats['objects'] += len(actions)
+        try:
+            index_objects(
+                model,
+                [pk for pk, action in actions.items() if action == SearchIndexQueue.Action.INDEX],
+                [pk for pk, action in actions.items() if action == SearchIndexQueue.Action.DELETE],
+                backend=backend,
+            )
+        except Exception:
+            logger.error(f'Error update search index for {content_type}')
+            logger.error(traceback.format_exc())
+            failed_content_types[content_type.id] = traceback.format_exc()
+    if own_backend:
+        backend.flush()
+
+    now = timezone.datetime.now()
+    with atomic():
+        done_ids = []
+        for row in rows:
+            if row.content_type_id in failed_content_types:
+                stats['failed'] += 1
+                row.attempts += 1
+                if row.attempts >= MAX_ATTEMPTS:
+                    logger.error(f'Search index update dropped after {row.attempts} attempts: {row}')
+                    done_ids.append(row.id)
+                    continue
+                row.date_next_attempt = now + get_retry_delay(row.attempts)
+                row.last_error = failed_content_types[row.content_type_id]
+                row.save(update_fields=['attempts', 'date_next_attempt', 'last_error'])
+            else:
+                done_ids.append(row.id)
+        SearchIndexQueue.objects.filter(id__in=done_ids).delete()
+    return stats
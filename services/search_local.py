@@ -0,0 +1,359 @@
+"""
+Локальный поисковый индекс для работы без Elasticsearch
+"""
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import typing
+from collections import Counter, defaultdict
+
+from django.utils.html import strip_tags
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'^[а-яё]+$')
+
+SEARCH_FIELDS = ('title', 'text')
+HIGHLIGHT_FRAGMENT_SIZE = 100
+HIGHLIGHT_PRE_TAG = '<em>'
+HIGHLIGHT_POST_TAG = '</em>'
+BM25_K1 = 1.2
+BM25_B = 0.75
+SUGGEST_MAX_NGRAM = 15
+SUGGEST_FIELDS = ('id', 'title', 'url', 'model_class')
+
+
+class RussianStemmer:
+    """ Стеммер Портера (Snowball) для русского языка """
+    PERFECTIVE_GERUND = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+    REFLEXIVE = re.compile(r'(с[яь])$')
+    ADJECTIVE = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+    PARTICIPLE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+    VERB = re.compile(
+        r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+        r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$'
+    )
+    NOUN = re.compile(
+        r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+    )
+    RV = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+    DERIVATIONAL = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+    DER = re.compile(r'ость?$')
+    SUPERLATIVE = re.compile(r'(ейше|ейш)$')
+    I = re.compile(r'и$')
+    SOFT_SIGN = re.compile(r'ь$')
+    NN = re.compile(r'нн$')
+
+    def stem(self, word: str) -> str:
+        word = word.lower().replace('ё', 'е')
+        match = self.RV.match(word)
+        if not match:
+            return word
+        start, rv = match.groups()
+
+        # шаг 1: деепричастия, возвратные формы, прилагательные, глаголы, существительные
+        temp = self.PERFECTIVE_GERUND.sub('', rv, 1)
+        if temp == rv:
+            rv = self.REFLEXIVE.sub('', rv, 1)
+            temp = self.ADJECTIVE.sub('', rv, 1)
+            if temp != rv:
+                rv = self.PARTICIPLE.sub('', temp, 1)
+            else:
+                temp = self.VERB.sub('', rv, 1)
+                rv = self.NOUN.sub('', rv, 1) if temp == rv else temp
+        else:
+            rv = temp
+
+        # шаг 2
+        rv = self.I.sub('', rv, 1)
+
+        # шаг 3: словообразовательные окончания
+        if self.DERIVATIONAL.match(rv):
+            rv = self.DER.sub('', rv, 1)
+
+        # шаг 4: превосходная степень, двойное н, мягкий знак
+        temp = self.SOFT_SIGN.sub('', rv, 1)
+        if temp == rv:
+            rv = self.SUPERLATIVE.sub('', rv, 1)
+            rv = self.NN.sub('н', rv, 1)
+        else:
+            rv = temp
+        return start + rv
+
+
+stemmer = RussianStemmer()
+
+
+def normalize_token(token: str) -> str:
+    """ Приводит слово к основе """
+    token = token.lower()
+    if CYRILLIC_RE.match(token):
+        return stemmer.stem(token)
+    return token
+
+
+def tokenize(text: str) -> typing.List[str]:
+    """ Разбивает текст на основы слов """
+    return [normalize_token(match.group(0)) for match in WORD_RE.finditer(text or '')]
+
+
+def edge_ngrams(text: str) -> typing.Set[str]:
+    """ Возвращает начала слов текста (edge n-gram) для поиска по префиксу """
+    result = set()
+    for match in WORD_RE.finditer((text or '').lower().replace('ё', 'е')):
+        word = match.group(0)
+        for size in range(1, min(len(word), SUGGEST_MAX_NGRAM) + 1):
+            result.add(word[:size])
+    return result
+
+
+def clean_text(value) -> str:
+    """ Приводит значение поля документа к тексту без разметки """
+    if value is None:
+        return ''
+    return strip_tags(str(value))
+
+
+def highlight(text: str, terms: typing.Set[str], fragment_size: int = None) -> typing.Optional[str]:
+    """
+    Выделяет в тексте найденные слова
+    :param text: текст поля
+    :param terms: основы искомых слов
+    :param fragment_size: размер фрагмента, None - весь текст
+    :return: фрагмент с выделенными словами или None если совпадений нет
+    """
+    matches = [match for match in WORD_RE.finditer(text) if normalize_token(match.group(0)) in terms]
+    if not matches:
+        return None
+
+    start, end = 0, len(text)
+    if fragment_size and len(text) > fragment_size:
+        start = max(0, matches[0].start() - fragment_size // 4)
+        end = min(len(text), start + fragment_size)
+        # фрагмент по границам слов
+        while start > 0 and not text[start - 1].isspace():
+            start -= 1
+        while end < len(text) and not text[end].isspace():
+            end += 1
+
+    result = []
+    position = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        result.append(text[position:match.start()])
+        result.append(HIGHLIGHT_PRE_TAG + match.group(0) + HIGHLIGHT_POST_TAG)
+        position = match.end()
+    result.append(text[position:end])
+    return ''.join(result).strip()
+
+
+class LocalSearchIndex:
+    """
+    Инвертированный индекс документов поиска в памяти процесса с ранжированием BM25.
+    Хранит те же документы, что индексатор отправляет в Elasticsearch
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.RLock()
+        self.clear()
+        if path and os.path.exists(path):
+            self.load()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.documents = dict()
+            self.postings = {field: defaultdict(dict) for field in SEARCH_FIELDS}
+            self.terms = dict()
+            self.lengths = {field: dict() for field in SEARCH_FIELDS}
+            self.total_lengths = {field: 0 for field in SEARCH_FIELDS}
+            self.ngrams = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.documents
+
+    def get_document(self, key: str) -> typing.Optional[dict]:
+        return self.documents.get(key)
+
+    def add(self, key: str, source: dict) -> None:
+        """ Добавляет или заменяет документ в индексе """
+        with self.lock:
+            self.remove(key)
+            self.documents[key] = source
+            self.terms[key] = dict()
+            for field in SEARCH_FIELDS:
+                counts = Counter(tokenize(clean_text(source.get(field))))
+                self.terms[key][field] = list(counts.keys())
+                for term, count in counts.items():
+                    self.postings[field][term][key] = count
+                length = sum(counts.values())
+                self.lengths[field][key] = length
+                self.total_lengths[field] += length
+            for ngram in edge_ngrams(clean_text(source.get('title'))):
+                self.ngrams[ngram].add(key)
+
+    def remove(self, key: str) -> None:
+        """ Удаляет документ из индекса """
+        with self.lock:
+            if key not in self.documents:
+                return
+            for field in SEARCH_FIELDS:
+                for term in self.terms[key][field]:
+                    postings = self.postings[field][term]
+                    postings.pop(key, None)
+                    if not postings:
+                        del self.postings[field][term]
+                self.total_lengths[field] -= self.lengths[field].pop(key)
+            for ngram in edge_ngrams(clean_text(self.documents[key].get('title'))):
+                keys = self.ngrams[ngram]
+                keys.discard(key)
+                if not keys:
+                    del self.ngrams[ngram]
+            del self.terms[key]
+            del self.documents[key]
+
+    def match(self, source: dict, site_id: int = None, model_class: str = None) -> bool:
+        """ Проверяет фильтры документа по сайту и типу объекта """
+        if site_id is not None and source.get('site') != site_id and not source.get('is_global'):
+            return False
+        if model_class and source.get('model_class') != model_class:
+            return False
+        return True
+
+    def search(self, text: str, site_id: int = None, model_class: str = None) -> typing.List[typing.Tuple[str, float]]:
+        """
+        Ищет документы по тексту, оценка документа - лучшая оценка BM25 по полям
+        :return: список (ключ документа, оценка) по убыванию оценки
+        """
+        terms = set(tokenize(text))
+        scores = defaultdict(float)
+        with self.lock:
+            count = len(self.documents)
+            for field in SEARCH_FIELDS:
+                if not count:
+                    break
+                average_length = (self.total_lengths[field] / count) or 1
+                field_scores = defaultdict(float)
+                for term in terms:
+                    postings = self.postings[field].get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for key, frequency in postings.items():
+                        length = self.lengths[field][key]
+                        field_scores[key] += idf * frequency * (BM25_K1 + 1) / (
+                            frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                        )
+                for key, score in field_scores.items():
+                    scores[key] = max(scores[key], score)
+
+            result = [
+                (key, score) for key, score in scores.items()
+                if self.match(self.documents[key], site_id, model_class)
+            ]
+        result.sort(key=lambda item: (-item[1], item[0]))
+        return result
+
+    def suggest(self, prefix: str, site_id: int = None, size: int = 10) -> typing.List[dict]:
+        """
+        Ищет документы, в заголовке которых есть слова, начинающиеся с каждого слова префикса
+        :return: поля SUGGEST_FIELDS документов, короткие заголовки первыми
+        """
+        words = [match.group(0) for match in WORD_RE.finditer((prefix or '').lower().replace('ё', 'е'))]
+        if not words:
+            return []
+        with self.lock:
+            keys = None
+            for word in words:
+                found = self.ngrams.get(word[:SUGGEST_MAX_NGRAM], set())
+                keys = found if keys is None else keys & found
+                if not keys:
+                    return []
+            long_words = [word for word in words if len(word) > SUGGEST_MAX_NGRAM]
+            sources = []
+            for key in keys:
+                source = self.documents[key]
+                if not self.match(source, site_id):
+                    continue
+                # слова длиннее n-грамм проверяются по заголовку
+                title = clean_text(source.get('title')).lower().replace('ё', 'е')
+                if long_words and not all(
+                        any(token.startswith(word) for token in WORD_RE.findall(title)) for word in long_words):
+                    continue
+                sources.append((len(title), key, source))
+        sources.sort(key=lambda item: item[:2])
+        return [{field: source.get(field) for field in SUGGEST_FIELDS} for _, _, source in sources[:size]]
+
+    def get_highlight(self, key: str, text: str) -> dict:
+        """ Возвращает выделение найденных слов в полях документа в формате Elasticsearch """
+        terms = set(tokenize(text))
+        source = self.documents.get(key) or dict()
+        result = dict()
+        for field in SEARCH_FIELDS:
+            fragment = highlight(
+                clean_text(source.get(field)), terms, None if field == 'title' else HIGHLIGHT_FRAGMENT_SIZE
+            )
+            if fragment:
+                result[field] = [fragment]
+        return result
+
+    def save(self) -> None:
+        """ Сохраняет документы индекса на диск """
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.documents, ensure_ascii=False, separators=(',', ':'))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        self.mtime = os.path.getmtime(self.path)
+
+    def load(self) -> None:
+        """ Загружает документы с диска и строит индекс """
+        with open(self.path, 'r', encoding='utf-8') as f:
+            documents = json.load(f)
+        with self.lock:
+            self.clear()
+            for key, source in documents.items():
+                self.add(key, source)
+            self.mtime = os.path.getmtime(self.path)
+
+    def reload_if_changed(self) -> None:
+        """ Перечитывает индекс, если файл изменен другим процессом """
+        if self.path and os.path.exists(self.path) and os.path.getmtime(self.path) != self.mtime:
+            self.load()
+
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def get_local_index_path() -> typing.Optional[str]:
+    """
+    Возвращает каталог локальных индексов: SEARCH_LOCAL_INDEX_PATH, по умолчанию search_index в каталоге проекта.
+    Индекс общий для обработчика очереди и веб-процессов. None - индекс только в памяти процесса
+    """
+    from django.conf import settings
+
+    default = os.path.join(getattr(settings, 'BASE_DIR', None) or tempfile.gettempdir(), 'search_index')
+    return getattr(settings, 'SEARCH_LOCAL_INDEX_PATH', default)
+
+
+def get_local_index(name: str = 'search') -> LocalSearchIndex:
+    """ Возвращает локальный индекс по имени, индексы хранятся в каталоге get_local_index_path() """
+    with _indexes_lock:
+        if name not in _indexes:
+            directory = get_local_index_path()
+            _indexes[name] = LocalSearchIndex(os.path.join(directory, f'{name}.json') if directory else None)
+    index = _indexes[name]
+    index.reload_if_changed()
+    return index
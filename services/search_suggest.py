@@ -0,0 +1,54 @@
+"""
+Поле автодополнения поиска для документов Elasticsearch
+"""
+import typing
+
+from django_elasticsearch_dsl import fields
+
+from main.services.search_local import WORD_RE, clean_text
+
+SUGGEST_FIELD = 'title_suggest'
+SUGGEST_SITE_CONTEXT = 'site'
+SUGGEST_GLOBAL_CONTEXT = 'global'
+SUGGEST_MAX_INPUTS = 5
+
+
+def get_suggest_contexts(site_id: typing.Optional[int], is_global: bool) -> typing.List[str]:
+    """ Возвращает значения контекста сайта: документ находится на своем сайте или на всех сайтах """
+    if is_global or site_id is None:
+        return [SUGGEST_GLOBAL_CONTEXT]
+    return [str(site_id)]
+
+
+def get_suggest_input(title: str) -> typing.List[str]:
+    """
+    Возвращает варианты ввода для автодополнения: заголовок и его окончания с начала слов,
+    чтобы заголовок находился по началу любого из первых слов
+    """
+    title = clean_text(title).strip()
+    if not title:
+        return []
+    starts = [match.start() for match in WORD_RE.finditer(title)][:SUGGEST_MAX_INPUTS]
+    return list(dict.fromkeys(title[start:] for start in starts)) or [title]
+
+
+class SuggestDocumentMixin:
+    """
+    Примесь документа поиска с полем автодополнения (completion suggester).
+    Контекст сайта позволяет фильтровать подсказки по сайту и общим документам в одном запросе.
+    После подключения примеси к документу индекс перестраивается командой rebuild_search_index,
+    до этого подсказки отдаются из локального индекса
+    """
+    title_suggest = fields.CompletionField(contexts=[
+        {'name': SUGGEST_SITE_CONTEXT, 'type': 'category'},
+    ])
+
+    def prepare_title_suggest(self, instance) -> dict:
+        return {
+            'input': get_suggest_input(getattr(instance, 'title', '')),
+            'contexts': {
+                SUGGEST_SITE_CONTEXT: get_suggest_contexts(
+                    getattr(instance, 'site_id', None), getattr(instance, 'is_global', False)
+                ),
+            },
+        }
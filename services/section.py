@@ -0,0 +1,228 @@
+"""
+Сервисные функции для работы с разделами сайта
+"""
+import hashlib
+import time
+import typing
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+
+SECTION_TREE_GENERATION_KEY = 'section_tree_generation'
+SECTION_TREE_CACHE_TIMEOUT = 60 * 60
+
+
+def build_children_index(sections: typing.Iterable) -> typing.Dict[typing.Optional[int], list]:
+    """
+    Группирует плоский список разделов по родителю за один проход
+    :param sections: список разделов (порядок внутри родителя сохраняется)
+    :return: словарь parent_id -> список дочерних разделов
+    """
+    result = defaultdict(list)
+    for section in sections:
+        result[section.parent_id].append(section)
+    return result
+
+
+class SectionSettingsResolver:
+    """
+    Загружает настройки разделов для сайта пачкой и отдает их из памяти.
+    Настройки подгружаются вместе с настройками всех предков разделов,
+    поэтому хлебные крошки не требуют дополнительных запросов.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self._settings = dict()
+        self._loaded_ids = set()
+        self._loaded_ranges = defaultdict(list)
+
+    def _is_loaded(self, section) -> bool:
+        """ Возвращает флаг что настройки раздела уже загружены """
+        if section.id in self._loaded_ids:
+            return True
+        # раздел является предком одного из загруженных разделов
+        for lft, rght in self._loaded_ranges.get(section.tree_id, []):
+            if section.lft <= lft and section.rght >= rght:
+                return True
+        return False
+
+    def prefetch(self, sections: typing.Iterable) -> None:
+        """ Загружает одним запросом настройки разделов и их предков """
+        from main.models.section_settings import SectionSettings
+
+        sections = [section for section in sections if section.id and not self._is_loaded(section)]
+        if not sections:
+            return
+
+        if self.site:
+            query = Q()
+            for section in sections:
+                query |= Q(section__tree_id=section.tree_id,
+                           section__lft__lte=section.lft,
+                           section__rght__gte=section.rght)
+            queryset = SectionSettings.objects.filter(Q(site=self.site) & query).order_by('pk')
+            for settings in queryset:
+                self._settings.setdefault(settings.section_id, settings)
+
+        for section in sections:
+            self._loaded_ids.add(section.id)
+            self._loaded_ranges[section.tree_id].append((section.lft, section.rght))
+
+    def get(self, section):
+        """ Возвращает настройки раздела для сайта или None """
+        if not self._is_loaded(section):
+            self.prefetch([section])
+        return self._settings.get(section.id)
+
+
+def get_section_settings_resolver(context: dict, site) -> SectionSettingsResolver:
+    """ Возвращает резолвер настроек разделов из контекста сериализатора """
+    resolvers = context.setdefault('section_settings', dict())
+    key = site.id if site else None
+    if key not in resolvers:
+        resolvers[key] = SectionSettingsResolver(site)
+    return resolvers[key]
+
+
+def get_section_tree_generation(site_id: typing.Optional[int]) -> tuple:
+    """ Возвращает поколение дерева разделов: общее для всех сайтов и поколение сайта """
+    keys = [f'{SECTION_TREE_GENERATION_KEY}:global', f'{SECTION_TREE_GENERATION_KEY}:{site_id}']
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            # после вытеснения ключа начинаю с метки времени, чтобы не вернуться к старым поколениям
+            cache.add(key, int(time.time() * 1000), None)
+            values[key] = cache.get(key)
+    return tuple(values[key] for key in keys)
+
+
+def bump_section_tree_generation(site_ids: typing.Iterable[typing.Optional[int]] = None) -> None:
+    """
+    Увеличивает поколение дерева разделов сайтов, что делает недействительными их закешированные деревья
+    :param site_ids: сайты, None - общее поколение для всех сайтов (глобальные разделы)
+    """
+    keys = [f'{SECTION_TREE_GENERATION_KEY}:{site_id}' for site_id in set(site_ids)] if site_ids is not None \
+        else [f'{SECTION_TREE_GENERATION_KEY}:global']
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), None)
+
+
+def get_section_tree_cache_key(site, is_active: bool, code: str = None) -> str:
+    """ Возвращает ключ кеша сериализованного дерева разделов сайта """
+    code_hash = hashlib.md5((code or '').encode('utf-8')).hexdigest()
+    site_id = site.id if site else None
+    generation = '.'.join(str(value) for value in get_section_tree_generation(site_id))
+    return f'section_tree:{generation}:{site_id or 0}:{int(is_active)}:{code_hash}'
+
+
+def get_cached_section_tree(site, is_active: bool, code: str = None) -> typing.Optional[list]:
+    """ Возвращает закешированное сериализованное дерево разделов сайта или None """
+    return cache.get(get_section_tree_cache_key(site, is_active, code))
+
+
+def set_cached_section_tree(site, is_active: bool, code: str, data: list) -> None:
+    """ Сохраняет в кеш сериализованное дерево разделов сайта """
+    cache.set(get_section_tree_cache_key(site, is_active, code), data, SECTION_TREE_CACHE_TIMEOUT)
+
+
+class SectionAncestorsResolver:
+    """
+    Загружает предков разделов одним запросом по полям MPTT (tree_id, lft, rght)
+    и строит хлебные крошки в памяти
+    """
+
+    def __init__(self):
+        self._trees = defaultdict(list)
+        self._node_ids = set()
+        self._loaded_ids = set()
+
+    def prefetch(self, sections: typing.Iterable) -> None:
+        """ Загружает предков всех разделов списка одним запросом """
+        from main.models import Section
+
+        sections = [section for section in sections if section.id and section.id not in self._loaded_ids]
+        query = Q()
+        for section in sections:
+            # у корневых разделов нет предков
+            if section.level:
+                query |= Q(tree_id=section.tree_id, lft__lt=section.lft, rght__gt=section.rght)
+            self._loaded_ids.add(section.id)
+        if not query:
+            return
+
+        changed_trees = set()
+        for node in Section.objects.filter(query).order_by('tree_id', 'lft'):
+            if node.id not in self._node_ids:
+                self._node_ids.add(node.id)
+                self._trees[node.tree_id].append(node)
+                changed_trees.add(node.tree_id)
+        for tree_id in changed_trees:
+            self._trees[tree_id].sort(key=lambda node: node.lft)
+
+    def get_ancestors(self, section, include_self: bool = False) -> list:
+        """ Возвращает предков раздела начиная с корня """
+        if section.id not in self._loaded_ids:
+            self.prefetch([section])
+        result = [
+            node for node in self._trees.get(section.tree_id, [])
+            if node.lft < section.lft and node.rght > section.rght
+        ]
+        if include_self:
+            result.append(section)
+        return result
+
+
+def get_section_ancestors_resolver(context: dict) -> SectionAncestorsResolver:
+    """ Возвращает резолвер предков разделов из контекста сериализатора """
+    if 'section_ancestors' not in context:
+        context['section_ancestors'] = SectionAncestorsResolver()
+    return context['section_ancestors']
+
+
+def save_sections_ordering(site, items: typing.List[dict]) -> list:
+    """
+    Сохраняет порядок сортировки разделов на сайте пачкой
+    :param site: текущий сайт
+    :param items: список словарей с ключами id и order
+    :return: список разделов сайта в порядке входных данных
+    """
+    from cacheops import invalidate_model
+    from django.db.transaction import atomic
+    from main.models import Section
+    from main.models.section_settings import SectionSettings
+
+    ids = [int(item['id']) for item in items]
+    sections = Section.objects.filter(Section.get_filter_query_by_site(site)).nocache().in_bulk(ids)
+
+    orders = dict()
+    for item in items:
+        if int(item['id']) in sections and (item['order'] or item['order'] == 0):
+            orders[int(item['id'])] = int(item['order'])
+
+    if orders:
+        with atomic():
+            existing = dict()
+            settings_queryset = SectionSettings.objects.filter(site=site, section_id__in=orders.keys())\
+                .select_for_update()\
+                .order_by('pk')\
+                .nocache()
+            for settings in settings_queryset:
+                existing.setdefault(settings.section_id, settings)
+
+            for section_id, settings in existing.items():
+                settings.order = orders[section_id]
+            SectionSettings.objects.bulk_update(existing.values(), ['order'])
+            SectionSettings.objects.bulk_create([
+                SectionSettings(site=site, section_id=section_id, order=order)
+                for section_id, order in orders.items() if section_id not in existing
+            ])
+        # массовые операции не отправляют сигналы моделей
+        invalidate_model(SectionSettings)
+        bump_section_tree_generation([site.id if site else None])
+
+    return [sections[section_id] for section_id in ids if section_id in sections]
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+from django.test import TestCase, override_settings
+
+from main.models.ticket import Ticket
+from main.models.user import User
+from main.services import event_bus
+from main.services.event_bus import BrokerEventBackend, InProcessEventBackend, LocalBroker
+
+
+class EventBusTestCase(TestCase):
+    def check_backend(self, backend):
+        with backend.subscribe(['a', 'b']) as subscription:
+            backend.publish('a', {'value': 1})
+            backend.publish('c', {'value': 2})
+            self.assertEqual(subscription.get(timeout=1), {'value': 1})
+            self.assertIsNone(subscription.get(timeout=0.01))
+        backend.publish('a', {'value': 3})
+        self.assertIsNone(subscription.get(timeout=0.01))
+
+    def test_in_process(self):
+        self.check_backend(InProcessEventBackend())
+
+    def test_broker(self):
+        self.check_backend(BrokerEventBackend(LocalBroker()))
+
+
+@override_settings(EVENT_BUS_BACKEND='main.services.event_bus.InProcessEventBackend')
+class TicketEventsTestCase(TestCase):
+    fixtures = [
+        'user.json',
+    ]
+
+    def setUp(self):
+        event_bus._event_bus = None
+
+    def test_publish(self):
+        user = User.objects.get_by_username('user')
+        staff_user = User.objects.get_by_username('staff')
+        ticket = Ticket.objects.create(title='Тикет', body='Описание', sender=user, ticket_type=Ticket.TicketType.TECH)
+
+        with event_bus.get_event_bus().subscribe([Ticket.get_user_channel(user.id)]) as subscription:
+            # событие отправляется только после фиксации транзакции
+            with self.captureOnCommitCallbacks(execute=True):
+                ticket.onChatMessageAdd(SimpleNamespace(user_id=staff_user.id, user=staff_user))
+                self.assertIsNone(subscription.get(timeout=0.01))
+            self.assertEqual(
+                subscription.get(timeout=1), {'ticket': ticket.id, 'site': ticket.site_id, 'count_new_user': 1}
+            )
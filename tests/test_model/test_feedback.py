@@ -0,0 +1,105 @@
+from unittest import mock
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase, override_settings
+from django_mail_admin import models
+
+from main.services import feedback
+from main.services.feedback import get_mail_queue_stats, process_mail_queue, send_new_order_notice
+
+
+class CountingEmailBackend(EmailBackend):
+    """ Бэкенд с поведением соединения SMTP: send_messages() неоткрытого соединения открывает и закрывает его """
+    opened_count = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountingEmailBackend, self).__init__(*args, **kwargs)
+        self.is_open = False
+
+    def open(self):
+        if self.is_open:
+            return False
+        self.is_open = True
+        CountingEmailBackend.opened_count += 1
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        new_connection = self.open()
+        try:
+            return super(CountingEmailBackend, self).send_messages(messages)
+        finally:
+            if new_connection:
+                self.close()
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    DEFAULT_FROM_EMAIL='site@example.com',
+    NOTICE_FEEDBACK_EMAIL='manager@example.com',
+    FEEDBACK_MAIL_QUEUE=True,
+)
+class MailQueueTestCase(TestCase):
+    def setUp(self):
+        models.EmailTemplate.objects.create(name='order', subject='Заказ {{ name }}',
+                                            email_html_text='Телефон {{ phone }}')
+        feedback.template_cache.clear()
+        mail.outbox = []
+
+    def test_queue(self):
+        for i in range(3):
+            send_new_order_notice({'name': f'Иван {i}', 'phone': '123'})
+        # письма сохраняются в очередь и не отправляются в запросе
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(models.OutgoingEmail.objects.filter(status=models.STATUS.queued).count(), 3)
+
+        stats = process_mail_queue(batch_size=10)
+        self.assertEqual(stats, {'rows': 3, 'sent': 3, 'retried': 0, 'failed': 0})
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].subject, 'Заказ Иван 0')
+        self.assertEqual(mail.outbox[0].to, ['manager@example.com'])
+        self.assertEqual(mail.outbox[0].alternatives[0][0], 'Телефон 123')
+        self.assertEqual(models.OutgoingEmail.objects.filter(status=models.STATUS.sent).count(), 3)
+        self.assertEqual(process_mail_queue()['rows'], 0)
+
+    def test_retry(self):
+        send_new_order_notice({'name': 'Иван', 'phone': '123'})
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=ConnectionError()):
+            stats = process_mail_queue(max_attempts=2, retry_delay=0)
+        self.assertEqual(stats['retried'], 1)
+        email = models.OutgoingEmail.objects.get()
+        self.assertEqual(email.status, models.STATUS.queued)
+        self.assertEqual(email.logs.filter(status=models.STATUS.failed).count(), 1)
+
+        stats = process_mail_queue(max_attempts=2, retry_delay=0)
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        stats = get_mail_queue_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(stats['failed_attempts'], 1)
+        self.assertEqual(stats['last_error']['exception_type'], 'ConnectionError')
+
+    def test_drop_after_max_attempts(self):
+        send_new_order_notice({'name': 'Иван', 'phone': '123'})
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=ConnectionError()):
+            process_mail_queue(max_attempts=2, retry_delay=0)
+            stats = process_mail_queue(max_attempts=2, retry_delay=0)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(models.OutgoingEmail.objects.get().status, models.STATUS.failed)
+        self.assertEqual(process_mail_queue()['rows'], 0)
+
+    def test_one_connection_per_batch(self):
+        with override_settings(EMAIL_BACKEND=f'{__name__}.CountingEmailBackend'):
+            for batch in range(2):
+                for i in range(3):
+                    send_new_order_notice({'name': f'Иван {i}', 'phone': '123'})
+                opened_count = CountingEmailBackend.opened_count
+                self.assertEqual(process_mail_queue(batch_size=10)['sent'], 3)
+                # django_mail_admin открывает свое соединение при первой подготовке письма в потоке
+                self.assertLessEqual(CountingEmailBackend.opened_count - opened_count, 2 if batch == 0 else 1)
+        self.assertEqual(len(mail.outbox), 6)
@@ -0,0 +1,255 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from main.models.dirty_fields import get_side_effect_counters
+from main.models.news import News
+from main.models.news_archive import NewsArchive
+from main.models.search_index_queue import SearchIndexQueue
+
+
+class NewsArchiveTestCase(TestCase):
+    def get_count(self, year: int, month: int, is_chronicles: bool = False) -> int:
+        item = NewsArchive.objects.filter(site__isnull=True, is_chronicles=is_chronicles, year=year, month=month).first()
+        return item.count if item else 0
+
+    def test_archive_update(self):
+        date = timezone.datetime(year=2020, month=5, day=10)
+        news1 = News.objects.create(title='Новость 1', date_publish=date)
+        news2 = News.objects.create(title='Новость 2', date_publish=date)
+        self.assertEqual(self.get_count(2020, 5), 2)
+
+        news1 = News.objects.get(id=news1.id)
+        news1.date_publish = timezone.datetime(year=2020, month=6, day=1)
+        news1.save()
+        self.assertEqual(self.get_count(2020, 5), 1)
+        self.assertEqual(self.get_count(2020, 6), 1)
+
+        news2.delete()
+        self.assertEqual(self.get_count(2020, 5), 0)
+        news2.restore()
+        self.assertEqual(self.get_count(2020, 5), 1)
+
+        news2.is_chronicles = True
+        news2.save()
+        self.assertEqual(self.get_count(2020, 5), 0)
+        self.assertEqual(self.get_count(2020, 5, is_chronicles=True), 1)
+
+        news1.delete(force_delete=True)
+        self.assertEqual(self.get_count(2020, 6), 0)
+
+    def test_concurrent_create(self):
+        from unittest import mock
+        from django.db import IntegrityError
+
+        date = timezone.datetime(year=2018, month=2, day=10)
+        for i in range(2):
+            News.objects.create(title=f'Новость {i}', date_publish=date)
+        NewsArchive.objects.all().delete()
+
+        def create(**kwargs):
+            # ячейку создала другая транзакция между UPDATE и INSERT
+            NewsArchive.objects.bulk_create([NewsArchive(**dict(kwargs, count=1))])
+            raise IntegrityError()
+
+        with mock.patch.object(NewsArchive.objects, 'create', side_effect=create):
+            NewsArchive.recount(None, False, 2018, 2)
+        self.assertEqual(self.get_count(2018, 2), 2)
+
+    def test_rebuild(self):
+        date = timezone.datetime(year=2019, month=1, day=10)
+        for i in range(3):
+            News.objects.create(title=f'Новость {i}', date_publish=date)
+        NewsArchive.objects.all().delete()
+
+        self.assertEqual(NewsArchive.rebuild(), 1)
+        self.assertEqual(self.get_count(2019, 1), 3)
+
+
+class NewsDirtyFieldsTestCase(TestCase):
+    def test_dirty_fields(self):
+        news = News.objects.create(title='Новость')
+        news = News.objects.get(id=news.id)
+        self.assertEqual(news.get_dirty_fields(), set())
+        news.title = 'Новость 2'
+        self.assertTrue(news.has_changed('title'))
+        self.assertFalse(news.has_changed('is_top', 'site'))
+        news.save()
+        self.assertEqual(news.get_dirty_fields(), set())
+
+    def test_skip_side_effects(self):
+        news = News.objects.create(title='Новость')
+        SearchIndexQueue.objects.all().delete()
+        counters = get_side_effect_counters()
+
+        # изменение поля, не влияющего на индекс и рассылку
+        news.is_top = True
+        news.save()
+        self.assertFalse(SearchIndexQueue.objects.exists())
+        self.assertEqual(
+            get_side_effect_counters()['news.search_index.skipped'],
+            counters.get('news.search_index.skipped', 0) + 1
+        )
+        self.assertEqual(
+            get_side_effect_counters()['news.mailing.skipped'], counters.get('news.mailing.skipped', 0) + 1
+        )
+
+        news.title = 'Новость 2'
+        news.save()
+        self.assertEqual(SearchIndexQueue.objects.get().action, SearchIndexQueue.Action.INDEX)
+
+        news.delete()
+        self.assertEqual(SearchIndexQueue.objects.last().action, SearchIndexQueue.Action.DELETE)
+
+    def test_placeholder_reindex(self):
+        news = News.objects.create(title='Новость')
+        SearchIndexQueue.objects.all().delete()
+
+        placeholder = news.placeholders.get()
+        placeholder.text = 'Текст новости'
+        placeholder.save()
+        self.assertEqual(
+            list(SearchIndexQueue.objects.values_list('object_id', 'action')),
+            [(news.id, SearchIndexQueue.Action.INDEX)]
+        )
+
+    def test_delete_updates_date_modified(self):
+        news = News.objects.create(title='Новость')
+        date_modified = timezone.datetime(year=2020, month=1, day=1)
+        News.objects.filter(id=news.id).update(date_modified=date_modified)
+
+        news = News.objects.get(id=news.id)
+        news.delete()
+        self.assertGreater(News.objects.get(id=news.id).date_modified, date_modified)
+
+
+class NewsSoftDeleteTestCase(TestCase):
+    def test_soft_delete(self):
+        date = timezone.datetime(year=2021, month=3, day=1)
+        items = [News.objects.create(title=f'Новость {i}', date_publish=date) for i in range(3)]
+        SearchIndexQueue.objects.all().delete()
+        ids = [item.id for item in items]
+
+        self.assertEqual(News.objects.filter(id__in=ids[:2]).soft_delete(), 2)
+        self.assertEqual(News.objects.filter(id__in=ids, is_deleted=True).count(), 2)
+        self.assertEqual(
+            set(SearchIndexQueue.objects.values_list('object_id', 'action')),
+            {(pk, SearchIndexQueue.Action.DELETE) for pk in ids[:2]}
+        )
+        self.assertEqual(NewsArchive.objects.get(year=2021, month=3).count, 1)
+
+        # повторное удаление не меняет уже удаленные объекты
+        self.assertEqual(News.objects.filter(id__in=ids).soft_delete(), 1)
+        self.assertEqual(News.objects.filter(id__in=ids).restore(), 3)
+        self.assertFalse(News.objects.filter(id__in=ids, is_deleted=True).exists())
+        self.assertEqual(NewsArchive.objects.get(year=2021, month=3).count, 3)
+
+
+class NewsStaffBulkTestCase(TestCase):
+    fixtures = [
+        'user.json',
+    ]
+
+    def post(self, action: str, ids: list):
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from main.api.news import NewsStaffView
+        from main.models.user import User
+
+        request = APIRequestFactory().post('/', {'ids': ids}, format='json')
+        force_authenticate(request, user=User.objects.get_by_username('staff'))
+        return NewsStaffView.as_view({'post': action})(request)
+
+    def test_soft_delete_many(self):
+        items = [News.objects.create(title=f'Новость {i}') for i in range(3)]
+        ids = [item.id for item in items[:2]]
+
+        response = self.post('soft_delete_many', ids)
+        self.assertEqual(response.data, {'count': 2})
+        self.assertEqual(set(News.objects.filter(is_deleted=True).values_list('id', flat=True)), set(ids))
+
+        response = self.post('restore_many', ids)
+        self.assertEqual(response.data, {'count': 2})
+        self.assertFalse(News.objects.filter(is_deleted=True).exists())
+        self.assertEqual(self.post('restore_many', ['x']).status_code, 400)
+
+
+class NewsPurgeTestCase(TestCase):
+    def test_purge(self):
+        from main.services.purge import purge_deleted
+
+        items = [News.objects.create(title=f'Новость {i}') for i in range(3)]
+        News.objects.filter(id__in=[item.id for item in items]).soft_delete()
+        News.objects.filter(id__in=[items[0].id, items[1].id])\
+            .update(date_deleted=timezone.datetime.now() - timezone.timedelta(days=100))
+
+        stats = list(purge_deleted(News, retention_days=90, batch_size=1))
+        self.assertEqual(sum(item['rows'] for item in stats), 2)
+        self.assertEqual(list(News.objects.values_list('id', flat=True)), [items[2].id])
+
+
+class NewsCursorPaginationTestCase(TestCase):
+    def test_null_date_publish(self):
+        from django.db.models import IntegerField, Value
+        from django.test import RequestFactory
+        from main.api.news import NewsCursorPagination
+
+        date = timezone.datetime(year=2022, month=1, day=1)
+        dated = [News.objects.create(title=f'Новость {i}', date_publish=date) for i in range(2)]
+        undated = [News.objects.create(title=f'Без даты {i}') for i in range(2)]
+        News.objects.filter(id__in=[item.id for item in undated]).update(date_publish=None)
+        queryset = News.objects.annotate(top_order=Value(0, output_field=IntegerField()))
+
+        ids = []
+        cursor = None
+        while True:
+            pagination = NewsCursorPagination(page_size=1)
+            request = RequestFactory().get('/news/', {'cursor': cursor} if cursor else {})
+            ids += [item.id for item in pagination.paginate_queryset(queryset, request)]
+            if not pagination.next_position:
+                break
+            cursor = pagination.encode_cursor(pagination.next_position)
+
+        # новости без даты публикации идут в конце ленты
+        self.assertEqual(ids, [dated[1].id, dated[0].id, undated[1].id, undated[0].id])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Планы запросов проверяются на PostgreSQL')
+class AliveIndexPlanTestCase(TestCase):
+    def get_plan(self, queryset) -> str:
+        with connection.cursor() as cursor:
+            # на маленьких тестовых таблицах планировщик выбирает последовательное чтение
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def test_public_queries(self):
+        from main.models.section import Section
+        from main.models.ticket import Ticket
+
+        self.assertIn(
+            'main_news_alive_site_pub_idx',
+            self.get_plan(News.alive.filter(site__isnull=True).order_by('-date_publish')[:10])
+        )
+        self.assertIn(
+            'main_news_alive_site_pub_idx',
+            self.get_plan(News.objects.filter(News.get_deleted_query(), site__isnull=True).order_by('-date_publish'))
+        )
+        self.assertIn('main_section_alive_tree_idx', self.get_plan(Section.alive.order_by('tree_id', 'lft')))
+        self.assertIn('main_ticket_alive_created_idx', self.get_plan(Ticket.alive.order_by('date_created')))
+
+    def test_cursor_page(self):
+        from main.api.news import NewsCursorPagination
+
+        date = timezone.datetime(year=2022, month=1, day=1)
+        position = (0, date, 1000)
+        # глубокая страница читается диапазоном индекса от позиции курсора, а не с начала ленты
+        plan = self.get_plan(
+            News.alive.filter(site__isnull=True, date_publish__isnull=False)
+                .filter(NewsCursorPagination.get_position_query(position))
+                .order_by('-date_publish', '-id')[:10]
+        )
+        self.assertIn('main_news_alive_site_pub_idx', plan)
+        self.assertIn('Index Scan Backward', plan)
+        self.assertIn('date_publish <=', plan)
+        self.assertNotIn('Sort', plan)
@@ -0,0 +1,66 @@
+import time
+from unittest import mock, skipUnless
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.cache.backends import locmem
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+from main.models.section import Section
+from main.models.site import Site
+from main.models.user import User
+from main.services import permissions
+
+
+class PermissionMatrixTestCase(TestCase):
+    fixtures = [
+        'sites.json',
+        'user.json',
+    ]
+
+    def setUp(self):
+        self.SiteRight = apps.get_model('main', 'SiteRight')
+        self.site = Site.objects.first()
+        self.user = User.objects.get_by_username('staff')
+        self.section = Section.objects.create(title='section')
+        self.section.sites.add(self.site)
+
+    def has_perm(self) -> bool:
+        # матрица хранится в объекте пользователя на время запроса, каждая проверка - новый запрос
+        user = User.objects.get_by_username('staff')
+        return Section.has_perm(self.section, 'main.can_control_section', user, self.site)
+
+    def grant(self, rights_type: str = 'sections'):
+        # права не FULL ограничены списком разделов
+        rights = self.SiteRight.objects.create(user=self.user, site=self.site, rights_type=rights_type)
+        if rights_type != self.SiteRight.RightType.FULL:
+            rights.sections.add(self.section)
+        return rights
+
+    def test_grant(self):
+        self.assertFalse(self.has_perm())
+        # закешированная матрица без прав сбрасывается сохранением прав, без изменения разделов
+        rights = self.grant(self.SiteRight.RightType.FULL)
+        self.assertTrue(self.has_perm())
+        rights.delete()
+        self.assertFalse(self.has_perm())
+
+    def test_revoke(self):
+        rights = self.grant()
+        self.assertTrue(self.has_perm())
+        rights.sections.remove(self.section)
+        self.assertFalse(self.has_perm())
+
+    @skipUnless(isinstance(cache, LocMemCache), 'Часы подменяются в локальном кеше')
+    def test_expiry(self):
+        self.grant()
+        with mock.patch.object(permissions, 'PERMISSION_MATRIX_CACHE_TIMEOUT', 1):
+            self.assertTrue(self.has_perm())
+        # истечение срока прав не отправляет сигналов, матрица перечитывается после истечения кеша
+        with mock.patch.object(User, 'get_rights_for_site', return_value=None):
+            self.assertTrue(self.has_perm())
+            # часы локального кеша переводятся за срок хранения матрицы
+            clock = mock.Mock(time=mock.Mock(return_value=time.time() + 2))
+            with mock.patch.object(locmem, 'time', clock):
+                self.assertFalse(self.has_perm())
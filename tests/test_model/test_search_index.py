@@ -0,0 +1,263 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from main.models.news import News
+from main.models.search_index_queue import SearchIndexQueue
+from main.services.search_index import LocalIndexBackend, claim_search_index_queue, pause_search_index_queue, \
+    process_search_index_queue, resume_search_index_queue
+from main.services import search
+from main.services.search import CachedSearchQuery, ElasticsearchSearchQuery, LocalSearchQuery, SearchResultCache, bump_search_generation
+from main.services.search_local import LocalSearchIndex, get_local_index, stemmer
+
+
+@override_settings(SEARCH_INDEX_BACKEND='main.services.search_index.LocalIndexBackend')
+class SearchIndexQueueTestCase(TestCase):
+    def setUp(self):
+        get_local_index('search').clear()
+
+    def get_indexed(self):
+        return get_local_index('search')
+
+    def test_coalesce(self):
+        news = News.objects.create(title='Новость', preview='текст')
+        news.title = 'Новость 2'
+        news.save()
+        news.save()
+        self.assertEqual(SearchIndexQueue.objects.count(), 3)
+
+        stats = process_search_index_queue()
+        self.assertEqual(stats['rows'], 3)
+        self.assertEqual(stats['objects'], 1)
+        self.assertEqual(SearchIndexQueue.objects.count(), 0)
+        self.assertEqual(self.get_indexed().get_document(f'news:{news.id}')['title'], 'Новость 2')
+
+        news.delete()
+        process_search_index_queue()
+        self.assertNotIn(f'news:{news.id}', self.get_indexed())
+
+    def test_retry(self):
+        news = News.objects.create(title='Новость', preview='текст')
+        with mock.patch.object(LocalIndexBackend, 'bulk', side_effect=ConnectionError()):
+            stats = process_search_index_queue()
+        self.assertEqual(stats['failed'], 1)
+        row = SearchIndexQueue.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertTrue(row.last_error)
+
+        # следующая попытка откладывается
+        self.assertEqual(process_search_index_queue()['rows'], 0)
+        SearchIndexQueue.objects.update(date_next_attempt=row.date_created)
+        self.assertEqual(process_search_index_queue()['failed'], 0)
+        self.assertIn(f'news:{news.id}', self.get_indexed())
+
+    def test_save_once(self):
+        for i in range(3):
+            News.objects.create(title=f'Новость {i}', preview='текст')
+        backend = LocalIndexBackend()
+        with mock.patch.object(LocalSearchIndex, 'save') as save:
+            # индекс записывается на диск один раз после разбора очереди, а не после каждой пачки
+            while process_search_index_queue(batch_size=1, backend=backend)['rows']:
+                pass
+            self.assertEqual(save.call_count, 0)
+            backend.flush()
+            self.assertEqual(save.call_count, 1)
+        self.assertEqual(len(self.get_indexed()), 3)
+
+    def test_hydrated_text(self):
+        from main.serializers.search import SearchSerializer
+        from main.services.search import LocalHit, hydrate_search_hits
+
+        items = [News.objects.create(title=f'Новость {i}', preview='текст') for i in range(3)]
+        hits = [LocalHit({'id': item.id, 'model_class': 'news'}, 1.0, dict()) for item in items]
+        nodes = hydrate_search_hits(hits)
+        serializer = SearchSerializer(context={'search_nodes': nodes})
+        # текст берется из загруженных объектов без запроса на каждый результат
+        with self.assertNumQueries(0):
+            texts = [serializer.get_text(hit) for hit in hits]
+        self.assertTrue(all(text.startswith('текст') for text in texts))
+
+    def test_claim(self):
+        News.objects.create(title='Новость', preview='текст')
+        self.assertEqual(len(claim_search_index_queue(10)), 1)
+        # закрепленные записи не достаются другому обработчику до истечения срока
+        self.assertEqual(process_search_index_queue()['rows'], 0)
+        self.assertEqual(SearchIndexQueue.objects.count(), 1)
+
+    def test_pause(self):
+        news = News.objects.create(title='Новость', preview='текст')
+        pause_search_index_queue()
+        try:
+            # во время перестроения индекса изменения остаются в очереди
+            self.assertEqual(process_search_index_queue()['rows'], 0)
+            self.assertEqual(SearchIndexQueue.objects.count(), 1)
+        finally:
+            resume_search_index_queue()
+        self.assertEqual(process_search_index_queue()['rows'], 1)
+        self.assertIn(f'news:{news.id}', self.get_indexed())
+
+
+class LocalSearchIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = LocalSearchIndex()
+        self.index.add('news:1', {
+            'id': 1, 'title': 'Выставка в детском саду', 'text': '<p>Прошла выставка рисунков</p>',
+            'url': '/news/1', 'model_class': 'news', 'site': 1, 'is_global': False,
+        })
+        self.index.add('news:2', {
+            'id': 2, 'title': 'Новости сада', 'text': 'Рисунки детей',
+            'url': '/news/2', 'model_class': 'news', 'site': 2, 'is_global': False,
+        })
+        self.index.add('article:1', {
+            'id': 1, 'title': 'Статья про выставки', 'text': 'Текст',
+            'url': '/article/1', 'model_class': 'article', 'site': None, 'is_global': True,
+        })
+
+    def test_stemming(self):
+        self.assertEqual(stemmer.stem('выставки'), stemmer.stem('выставка'))
+        self.assertEqual(stemmer.stem('детского'), stemmer.stem('детский'))
+
+    def test_search(self):
+        result = [key for key, score in self.index.search('выставки рисунков', site_id=1)]
+        self.assertEqual(result, ['news:1', 'article:1'])
+
+        result = [key for key, score in self.index.search('рисунки', site_id=2)]
+        self.assertEqual(result, ['news:2'])
+
+        result = [key for key, score in self.index.search('выставка', site_id=1, model_class='article')]
+        self.assertEqual(result, ['article:1'])
+
+        self.index.remove('news:1')
+        result = [key for key, score in self.index.search('выставка', site_id=1)]
+        self.assertEqual(result, ['article:1'])
+
+    def test_query(self):
+        query = LocalSearchQuery(self.index, 'выставка', site_id=1)
+        self.assertEqual(query.count(), 2)
+        hit = query[0:1][0]
+        self.assertEqual(hit.title, 'Выставка в детском саду')
+        self.assertEqual(hit.meta['highlight']['title'][0], '<em>Выставка</em> в детском саду')
+        self.assertEqual(hit.meta['highlight']['text'][0], 'Прошла <em>выставка</em> рисунков')
+        self.assertTrue(hit.meta['score'] > 0)
+
+    def test_elasticsearch_last_page(self):
+        class Response(list):
+            hits = mock.Mock(total=mock.Mock(value=23))
+
+        search = mock.MagicMock()
+        search.__getitem__.return_value.execute.side_effect = lambda: Response(range(20, 23))
+        query = ElasticsearchSearchQuery(search, window=(20, 30))
+        # количество и короткая последняя страница получаются одним запросом
+        self.assertEqual(query.count(), 23)
+        self.assertEqual(query[20:23], [20, 21, 22])
+        self.assertEqual(search.__getitem__.call_count, 1)
+
+    def test_elasticsearch_total_limit(self):
+        class Response(list):
+            hits = mock.Mock(total=mock.Mock(value=10000, relation='gte'))
+
+        class ExactResponse(list):
+            hits = mock.Mock(total=mock.Mock(value=12345, relation='eq'))
+
+        search = mock.MagicMock()
+        search.__getitem__.return_value.execute.side_effect = lambda: Response(range(10))
+        search.extra.return_value.__getitem__.return_value.execute.side_effect = lambda: ExactResponse(range(10))
+        query = ElasticsearchSearchQuery(search, window=(0, 10))
+        # количество не ограничено порогом подсчета попаданий
+        self.assertEqual(query.count(), 12345)
+        self.assertEqual(query.count(), 12345)
+        search.extra.assert_called_once_with(track_total_hits=True)
+        self.assertEqual(query[0:10], list(range(10)))
+        self.assertEqual(search.__getitem__.call_count, 1)
+
+    def test_facets(self):
+        query = LocalSearchQuery(self.index, 'выставка', site_id=1, model_class='article', facets=True)
+        self.assertEqual(query.count(), 1)
+        self.assertEqual(query[0:10][0].url, '/article/1')
+        self.assertEqual(query.facets(), {'news': 1, 'article': 1})
+
+    def test_suggest(self):
+        # короткие заголовки первыми, документы другого сайта не подсказываются
+        result = self.index.suggest('выст', site_id=1)
+        self.assertEqual([item['url'] for item in result], ['/article/1', '/news/1'])
+        self.assertEqual(set(result[0].keys()), {'id', 'title', 'url', 'model_class'})
+
+        result = self.index.suggest('выставка дет', site_id=1)
+        self.assertEqual([item['url'] for item in result], ['/news/1'])
+        self.assertEqual(self.index.suggest('сад', site_id=1, size=1)[0]['url'], '/news/1')
+
+        self.index.remove('news:1')
+        self.assertEqual([item['url'] for item in self.index.suggest('выст', site_id=1)], ['/article/1'])
+
+
+class SearchResultCacheTestCase(TestCase):
+    def setUp(self):
+        self.index = LocalSearchIndex()
+        self.index.add('news:1', {
+            'id': 1, 'title': 'Выставка', 'text': 'Текст', 'url': '/news/1',
+            'model_class': 'news', 'site': 1, 'is_global': False,
+        })
+        self.result_cache = SearchResultCache(timeout=60, max_entries=2)
+
+    def get_query(self, text='Выставка'):
+        return CachedSearchQuery(
+            LocalSearchQuery(self.index, text, site_id=1), 1, text, result_cache=self.result_cache
+        )
+
+    def test_cache(self):
+        self.assertEqual(self.get_query().count(), 1)
+        self.assertEqual(self.get_query()[0:10][0].title, 'Выставка')
+
+        # фраза нормализуется, результаты берутся из кеша
+        with mock.patch.object(LocalSearchQuery, 'get_results', side_effect=AssertionError()):
+            query = self.get_query('  выставка ')
+            self.assertEqual(query.count(), 1)
+            hit = query[0:10][0]
+        self.assertEqual(hit.meta['highlight']['title'][0], '<em>Выставка</em>')
+
+        # после обновления индекса сайта кеш не используется
+        self.index.remove('news:1')
+        self.assertEqual(self.get_query().count(), 1)
+        bump_search_generation([1])
+        self.assertEqual(self.get_query().count(), 0)
+
+    def test_cache_key(self):
+        query = self.get_query()
+        self.assertEqual(query[0:10][0].title, 'Выставка')
+        # текст документа не хранится в кеше, ответ другого движка не берется из кеша
+        self.assertNotIn('text', self.result_cache.get(query.key + ('page', 0, 10))[0][0])
+        other = CachedSearchQuery(mock.Mock(**{'count.return_value': 5}), 1, 'Выставка',
+                                  result_cache=self.result_cache)
+        self.assertNotEqual(other.key, query.key)
+        self.assertEqual(other.count(), 5)
+
+    def test_suggest_fallback(self):
+        index = get_local_index('search')
+        index.clear()
+        index.add('news:1', {
+            'id': 1, 'title': 'Выставка', 'text': 'Текст', 'url': '/news/1',
+            'model_class': 'news', 'site': 1, 'is_global': False,
+        })
+        backend = mock.Mock(**{'suggest.side_effect': RuntimeError('no completion field')})
+        with mock.patch.object(search, 'get_search_backend', return_value=backend):
+            result = search.get_suggestions('выст', 1, result_cache=self.result_cache)
+            # запасной результат кешируется, движок не запрашивается повторно
+            self.assertEqual(search.get_suggestions('выст', 1, result_cache=self.result_cache), result)
+        self.assertEqual([item['url'] for item in result], ['/news/1'])
+        self.assertEqual(backend.suggest.call_count, 1)
+
+        # индекс без поля автодополнения: запросы к движку не отправляются
+        backend = mock.Mock(**{'supports_suggest.return_value': False})
+        with mock.patch.object(search, 'get_search_backend', return_value=backend):
+            result = search.get_suggestions('выста', 1, result_cache=self.result_cache)
+        self.assertEqual([item['url'] for item in result], ['/news/1'])
+        backend.suggest.assert_not_called()
+        index.clear()
+
+    def test_lru(self):
+        self.result_cache.set(('a', ), 1)
+        self.result_cache.set(('b', ), 2)
+        self.result_cache.get(('a', ))
+        self.result_cache.set(('c', ), 3)
+        self.assertEqual(self.result_cache.get(('a', )), 1)
+        self.assertIsNone(self.result_cache.get(('b', )))
@@ -0,0 +1,197 @@
+from django.test import TestCase
+
+from main.models.section import Section
+from main.models.section_settings import SectionSettings
+from main.models.site import Site
+from main.services.section import build_children_index, SectionAncestorsResolver, SectionSettingsResolver
+
+
+class SectionTreeTestCase(TestCase):
+    def test_build_children_index(self):
+        root1 = Section(id=1, title='root1', parent_id=None)
+        root2 = Section(id=2, title='root2', parent_id=None)
+        child1 = Section(id=3, title='child1', parent_id=1)
+        child2 = Section(id=4, title='child2', parent_id=1)
+        child3 = Section(id=5, title='child3', parent_id=3)
+
+        index = build_children_index([root1, child1, root2, child2, child3])
+        self.assertEqual(index[None], [root1, root2])
+        self.assertEqual(index[1], [child1, child2])
+        self.assertEqual(index[3], [child3])
+        self.assertEqual(index.get(2, []), [])
+
+
+class SectionSettingsResolverTestCase(TestCase):
+    fixtures = [
+        'sites.json',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.site = Site.objects.first()
+        cls.root = Section.objects.create(title='root')
+        cls.children = [
+            Section.objects.create(title=f'child{i}', parent=cls.root)
+            for i in range(5)
+        ]
+        SectionSettings.objects.create(section=cls.root, site=cls.site, is_active=False)
+        SectionSettings.objects.create(section=cls.children[0], site=cls.site, is_active=False)
+
+    def test_prefetch(self):
+        children = list(Section.objects.filter(parent=self.root))
+        resolver = SectionSettingsResolver(self.site)
+        with self.assertNumQueries(1):
+            resolver.prefetch(children)
+
+        root = Section.objects.get(id=self.root.id)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(resolver.get(root))
+            for child in children:
+                self.assertEqual(resolver.get(child) is not None, child.id == self.children[0].id)
+                self.assertEqual(child.is_active(self.site, resolver=resolver), child.id != self.children[0].id)
+
+    def test_site_overlay(self):
+        SectionSettings.objects.filter(section=self.children[0]).update(order=5)
+        queryset = Section.annotate_site_overlay(Section.objects.filter(parent=self.root), self.site)\
+            .order_by('ordering', 'order', 'id')
+        items = list(queryset)
+        self.assertEqual(len(items), 5)
+        self.assertEqual(items[0].id, self.children[0].id)
+        self.assertEqual(items[0].ordering, 5)
+        self.assertFalse(items[0].site_is_active)
+        for item in items[1:]:
+            self.assertEqual(item.ordering, 100)
+            self.assertTrue(item.site_is_active)
+
+        active = queryset.filter(site_is_active=True)
+        self.assertEqual(active.count(), 4)
+
+
+class SectionAncestorsResolverTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Section.objects.create(title='root')
+        cls.child = Section.objects.create(title='child', parent=cls.root)
+        cls.grandchildren = [
+            Section.objects.create(title=f'grandchild{i}', parent=cls.child)
+            for i in range(5)
+        ]
+
+    def test_get_ancestors(self):
+        sections = list(Section.objects.filter(parent=self.child)) + [Section.objects.get(id=self.root.id)]
+        resolver = SectionAncestorsResolver()
+        with self.assertNumQueries(1):
+            resolver.prefetch(sections)
+
+        expected = {section.id: list(section.get_ancestors(ascending=False)) for section in sections}
+        with self.assertNumQueries(0):
+            for section in sections:
+                self.assertEqual(resolver.get_ancestors(section), expected[section.id])
+                self.assertEqual(resolver.get_ancestors(section, include_self=True)[-1], section)
+
+
+class SectionPurgeTestCase(TestCase):
+    def test_purge_keeps_live_children(self):
+        from django.utils import timezone
+        from main.services.purge import purge_deleted
+
+        root = Section.objects.create(title='root')
+        deleted = Section.objects.create(title='deleted', parent=root)
+        live = Section.objects.create(title='live', parent=deleted)
+        empty = Section.objects.create(title='empty', parent=root)
+        Section.objects.filter(id__in=[root.id, deleted.id, empty.id]).soft_delete()
+        Section.objects.all().update(date_deleted=timezone.datetime.now() - timezone.timedelta(days=100))
+
+        # пробный запуск учитывает только узлы без неудаленных потомков
+        dry_stats = list(purge_deleted(Section, retention_days=90, dry_run=True))
+        self.assertEqual(sum(item['rows'] for item in dry_stats), 1)
+        self.assertEqual(Section.objects.count(), 4)
+
+        stats = list(purge_deleted(Section, retention_days=90))
+        self.assertEqual(sum(item['rows'] for item in stats), 1)
+        self.assertEqual([item['bytes'] for item in stats], [item['bytes'] for item in dry_stats])
+        self.assertEqual(
+            set(Section.objects.values_list('id', flat=True)),
+            {root.id, deleted.id, live.id}
+        )
+        self.assertFalse(Section.objects.get(id=live.id).is_deleted)
+
+
+class SectionTreeGenerationTestCase(TestCase):
+    fixtures = [
+        'sites.json',
+    ]
+
+    def test_site_generation(self):
+        from main.services.section import get_section_tree_generation
+
+        site = Site.objects.first()
+        other_site_id = site.id + 1000
+        section = Section.objects.create(title='section')
+        generation = get_section_tree_generation(site.id)
+        other_generation = get_section_tree_generation(other_site_id)
+
+        # раздел сайта сбрасывает только деревья своего сайта
+        section.sites.add(site)
+        self.assertNotEqual(get_section_tree_generation(site.id), generation)
+        self.assertEqual(get_section_tree_generation(other_site_id), other_generation)
+
+        generation = get_section_tree_generation(site.id)
+        section.title = 'section 2'
+        section.save()
+        self.assertNotEqual(get_section_tree_generation(site.id), generation)
+        self.assertEqual(get_section_tree_generation(other_site_id), other_generation)
+
+        # глобальный раздел входит в деревья всех сайтов
+        section.is_global = True
+        section.save()
+        self.assertNotEqual(get_section_tree_generation(other_site_id), other_generation)
+
+
+class SectionOrderingTestCase(TestCase):
+    fixtures = [
+        'sites.json',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.site = Site.objects.first()
+        cls.root = Section.objects.create(title='root', template=cls.site.template, is_global=True)
+        cls.children = [
+            Section.objects.create(title=f'child{i}', parent=cls.root, template=cls.site.template, is_global=True)
+            for i in range(4)
+        ]
+        SectionSettings.objects.create(section=cls.children[0], site=cls.site, order=50)
+
+    def get_ordered_ids(self) -> list:
+        queryset = Section.annotate_site_overlay(Section.objects.filter(parent=self.root), self.site)\
+            .order_by('ordering', 'order', 'id')
+        return [item.id for item in queryset]
+
+    def test_save_ordering(self):
+        from main.services.section import get_cached_section_tree, get_section_tree_generation, \
+            save_sections_ordering, set_cached_section_tree
+
+        set_cached_section_tree(self.site, True, None, ['cached'])
+        generation = get_section_tree_generation(self.site.id)
+        items = [
+            {'id': self.children[2].id, 'order': 1},
+            {'id': self.children[0].id, 'order': 2},
+            {'id': self.children[1].id, 'order': 3},
+        ]
+        # разделы, блокировка настроек, обновление существующих и вставка новых пачкой в точке сохранения
+        with self.assertNumQueries(6):
+            result = save_sections_ordering(self.site, items)
+        self.assertEqual([item.id for item in result], [item['id'] for item in items])
+
+        self.assertEqual(
+            self.get_ordered_ids(),
+            [self.children[2].id, self.children[0].id, self.children[1].id, self.children[3].id]
+        )
+        # существующая строка настроек обновлена, а не продублирована
+        self.assertEqual(SectionSettings.objects.filter(section=self.children[0], site=self.site).count(), 1)
+        self.assertEqual(SectionSettings.objects.filter(site=self.site).count(), 3)
+
+        # закешированное дерево сайта больше не используется
+        self.assertNotEqual(get_section_tree_generation(self.site.id), generation)
+        self.assertIsNone(get_cached_section_tree(self.site, True, None))
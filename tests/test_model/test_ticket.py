@@ -0,0 +1,143 @@
+import threading
+from types import SimpleNamespace
+from unittest import skipUnless
+
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+
+from main.models.ticket import Ticket
+from main.models.ticket_inbox import TicketInboxSummary
+from main.models.user import User
+
+
+class TicketCounterTestCase(TestCase):
+    fixtures = [
+        'user.json',
+    ]
+
+    def setUp(self):
+        self.user = User.objects.get_by_username('user')
+        self.staff_user = User.objects.get_by_username('staff')
+        self.ticket = Ticket.objects.create(
+            title='Тикет', body='Описание', sender=self.user, ticket_type=Ticket.TicketType.TECH
+        )
+
+    def test_counters(self):
+        self.ticket.onChatMessageAdd(SimpleNamespace(user_id=self.user.id, user=self.user))
+        self.ticket.onChatMessageAdd(SimpleNamespace(user_id=self.staff_user.id, user=self.staff_user))
+        self.ticket.onChatMessageAdd(SimpleNamespace(user_id=self.staff_user.id, user=self.staff_user))
+        self.assertEqual((self.ticket.count_new_staff, self.ticket.count_new_user), (1, 2))
+
+        self.ticket.mark_read(for_staff=False)
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        self.assertEqual((ticket.count_new_staff, ticket.count_new_user), (1, 0))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Параллельная запись проверяется на PostgreSQL')
+class TicketCounterConcurrencyTestCase(TransactionTestCase):
+    fixtures = [
+        'user.json',
+    ]
+
+    def test_parallel_messages(self):
+        user = User.objects.get_by_username('user')
+        ticket = Ticket.objects.create(title='Тикет', body='Описание', sender=user, ticket_type=Ticket.TicketType.TECH)
+        threads_count = 8
+        messages_count = 25
+        barrier = threading.Barrier(threads_count)
+
+        def post_messages():
+            try:
+                barrier.wait()
+                obj = Ticket.objects.get(id=ticket.id)
+                for _ in range(messages_count):
+                    obj.onChatMessageAdd(SimpleNamespace(user_id=user.id, user=user))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post_messages) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.count_new_staff, threads_count * messages_count)
+
+
+class TicketInboxSummaryTestCase(TestCase):
+    fixtures = [
+        'user.json',
+    ]
+
+    def setUp(self):
+        self.user = User.objects.get_by_username('user')
+
+    def create_ticket(self, **kwargs) -> Ticket:
+        return Ticket.objects.create(
+            title='Тикет', body='Описание', sender=self.user, ticket_type=Ticket.TicketType.TECH, **kwargs
+        )
+
+    def test_summary(self):
+        ticket1 = self.create_ticket()
+        ticket2 = self.create_ticket()
+        ticket1.onChatMessageAdd(SimpleNamespace(user_id=self.user.id, user=self.user))
+
+        summary = TicketInboxSummary.get_summary()
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['count_new_staff'], 1)
+        self.assertEqual(summary['statuses'], {Ticket.Status.NEW: 2})
+
+        ticket1 = Ticket.objects.get(id=ticket1.id)
+        ticket1.status = Ticket.Status.OPEN
+        ticket1.save()
+        ticket2.delete()
+        summary = TicketInboxSummary.get_summary()
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(summary['statuses'], {Ticket.Status.NEW: 0, Ticket.Status.OPEN: 1})
+        self.assertEqual(summary['count_new_staff'], 1)
+
+        ticket1.mark_read(for_staff=True)
+        self.assertEqual(TicketInboxSummary.get_summary()['count_new_staff'], 0)
+
+        # сводка совпадает с пересчетом по таблице тикетов
+        expected = TicketInboxSummary.get_summary()
+        TicketInboxSummary.rebuild()
+        summary = TicketInboxSummary.get_summary()
+        self.assertEqual(summary['count'], expected['count'])
+        self.assertEqual(summary['count_new_staff'], expected['count_new_staff'])
+        self.assertEqual(summary['statuses'].get(Ticket.Status.OPEN), 1)
+
+    def test_stale_counter_save(self):
+        ticket = self.create_ticket()
+        stale = Ticket.objects.get(id=ticket.id)
+        # новое сообщение пользователя после загрузки тикета модератором
+        ticket.onChatMessageAdd(SimpleNamespace(user_id=self.user.id, user=self.user))
+
+        stale.status = Ticket.Status.OPEN
+        stale.save()
+        self.assertEqual(stale.count_new_staff, 1)
+        self.assertEqual(Ticket.objects.get(id=ticket.id).count_new_staff, 1)
+
+        summary = TicketInboxSummary.get_summary()
+        self.assertEqual(summary['count_new_staff'], 1)
+        self.assertEqual(summary['statuses'], {Ticket.Status.NEW: 0, Ticket.Status.OPEN: 1})
+        TicketInboxSummary.rebuild()
+        self.assertEqual(TicketInboxSummary.get_summary()['count_new_staff'], 1)
+
+    def test_concurrent_recount(self):
+        from unittest import mock
+        from django.db import IntegrityError
+
+        self.create_ticket()
+        self.create_ticket()
+        TicketInboxSummary.objects.all().delete()
+
+        def create(**kwargs):
+            # ячейку создала другая транзакция между UPDATE и INSERT
+            TicketInboxSummary.objects.bulk_create([TicketInboxSummary(**dict(kwargs, count=1))])
+            raise IntegrityError()
+
+        with mock.patch.object(TicketInboxSummary.objects, 'create', side_effect=create):
+            TicketInboxSummary.recount(None, Ticket.Status.NEW, Ticket.TicketType.TECH)
+        self.assertEqual(TicketInboxSummary.get_summary()['count'], 2)
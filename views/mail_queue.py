@@ -0,0 +1,23 @@
+"""
+API состояния очереди писем для модераторов
+"""
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from main.api.permissions import IsStaff
+from main.services.feedback import get_mail_queue_stats
+
+
+class MailQueueStatsView(APIView):
+    """
+    Состояние очереди писем: ожидают отправки и повтора, отправлено и отброшено за период, последняя ошибка.
+    Читается из таблиц django_mail_admin, поэтому учитывает все обработчики очереди
+    """
+    permission_classes = [IsStaff]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            hours = min(max(int(request.GET.get('hours', 24)), 1), 24 * 30)
+        except ValueError:
+            hours = 24
+        return Response(get_mail_queue_stats(hours))
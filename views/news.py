@@ -1,13 +1,19 @@
 """
 API новостей
 """
+import base64
+import typing
+from collections import OrderedDict, defaultdict
+
 from django_filters.rest_framework import DjangoFilterBackend, FilterSet
 from rest_framework import filters
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.permissions import DjangoObjectPermissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.utils.urls import replace_query_param
 from django.db.models import Q, Case, IntegerField, When
 from django.conf import settings
 from django.utils import timezone
@@ -16,6 +22,7 @@ from main.api.general import DestroyManyMixin, IdsFilter, PageSizeMixin, Infinit
 from main.api.permissions import IsStaff, ReadObjectPermission
 from main.api.mixins.status_delete import StatusDeleteMixin
 from main.models import News, Section
+from main.models.news_archive import NewsArchive
 from main.serializers.news import NewsSerializer, NewsStaffSerializer, NewsKindergartenSerializer, NewsPortalSerializer, NewsListStaffSerializer
 
 
@@ -34,6 +41,128 @@ class NewsFilter(FilterSet):
         }
 
 
+class NewsCursorPagination(BasePagination):
+    """
+    Навигация по курсору (top_order, date_publish, id) для бесконечной ленты новостей.
+    Важные новости и остальные выбираются отдельными запросами, поэтому каждая страница
+    читается по индексу (site, date_publish, id) без OFFSET и COUNT(*)
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор'
+
+    def __init__(self, page_size: int = 10):
+        self.page_size = page_size
+        self.request = None
+        self.next_position = None
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.GET.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, position: tuple) -> str:
+        top_order, date_publish, pk = position
+        # новости без даты публикации идут в конце ленты, в курсоре дата пустая
+        value = f'{top_order}|{date_publish.isoformat() if date_publish else ""}|{pk}'
+        return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.GET.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8')
+            top_order, date_publish, pk = value.split('|')
+            return int(top_order), timezone.datetime.fromisoformat(date_publish) if date_publish else None, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def get_regions(queryset) -> typing.List[tuple]:
+        """
+        Части ленты в порядке вывода: (top_order, есть дата публикации) и запрос части.
+        Новости без даты публикации - отдельная часть в конце, поэтому каждая часть читается
+        обратным проходом по индексу (site, date_publish, id)
+        """
+        regions = []
+        for top_order in (1, 0):
+            region = queryset.filter(top_order=top_order)
+            dated = region.filter(date_publish__isnull=False).order_by('-date_publish', '-id')
+            regions.append(((top_order, True), dated))
+            regions.append(((top_order, False), region.filter(date_publish__isnull=True).order_by('-id')))
+        return regions
+
+    @staticmethod
+    def get_position_query(position: tuple) -> Q:
+        """ Условие новостей части ленты после позиции курсора """
+        _, date_publish, pk = position
+        if date_publish is None:
+            return Q(id__lt=pk)
+        # верхняя граница по дате задает диапазон индекса, уточнение по id отсекает уже выведенные новости
+        return Q(date_publish__lte=date_publish) \
+            & (Q(date_publish__lt=date_publish) | Q(date_publish=date_publish, id__lt=pk))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        regions = self.get_regions(queryset)
+        start = 0
+        if position:
+            keys = [key for key, _ in regions]
+            key = (position[0], position[1] is not None)
+            if key not in keys:
+                raise NotFound(self.invalid_cursor_message)
+            start = keys.index(key)
+
+        items = []
+        for index, (key, region) in enumerate(regions[start:], start=start):
+            if position and index == start:
+                region = region.filter(self.get_position_query(position))
+            items += list(region[:page_size + 1 - len(items)])
+            if len(items) > page_size:
+                break
+
+        if len(items) > page_size:
+            items = items[:page_size]
+            last = items[-1]
+            self.next_position = (last.top_order, last.date_publish, last.id)
+        else:
+            self.next_position = None
+        return items
+
+    def get_next_link(self):
+        if not self.next_position:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('cursor', self.encode_cursor(self.next_position) if self.next_position else None),
+            ('results', data),
+        ]))
+
+
+class NewsCursorMixin:
+    """ Включает навигацию по курсору параметром pagination=cursor """
+
+    @property
+    def paginator(self):
+        request = getattr(self, 'request', None)
+        if request and (request.GET.get('pagination') == 'cursor' or request.GET.get('cursor')):
+            if not hasattr(self, '_cursor_paginator'):
+                self._cursor_paginator = NewsCursorPagination(page_size=self.page_size)
+            return self._cursor_paginator
+        return super(NewsCursorMixin, self).paginator
+
+
 class BaseNewsView(StatusDeleteMixin, PageSizeMixin, ModelViewSet):
     """
     Базовый API новостей
@@ -82,7 +211,7 @@ class BaseNewsView(StatusDeleteMixin, PageSizeMixin, ModelViewSet):
         return queryset
 
 
-class NewsView(BaseNewsView):
+class NewsView(NewsCursorMixin, BaseNewsView):
     """
     Публичный API раздела файлов
     """
@@ -119,24 +248,38 @@ class NewsView(BaseNewsView):
     @action(detail=False, methods=['GET'], url_path='stats')
     def stats(self, request, *args, **kwargs):
         """ Возвращает статистику по разделу новостей """
+        site = self.request.site
+        is_chronicles = self.request.GET.get('is_chronicles') == 'true'
 
-        news_queryset = self.get_queryset()
-        if self.request.GET.get('is_chronicles') == 'true':
-            news_queryset = news_queryset.filter(is_chronicles=True)
+        # прошедшие месяцы берутся из архива, текущий и будущие зависят от даты публикации
+        # и считаются по новостям
+        now = timezone.datetime.now()
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        counts = defaultdict(int)
 
-        queryset = news_queryset.extra(
-            select={'year': 'date_part(\'year\', main_news.date_publish)'}
-        ).values_list('year').distinct()
+        archive_query = Q(year__lt=now.year) | Q(year=now.year, month__lt=now.month)
+        if site:
+            archive_query &= Q(site=site)
+        elif settings.IS_PORTAL_SITE:
+            archive_query &= Q(site__isnull=True)
+        else:
+            archive_query &= Q(id__isnull=True)
+        if is_chronicles:
+            archive_query &= Q(is_chronicles=True)
+        for year, month, count in NewsArchive.objects.filter(archive_query).values_list('year', 'month', 'count'):
+            counts[(year, month)] += count
+
+        news_queryset = self.get_queryset().filter(date_publish__gte=month_start)
+        if is_chronicles:
+            news_queryset = news_queryset.filter(is_chronicles=True)
+        for date_publish in news_queryset.values_list('date_publish', flat=True):
+            counts[(date_publish.year, date_publish.month)] += 1
 
-        month_queryset = news_queryset.extra(
-            select={
-                'year': 'date_part(\'year\', main_news.date_publish)',
-                'month': 'date_part(\'month\', main_news.date_publish)'
-            }
-        ).values_list('year', 'month').distinct()
+        months = sorted(key for key, count in counts.items() if count)
         return Response({
-            'years': sorted(set([item[0] for item in queryset])),
-            'months': list(month_queryset)
+            'years': sorted(set([item[0] for item in months])),
+            'months': months,
+            'counts': [{'year': year, 'month': month, 'count': counts[(year, month)]} for year, month in months],
         })
 
     @action(detail=True, methods=['POST'], url_name='copy_chronicles')
@@ -150,7 +293,7 @@ class NewsView(BaseNewsView):
 
 
 
-class NewsStaffView(InfiniteMixin, DestroyManyMixin, BaseNewsView):
+class NewsStaffView(NewsCursorMixin, InfiniteMixin, DestroyManyMixin, BaseNewsView):
     """
     API раздела файлов для администраторов
     """
@@ -166,3 +309,24 @@ class NewsStaffView(InfiniteMixin, DestroyManyMixin, BaseNewsView):
     def get_queryset(self):
         return super(NewsStaffView, self).get_queryset()\
                     .select_related('site')
+
+    @staticmethod
+    def get_request_ids(request) -> typing.List[int]:
+        """ Возвращает идентификаторы новостей из тела запроса (ids) """
+        ids = request.data.getlist('ids') if hasattr(request.data, 'getlist') else request.data.get('ids')
+        try:
+            return [int(pk) for pk in ids or []]
+        except (TypeError, ValueError):
+            raise ValidationError({'ids': 'Некорректный список идентификаторов'})
+
+    @action(detail=False, methods=['post'], url_path='soft-delete', url_name='soft_delete_many')
+    def soft_delete_many(self, request, *args, **kwargs):
+        """ Помечает новости удаленными одним UPDATE, побочные действия выполняются пачкой """
+        count = News.objects.filter(id__in=self.get_request_ids(request)).soft_delete()
+        return Response({'count': count})
+
+    @action(detail=False, methods=['post'], url_path='restore', url_name='restore_many')
+    def restore_many(self, request, *args, **kwargs):
+        """ Восстанавливает удаленные новости одним UPDATE """
+        count = News.objects.filter(id__in=self.get_request_ids(request)).restore()
+        return Response({'count': count})
@@ -1,19 +1,83 @@
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MultiMatch, Q
 
 from main.serializers.search import SearchSerializer
 from main.api.general import PageSizeMixin
+from main.services.search import SUGGEST_MAX_SIZE, SUGGEST_SIZE, CachedSearchQuery, get_search_backend, \
+    get_suggestions, hydrate_search_hits
 
 
 class SearchView(PageSizeMixin, ReadOnlyModelViewSet):
     page_size = 10
     serializer_class = SearchSerializer
+    search_nodes = None
+    search_query = None
+
+    def use_facets(self) -> bool:
+        """ Количество результатов по типам объектов возвращается по параметру facets=1 """
+        return self.request.GET.get('facets') in ('1', 'true')
+
+    def get_page_window(self):
+        """ Срез запрашиваемой страницы по параметрам пагинатора, чтобы количество и страница получались одним запросом """
+        paginator = self.paginator
+        if paginator is None:
+            return None
+        if hasattr(paginator, 'get_offset'):
+            limit = paginator.get_limit(self.request)
+            offset = paginator.get_offset(self.request)
+            return (offset, offset + limit) if limit else None
+        if not hasattr(paginator, 'get_page_number'):
+            return None
+        page_size = paginator.get_page_size(self.request)
+        try:
+            # номер последней страницы (page=last) неизвестен до подсчета результатов
+            page = int(paginator.get_page_number(self.request, None))
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if not page_size or page < 1:
+            return None
+        return (page - 1) * page_size, page * page_size
 
     def get_queryset(self):
         search_text = self.request.GET.get('search', '')
-        query = (Q('term', site=self.request.site.id) | Q('term', is_global=True))\
-            & MultiMatch(query=search_text, fields=['title', 'text'])
+        model_class = None
         if self.request.GET.get('section') and self.request.GET.get('section') != 'all':
-            query &= Q('term', model_class=self.request.GET.get('section'))
-        return Search(index='search').query(query).highlight('title', 'text')
+            model_class = self.request.GET.get('section')
+        query = get_search_backend().search(
+            search_text, self.request.site.id, model_class=model_class,
+            facets=self.use_facets(), window=self.get_page_window(),
+        )
+        self.search_query = CachedSearchQuery(query, self.request.site.id, search_text, model_class=model_class)
+        return self.search_query
+
+    def paginate_queryset(self, queryset):
+        page = super(SearchView, self).paginate_queryset(queryset)
+        if page is not None:
+            # объекты результатов загружаются пачкой по моделям
+            self.search_nodes = hydrate_search_hits(page)
+        return page
+
+    def get_paginated_response(self, data):
+        response = super(SearchView, self).get_paginated_response(data)
+        if self.use_facets():
+            response.data['facets'] = self.search_query.facets()
+        return response
+
+    def get_serializer_context(self):
+        context = super(SearchView, self).get_serializer_context()
+        if self.search_nodes is not None:
+            context['search_nodes'] = self.search_nodes
+        return context
+
+    @action(detail=False, methods=['get'], url_path='suggest')
+    def suggest(self, request, *args, **kwargs):
+        """ Подсказки по началу поисковой фразы: только id, title, url и model_class """
+        prefix = request.GET.get('search', '').strip()
+        try:
+            size = min(int(request.GET.get('size', SUGGEST_SIZE)), SUGGEST_MAX_SIZE)
+        except ValueError:
+            size = SUGGEST_SIZE
+        if not prefix or size <= 0:
+            return Response([])
+        return Response(get_suggestions(prefix, request.site.id, size=size))
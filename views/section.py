@@ -24,6 +24,7 @@ from main.serializers.section import (SectionHierarchySerializer,
                                       SectionSerializer,
                                       SectionStaffSerializer)
 from main.serializers.section_settings import SectionSettingsSerializer
+from main.services.section import get_cached_section_tree, save_sections_ordering, set_cached_section_tree
 
 logger = logging.getLogger('debug')
 
@@ -90,10 +91,7 @@ class SectionView(BaseSectionView):
         else:
             if not self.request.user.is_staff:
                 query &= Q(id__isnull=True)
-        return super(SectionView, self).get_queryset().filter(query)\
-            .extra(
-                **Section.get_extrafilter_ordering_by_site(site)
-            )\
+        return Section.annotate_site_overlay(super(SectionView, self).get_queryset().filter(query), site)\
             .prefetch_related('settings')\
             .order_by('ordering', 'order')\
             .distinct()
@@ -125,6 +123,14 @@ class SectionView(BaseSectionView):
         """ Возвращает сериализованное дерево разделов """
         site = self._get_current_site(self.request)
 
+        # дерево одинаково для всех анонимных посетителей сайта, поэтому отдаю его из кеша
+        is_active = request.GET.get('is_active') == 'true'
+        use_cache = site is not None and not request.user.is_authenticated
+        if use_cache:
+            data = get_cached_section_tree(site, is_active, request.GET.get('code'))
+            if data is not None:
+                return Response(data)
+
         # получение разделов первого уровня
         query = Q(level=0, is_deleted=False)
         if request.GET.get('code'):
@@ -132,25 +138,24 @@ class SectionView(BaseSectionView):
         items = self.get_queryset().filter(query)
         if request.GET.get('is_active') == 'true' and site:
             # фильтрация отключенных в админке разделов
-            items = items.extra(
-                **Section.get_extrafilter_active_by_site(site)
-            )
+            items = items.filter(site_is_active=True)
 
         # получение всех разделов сайта для постороения иерархии
         query = Q(is_deleted=False)
         all_items = self.get_queryset().filter(query)
         if request.GET.get('is_active') == 'true' and site:
             # фильтрация отключенных в админке разделов
-            all_items = all_items.extra(
-                **Section.get_extrafilter_active_by_site(site)
-            )
+            all_items = all_items.filter(site_is_active=True)
 
         serializer_context = self.get_serializer_context()
         serializer_context.update({
             'sections': list(all_items)
         })
 
-        return Response(SectionHierarchySerializer(items, many=True, context=serializer_context).data)
+        data = SectionHierarchySerializer(items, many=True, context=serializer_context).data
+        if use_cache:
+            set_cached_section_tree(site, is_active, request.GET.get('code'), data)
+        return Response(data)
 
     @action(detail=False, methods=['get'], url_name='slug')
     def slug(self, request, *args, **kwargs):
@@ -183,20 +188,7 @@ class SectionView(BaseSectionView):
         """ Сохранение порядка сортировки элементов """
         if request.user.has_perm('main.change_site', request.site):
             try:
-                result = []
-                for item in request.data:
-                    section = Section.objects.filter(Section.get_filter_query_by_site(request.site) & Q(id=item['id'])).first()
-                    if section:
-                        if item['order'] or item['order'] == 0:
-                            settings = section.get_settings(request.site, cache=False)
-                            if not settings:
-                                settings = SectionSettings.objects.create(
-                                    site=request.site,
-                                    section=section,
-                                )
-                            settings.order = item['order']
-                            settings.save()
-                        result.append(section)
+                result = save_sections_ordering(request.site, request.data)
                 return Response(SectionSerializer(result, many=True, context=self.get_serializer_context()).data)
             except:
                 logger.error('Ошибка в отправляемых данных сортировки')
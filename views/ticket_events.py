@@ -0,0 +1,82 @@
+"""
+Поток событий изменения счетчиков новых сообщений в тикетах (server-sent events)
+"""
+import json
+import time
+
+from django.db import connection
+from django.http import StreamingHttpResponse
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.views import APIView
+
+from main.models.ticket import Ticket
+from main.models.ticket_inbox import TicketInboxSummary
+from main.services.event_bus import get_event_bus
+
+
+class EventStreamRenderer(BaseRenderer):
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class TicketEventsView(APIView):
+    """
+    Поток событий изменения счетчиков новых сообщений вместо периодического опроса списка тикетов.
+    Пользователь получает события своих тикетов, модератор - также события счетчиков модераторов.
+    Первое событие snapshot содержит текущие значения, соединение закрывается через max_duration
+    секунд, клиент переподключается автоматически
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+    heartbeat_interval = 15
+    max_duration = 5 * 60
+    retry = 3000
+
+    @staticmethod
+    def format_event(name: str, data) -> str:
+        return f'event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+    def get_channels(self, user) -> list:
+        channels = [Ticket.get_user_channel(user.id)]
+        if user.is_staff:
+            channels.append(Ticket.STAFF_CHANNEL)
+        return channels
+
+    def get_snapshot(self, user) -> dict:
+        result = {
+            'tickets': list(
+                Ticket.alive.filter(sender=user, count_new_user__gt=0).values('id', 'site_id', 'count_new_user')
+            ),
+        }
+        if user.is_staff:
+            result['count_new_staff'] = TicketInboxSummary.get_summary()['count_new_staff']
+        return result
+
+    def stream(self, user):
+        # подписка до чтения текущих значений, чтобы не пропустить изменения между ними
+        subscription = get_event_bus().subscribe(self.get_channels(user))
+        try:
+            yield f'retry: {self.retry}\n\n'
+            yield self.format_event('snapshot', self.get_snapshot(user))
+            # дальше БД не нужна, соединение не удерживается на время потока
+            if not connection.in_atomic_block:
+                connection.close()
+            deadline = time.monotonic() + self.max_duration
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=self.heartbeat_interval)
+                if event is None:
+                    yield ': heartbeat\n\n'
+                else:
+                    yield self.format_event('ticket', event)
+        finally:
+            subscription.close()
+
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(self.stream(request.user), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
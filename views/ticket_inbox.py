@@ -0,0 +1,34 @@
+"""
+API сводки обращений для модераторов
+"""
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from main.api.permissions import IsStaff
+from main.models.ticket import Ticket
+from main.models.ticket_inbox import TicketInboxSummary
+
+
+class TicketInboxSummaryView(APIView):
+    """
+    Сводка обращений для панели модераторов: количество тикетов по статусам и типам,
+    количество новых сообщений по сайтам. Читается из поддерживаемой таблицы сводки
+    """
+    permission_classes = [IsStaff]
+
+    def get(self, request, *args, **kwargs):
+        site_id = request.GET.get('site')
+        try:
+            site_id = int(site_id) if site_id else None
+        except ValueError:
+            site_id = None
+        summary = TicketInboxSummary.get_summary(site_id)
+        summary['statuses'] = [
+            {'status': key, 'title': title, 'count': summary['statuses'].get(key, 0)}
+            for key, title in Ticket.Status.to_dict().items()
+        ]
+        summary['types'] = [
+            {'ticket_type': key, 'title': title, 'count': summary['types'].get(key, 0)}
+            for key, title in Ticket.TicketType.to_dict().items()
+        ]
+        return Response(summary)